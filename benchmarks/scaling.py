@@ -0,0 +1,107 @@
+"""
+Scaling benchmark for the parallel (--workers) mode of both calculators.
+
+The bundled inputs are replicated `--copies` times under new ccy_pair / security_id keys, so the key space grows
+while each partition keeps its real shape. Every calculation then runs with 1 to N worker processes.
+
+Usage (from the repo root):
+    python benchmarks/scaling.py --copies 20 --max-workers 8
+"""
+import argparse
+import duckdb
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'rates_test' / 'scripts'))
+sys.path.insert(0, str(ROOT / 'stdev_test' / 'scripts'))
+
+from rates_calculation import FXRates  # noqa: E402
+from rolling_stdev_calculation import RollingStdev  # noqa: E402
+
+
+def replicate_inputs(temp_dir, copies):
+    """ Writes the bundled inputs `copies` times over, each copy with its keys suffixed by the copy number """
+    rates_data = ROOT / 'rates_test' / 'data'
+    stdev_data = ROOT / 'stdev_test' / 'data'
+    paths = {
+        'price': os.path.join(temp_dir, 'price.parq'),
+        'spot': os.path.join(temp_dir, 'spot.parq'),
+        'ccy': os.path.join(temp_dir, 'ccy.csv'),
+        'stdev': os.path.join(temp_dir, 'stdev.parq'),
+    }
+    con = duckdb.connect()
+    con.execute(f"""
+        COPY (
+            SELECT * REPLACE (ccy_pair || '_' || c.i AS ccy_pair)
+            FROM read_parquet('{rates_data / 'rates_price_data.parq'}'), range({copies}) c(i)
+        ) TO '{paths['price']}' (FORMAT parquet)
+    """)
+    con.execute(f"""
+        COPY (
+            SELECT * REPLACE (ccy_pair || '_' || c.i AS ccy_pair)
+            FROM read_parquet('{rates_data / 'rates_spot_rate_data.parq'}'), range({copies}) c(i)
+        ) TO '{paths['spot']}' (FORMAT parquet)
+    """)
+    con.execute(f"""
+        COPY (
+            SELECT * REPLACE (ccy_pair || '_' || c.i AS ccy_pair)
+            FROM read_csv_auto('{rates_data / 'rates_ccy_data.csv'}'), range({copies}) c(i)
+        ) TO '{paths['ccy']}' (HEADER)
+    """)
+    con.execute(f"""
+        COPY (
+            SELECT * REPLACE (security_id || '_' || c.i AS security_id)
+            FROM read_parquet('{stdev_data / 'stdev_price_data.parq'}'), range({copies}) c(i)
+        ) TO '{paths['stdev']}' (FORMAT parquet)
+    """)
+    con.close()
+    return paths
+
+
+def time_run(calculation):
+    start = time.perf_counter()
+    calculation.run()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parallel execution with 1 to N workers")
+    parser.add_argument('--copies', default=20, type=int, help='Replications of the bundled inputs')
+    parser.add_argument('--max-workers', default=os.cpu_count() or 1, type=int)
+    parser.add_argument('--memory-limit', default=None, help="DuckDB memory budget per worker, e.g. '1GB'")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = replicate_inputs(temp_dir, args.copies)
+        output_file = os.path.join(temp_dir, 'output.csv')
+
+        tasks = {
+            'fx-rates': lambda workers: FXRates(
+                paths['price'], paths['spot'], paths['ccy'], output_file,
+                workers=workers, memory_limit=args.memory_limit
+            ),
+            'rolling-stdev (sql)': lambda workers: RollingStdev(
+                file_path=paths['stdev'], output_file=output_file, lookback_days=30,
+                workers=workers, memory_limit=args.memory_limit
+            ),
+            'rolling-stdev (numpy)': lambda workers: RollingStdev(
+                file_path=paths['stdev'], output_file=output_file, lookback_days=30, engine='numpy',
+                workers=workers, memory_limit=args.memory_limit
+            ),
+        }
+
+        results = []
+        for task, make in tasks.items():
+            baseline = None
+            for workers in range(1, args.max_workers + 1):
+                elapsed = time_run(make(workers))
+                baseline = baseline or elapsed
+                results.append((task, workers, elapsed, baseline / elapsed))
+
+    print(f"\n{'task':<24}{'workers':>8}{'seconds':>10}{'speedup':>9}")
+    for task, workers, elapsed, speedup in results:
+        print(f"{task:<24}{workers:>8}{elapsed:>10.3f}{speedup:>9.2f}")
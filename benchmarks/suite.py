@@ -0,0 +1,280 @@
+"""
+Benchmark suite for both calculators on synthetic inputs (see synthetic.py).
+
+Every size of the chosen profile is generated once, then each engine option runs `--repeat` times in a fresh
+process so peak RSS is measured per run. Wall time, peak RSS and input rows/sec go to a JSON results file;
+`--check` compares them with a stored baseline and exits with status 1 on regressions beyond `--tolerance`.
+Baselines are machine specific: record one with `--save-baseline` on the machine that runs the check.
+The startup of `cli.py` and its task commands is timed too, in fresh interpreters.
+
+Usage (from the repo root):
+    python benchmarks/suite.py --profile default --output benchmarks/results.json
+    python benchmarks/suite.py --profile default --check benchmarks/baseline.json
+    python cli.py bench --profile smoke
+"""
+import argparse
+import duckdb
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'rates_test' / 'scripts'))
+sys.path.insert(0, str(ROOT / 'stdev_test' / 'scripts'))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from rates_calculation import FXRates  # noqa: E402
+from rolling_stdev_calculation import RollingStdev  # noqa: E402
+from synthetic import write_rates_inputs, write_stdev_inputs  # noqa: E402
+
+# input sizes per task; keys are write_rates_inputs / write_stdev_inputs parameters
+PROFILES = {
+    'smoke': {
+        'fx-rates': [dict(price_rows=20000, pairs=20, hours=24, spot_ticks_per_hour=20)],
+        'rolling-stdev': [dict(securities=50, hours=400)],
+    },
+    'default': {
+        'fx-rates': [
+            dict(price_rows=100000, pairs=90, hours=48, spot_ticks_per_hour=50),
+            dict(price_rows=1000000, pairs=500, hours=48, spot_ticks_per_hour=50),
+        ],
+        'rolling-stdev': [dict(securities=200, hours=600), dict(securities=2000, hours=1000)],
+    },
+    'large': {
+        'fx-rates': [dict(price_rows=10000000, pairs=2000, hours=72, spot_ticks_per_hour=100)],
+        'rolling-stdev': [dict(securities=20000, hours=1000)],
+    },
+}
+
+# engine options run for every size
+OPTIONS = {
+    'fx-rates': [dict(engine='asof'), dict(engine='range'), dict(engine='numpy'),
+                 dict(engine='asof', chunk_interval='6 hours'), dict(engine='asof', encode_keys=False),
+                 dict(engine='asof', memory_limit='128MB', preserve_insertion_order=False)],
+    'rolling-stdev': [dict(engine='sql'), dict(engine='numpy'), dict(engine='sql', encode_keys=True),
+                      dict(engine='sql', memory_limit='128MB', preserve_insertion_order=False),
+                      dict(engine='sql', snap_tolerance='1 minute'), dict(engine='numpy', window_frame='range')],
+}
+# the reference range join grows with spot density times prices; it is skipped above this many input rows
+MAX_INPUT_ROWS = {'engine=range': 200000}
+# startup timed per command: a fresh interpreter printing a task's help imports what a run imports before its
+# first query, 'python' is the interpreter alone
+STARTUP_COMMANDS = {
+    'python': ['-c', 'pass'],
+    'cli.py': [str(ROOT / 'cli.py'), '--help'],
+    'cli.py fx-rates': [str(ROOT / 'cli.py'), 'fx-rates', '--help'],
+    'cli.py rolling-stdev': [str(ROOT / 'cli.py'), 'rolling-stdev', '--help'],
+}
+
+
+def label(settings):
+    return ','.join(f'{key}={value}' for key, value in settings.items())
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process and its finished children (ru_maxrss is bytes on macOS) """
+    unit = 1 if sys.platform == 'darwin' else 1024
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage * unit / 2**20
+
+
+def make_calculation(task, inputs, options, output_file):
+    if task == 'fx-rates':
+        return FXRates(inputs['price'], inputs['spot'], inputs['ccy'], output_file, **options)
+    first, last = inputs['snap_times']
+    return RollingStdev(
+        file_path=inputs['stdev'],
+        start_output=str(first + timedelta(days=1)),
+        end_output=str(last),
+        lookback_days=1,
+        output_file=output_file,
+        **options
+    )
+
+
+def run_case(task, inputs, options, output_file):
+    """
+    Worker process entry point: one timed run, with the calculator's and DuckDB's progress output suppressed.
+    Runs under a memory budget spill next to the output and are profiled for DuckDB's peak buffer memory and
+    spill size.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    events = []
+    if 'memory_limit' in options:
+        work_dir = os.path.dirname(output_file)
+        options = dict(options, temp_directory=os.path.join(work_dir, 'spill'),
+                       profile_dir=os.path.join(work_dir, 'profiles'), metrics_callback=events.append)
+    calculation = make_calculation(task, inputs, options, output_file)
+    start = time.perf_counter()
+    calculation.run()
+    elapsed = time.perf_counter() - start
+    output_rows = duckdb.execute(f"SELECT count(*) FROM read_csv('{output_file}', delim=';')").fetchone()[0]
+    result = {'wall_seconds': elapsed, 'peak_rss_mb': peak_rss_mb(), 'output_rows': output_rows}
+    peaks = next((event['rows'] for event in events if event['stage'] == 'run'), {})
+    if 'system_peak_buffer_memory' in peaks:
+        result['duckdb_peak_mb'] = peaks['system_peak_buffer_memory'] / 2**20
+        result['spilled_mb'] = peaks.get('system_peak_temp_dir_size', 0) / 2**20
+    return result
+
+
+def count_rows(path):
+    return duckdb.execute(f"SELECT count(*) FROM read_parquet('{path}')").fetchone()[0]
+
+
+def generate(task, size, temp_dir):
+    """ Writes the inputs of one size; returns them with the row count that rows/sec is measured against """
+    if task == 'fx-rates':
+        inputs = write_rates_inputs(temp_dir, **size)
+        return inputs, count_rows(inputs['price'])
+    path, snap_times = write_stdev_inputs(temp_dir, **size)
+    return {'stdev': path, 'snap_times': snap_times}, count_rows(path)
+
+
+def time_startup(repeat):
+    """ Fastest wall time of every startup command over `repeat` fresh processes """
+    startup = []
+    for command, args in STARTUP_COMMANDS.items():
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *args], check=True, stdout=subprocess.DEVNULL)
+            runs.append(time.perf_counter() - start)
+        startup.append({'command': command, 'wall_seconds': round(min(runs), 4)})
+        print(f"{'startup':<15}{command:<98}{min(runs):>9.3f}s")
+    return startup
+
+
+def run_suite(profile, repeat):
+    startup = time_startup(repeat)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for task, sizes in PROFILES[profile].items():
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                inputs, input_rows = generate(task, size, temp_dir)
+                output_file = os.path.join(temp_dir, 'output.csv')
+                for options in OPTIONS[task]:
+                    if input_rows > MAX_INPUT_ROWS.get(label(options), input_rows):
+                        continue
+                    runs = []
+                    for _ in range(repeat):
+                        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                            runs.append(executor.submit(run_case, task, inputs, options, output_file).result())
+                    best = min(runs, key=lambda run: run['wall_seconds'])
+                    results.append({
+                        'task': task,
+                        'size': label(size),
+                        'options': label(options),
+                        'input_rows': input_rows,
+                        'output_rows': best['output_rows'],
+                        'wall_seconds': round(best['wall_seconds'], 4),
+                        'peak_rss_mb': round(max(run['peak_rss_mb'] for run in runs), 1),
+                        'rows_per_sec': round(input_rows / best['wall_seconds']),
+                    })
+                    spill = ''
+                    if 'duckdb_peak_mb' in best:
+                        result = results[-1]
+                        result['duckdb_peak_mb'] = round(max(run['duckdb_peak_mb'] for run in runs), 1)
+                        result['spilled_mb'] = round(max(run['spilled_mb'] for run in runs), 1)
+                        spill = f"  DuckDB {result['duckdb_peak_mb']:.1f}MB, spilled {result['spilled_mb']:.1f}MB"
+                    print(f"{task:<15}{label(size):<62}{label(options):<36}"
+                          f"{best['wall_seconds']:>9.3f}s{results[-1]['peak_rss_mb']:>9.1f}MB{spill}")
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'profile': profile,
+        'repeat': repeat,
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'duckdb': duckdb.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'startup': startup,
+        'results': results,
+    }
+
+
+def find_regressions(report, baseline, tolerance):
+    """
+    Results slower (rows/sec) or larger (peak RSS) than the matching baseline result by more than tolerance, and
+    startup commands slower than in the baseline by more than tolerance
+    """
+    expected = {(result['task'], result['size'], result['options']): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        reference = expected.get((result['task'], result['size'], result['options']))
+        if reference is None:
+            continue
+        if result['rows_per_sec'] < reference['rows_per_sec'] * (1 - tolerance):
+            regressions.append((result, 'rows_per_sec', reference['rows_per_sec']))
+        if result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + tolerance):
+            regressions.append((result, 'peak_rss_mb', reference['peak_rss_mb']))
+    startup = {entry['command']: entry for entry in baseline.get('startup', [])}
+    for entry in report['startup']:
+        reference = startup.get(entry['command'])
+        if reference is not None and entry['wall_seconds'] > reference['wall_seconds'] * (1 + tolerance):
+            regressions.append((entry, 'wall_seconds', reference['wall_seconds']))
+    return regressions
+
+
+def find_missing(report, baseline):
+    """ Results and startup commands the baseline has nothing to compare with, so a check cannot cover them """
+    expected = {(result['task'], result['size'], result['options']) for result in baseline['results']}
+    startup = {entry['command'] for entry in baseline.get('startup', [])}
+    return [result for result in report['results']
+            if (result['task'], result['size'], result['options']) not in expected] + \
+        [entry for entry in report['startup'] if entry['command'] not in startup]
+
+
+def describe(result):
+    if 'command' in result:
+        return f"startup [{result['command']}]"
+    return f"{result['task']} [{result['size']}] [{result['options']}]"
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Benchmark both calculators on synthetic inputs")
+    parser.add_argument('--profile', default='default', choices=PROFILES)
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per case; the fastest one is reported')
+    parser.add_argument('--output', default=ROOT / 'benchmarks' / 'results.json', type=Path)
+    parser.add_argument('--check', default=None, type=Path, help='Baseline results file to compare against')
+    parser.add_argument('--tolerance', default=0.25, type=float, help='Allowed relative regression')
+    parser.add_argument('--save-baseline', default=None, type=Path, help='Also write the results as a baseline')
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.profile, args.repeat)
+    args.output.write_text(json.dumps(report, indent=2) + '\n')
+    print(f"Results saved to: '{args.output}'")
+    if args.save_baseline is not None:
+        args.save_baseline.write_text(json.dumps(report, indent=2) + '\n')
+        print(f"Baseline saved to: '{args.save_baseline}'")
+
+    if args.check is not None:
+        baseline = json.loads(args.check.read_text())
+        missing = find_missing(report, baseline)
+        for result in missing:
+            print(f"WARNING {describe(result)}: not in baseline, not checked")
+        regressions = find_regressions(report, baseline, args.tolerance)
+        for result, metric, reference in regressions:
+            print(f"REGRESSION {describe(result)}: {metric} {result[metric]} vs baseline {reference}")
+        if regressions:
+            return 1
+        unchecked = f", {len(missing)} results not checked" if missing else ""
+        print(f"No regressions beyond {args.tolerance:.0%} against '{args.check}'{unchecked}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Synthetic inputs with the schemas of the bundled data files, generated at any scale.
+
+Values come from DuckDB's hash() of the row number and a per-column salt, so the same parameters always produce
+the same files regardless of thread count.
+
+Usage (from the repo root):
+    python benchmarks/synthetic.py rates <output-dir> --price-rows 1000000 --pairs 500
+    python benchmarks/synthetic.py stdev <output-dir> --securities 2000 --hours 1000
+"""
+import argparse
+import duckdb
+import os
+
+START = '2021-12-01 00:00:00'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def uniform(salt, column='i'):
+    """ SQL expression for a deterministic uniform [0, 1) value per row """
+    return f"(hash({column}, '{salt}') % 1000000007) / 1000000007.0"
+
+
+def write_rates_inputs(output_dir, price_rows=100000, pairs=90, hours=48, spot_ticks_per_hour=50,
+                       gap_rate=0.05, convert_rate=0.7):
+    """
+    Writes price, spot and ccy files like rates_price_data.parq, rates_spot_rate_data.parq and rates_ccy_data.csv.
+
+    Spots tick `spot_ticks_per_hour` times per pair and hour over `hours` hours; a `gap_rate` share of the
+    (pair, hour) buckets has no spots at all, so their prices fall outside the 1-hour window. Prices are spread
+    over the same period, timestamps are stored as strings as in the bundled files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        'price': os.path.join(output_dir, 'rates_price_data.parq'),
+        'spot': os.path.join(output_dir, 'rates_spot_rate_data.parq'),
+        'ccy': os.path.join(output_dir, 'rates_ccy_data.csv'),
+    }
+    pair = "'P' || lpad(CAST({} AS VARCHAR), 5, '0')"
+    con = duckdb.connect()
+    con.execute(f"""
+        COPY (
+            SELECT
+                {pair.format('i')} AS ccy_pair,
+                {uniform('convert', 'i')} < {convert_rate} AS convert_price,
+                CASE WHEN {uniform('convert', 'i')} < {convert_rate}
+                     THEN [10, 100, 1000][1 + CAST(hash(i, 'factor') % 3 AS INTEGER)] END AS conversion_factor
+            FROM range({pairs}) t(i)
+        ) TO '{paths['ccy']}' (HEADER)
+    """)
+    con.execute(f"""
+        COPY (
+            WITH ticks AS (
+                SELECT i, i % {pairs} AS p, i // {pairs} % {hours} AS h
+                FROM range({pairs * hours * spot_ticks_per_hour}) t(i)
+            )
+            SELECT
+                strftime(TIMESTAMP '{START}' + to_microseconds(CAST((h + {uniform('spot_time')}) * 3600e6 AS BIGINT)),
+                         '{TIMESTAMP_FORMAT}') AS timestamp,
+                {pair.format('p')} AS ccy_pair,
+                round(1 + p % 100 + {uniform('spot_rate')}, 5) AS spot_mid_rate
+            FROM ticks
+            WHERE {uniform('spot_gap', 'p * 1000003 + h')} >= {gap_rate}
+        ) TO '{paths['spot']}' (FORMAT parquet)
+    """)
+    con.execute(f"""
+        COPY (
+            SELECT
+                i AS index,
+                strftime(TIMESTAMP '{START}' + to_microseconds(CAST({uniform('price_time')} * {hours} * 3600e6 AS BIGINT)),
+                         '{TIMESTAMP_FORMAT}') AS timestamp,
+                'id_' || CAST(i % 1000 AS VARCHAR) AS security_id,
+                round(1000 + 100000 * {uniform('price')}, 0) AS price,
+                {pair.format(f"hash(i, 'pair') % {pairs}")} AS ccy_pair
+            FROM range({price_rows}) t(i)
+        ) TO '{paths['price']}' (FORMAT parquet)
+    """)
+    con.close()
+    return paths
+
+
+def write_stdev_inputs(output_dir, securities=200, hours=600, gap_rate=0.01, null_rate=0.005):
+    """
+    Writes an hourly price file like stdev_price_data.parq: one bid/mid/ask row per security and hour, with a
+    `gap_rate` share of the hours missing (breaking contiguity) and a `null_rate` share of NULL prices.
+    Returns the path and the (first, last) snap_time.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, 'stdev_price_data.parq')
+    con = duckdb.connect()
+    con.execute(f"""
+        COPY (
+            WITH rows AS (
+                SELECT i, i // {hours} AS s, i % {hours} AS h, {uniform('mid')} AS u
+                FROM range({securities * hours}) t(i)
+            )
+            SELECT
+                i AS index,
+                CAST(TIMESTAMP '{START}' + to_hours(h) AS TIMESTAMP_NS) AS snap_time,
+                'id_' || CAST(s AS VARCHAR) AS security_id,
+                CASE WHEN {uniform('null_bid')} >= {null_rate} THEN round(mid - spread, 3) END AS bid,
+                CASE WHEN {uniform('null_mid')} >= {null_rate} THEN round(mid, 3) END AS mid,
+                CASE WHEN {uniform('null_ask')} >= {null_rate} THEN round(mid + spread, 3) END AS ask
+            FROM (
+                SELECT *, 10 * sin(h / 24.0 + s) + 2 * u AS mid, 0.1 + {uniform('spread')} AS spread FROM rows
+            )
+            WHERE {uniform('gap')} >= {gap_rate}
+        ) TO '{path}' (FORMAT parquet)
+    """)
+    first, last = con.execute(f"SELECT min(snap_time), max(snap_time) FROM read_parquet('{path}')").fetchone()
+    con.close()
+    return path, (first, last)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic inputs for the benchmark suite")
+    subparsers = parser.add_subparsers(dest='task', required=True)
+
+    rates = subparsers.add_parser('rates')
+    rates.add_argument('output_dir')
+    rates.add_argument('--price-rows', default=100000, type=int)
+    rates.add_argument('--pairs', default=90, type=int)
+    rates.add_argument('--hours', default=48, type=int)
+    rates.add_argument('--spot-ticks-per-hour', default=50, type=int)
+    rates.add_argument('--gap-rate', default=0.05, type=float)
+
+    stdev = subparsers.add_parser('stdev')
+    stdev.add_argument('output_dir')
+    stdev.add_argument('--securities', default=200, type=int)
+    stdev.add_argument('--hours', default=600, type=int)
+    stdev.add_argument('--gap-rate', default=0.01, type=float)
+    stdev.add_argument('--null-rate', default=0.005, type=float)
+
+    args = parser.parse_args()
+    if args.task == 'rates':
+        print(write_rates_inputs(args.output_dir, args.price_rows, args.pairs, args.hours,
+                                 args.spot_ticks_per_hour, args.gap_rate))
+    else:
+        print(write_stdev_inputs(args.output_dir, args.securities, args.hours, args.gap_rate, args.null_rate))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Single entry point for both calculators and the benchmark suite.
+
+    python cli.py fx-rates [options of rates_test/scripts/main.py]
+    python cli.py rolling-stdev [options of stdev_test/scripts/main.py]
+    python cli.py bench [options of benchmarks/suite.py]
+    python cli.py jobs jobs.txt
+
+Starting it imports only this file: a command's modules, and with them DuckDB, Arrow and NumPy, are imported when
+the command runs. `jobs` runs the `fx-rates` and `rolling-stdev` commands of a job file, one per line, in this
+process on one DuckDB connection, so the imports and the connection are paid for once instead of per run. The
+connection is reset between jobs, and every job is parsed before the first one runs.
+"""
+import argparse
+import importlib.util
+import shlex
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+# command: (script defining its build_parser/run or main, module name, description). Both task scripts are
+# main.py, so they get names of their own; the suite keeps its name, which its worker processes import it by.
+COMMANDS = {
+    'fx-rates': ('rates_test/scripts/main.py', 'fx_rates_main', 'Convert prices with the latest spot rate (Task 1)'),
+    'rolling-stdev': ('stdev_test/scripts/main.py', 'rolling_stdev_main',
+                      'Rolling standard deviation and statistics (Task 2)'),
+    'bench': ('benchmarks/suite.py', 'suite', 'Benchmark both calculators and the startup of this CLI'),
+}
+JOB_COMMANDS = ('fx-rates', 'rolling-stdev')
+
+
+def load(command):
+    """
+    Imports the script of `command` by path under its module name. Its directory goes on sys.path for the modules
+    next to it; the task scripts add shared/ for the modules both tasks use.
+    """
+    script, name, _ = COMMANDS[command]
+    if name not in sys.modules:
+        path = ROOT / script
+        if str(path.parent) not in sys.path:
+            sys.path.insert(0, str(path.parent))
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+def read_jobs(path):
+    """ (command, args) of every line of a job file; blank lines and `#` comments are skipped """
+    jobs = []
+    with open(path) as job_file:
+        for number, line in enumerate(job_file, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            if words[0] not in JOB_COMMANDS:
+                raise ValueError(f"{path}:{number}: unknown job command '{words[0]}', expected one of {JOB_COMMANDS}")
+            jobs.append((words[0], words[1:]))
+    return jobs
+
+
+def run_jobs(path):
+    """ Runs the jobs of a job file in order on one connection; stops at the first failing job, returning 1 """
+    jobs = read_jobs(path)
+    parsed = [
+        (command, load(command).build_parser(f"{Path(path).name}:{command}").parse_args(args))
+        for command, args in jobs
+    ]
+    import duckdb
+    from resources import reset
+    con = duckdb.connect()
+    try:
+        for number, (command, args) in enumerate(parsed, 1):
+            start = time.perf_counter()
+            try:
+                load(command).calculate(args, connection=con)
+                reset(con)
+            except Exception as e:
+                print(f"Job {number}/{len(parsed)} ({command}) failed after {time.perf_counter() - start:.3f} "
+                      f"seconds: {type(e).__name__}: {e}")
+                return 1
+            print(f"Job {number}/{len(parsed)} ({command}) finished in {time.perf_counter() - start:.3f} seconds")
+    finally:
+        con.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='cli.py',
+        description='FX rate conversion and rolling statistics',
+        epilog='\n'.join(f"  {command:<15}{description}" for command, (_, _, description) in COMMANDS.items())
+        + "\n  jobs           Run the fx-rates and rolling-stdev lines of a job file in one process",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('command', choices=[*COMMANDS, 'jobs'])
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="The command's options, see <command> --help")
+    args = parser.parse_args(argv)
+    if args.command == 'jobs':
+        if len(args.args) != 1 or args.args[0].startswith('-'):
+            parser.error("jobs takes the path of one job file")
+        try:
+            return run_jobs(args.args[0])
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return 1
+    return load(args.command).main(args.args, prog=f"cli.py {args.command}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
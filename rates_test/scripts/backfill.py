@@ -0,0 +1,188 @@
+"""
+Backfill: converted prices for many periods on one connection. Each period's rows match a separate FXRates run
+with that period's start and end, but prices, spots and the ccy table are read once for the whole span.
+
+Usage:
+    python backfill.py --start 2021-12-10 --end '2021-12-10 23:59:59' --step '6 hours' \
+        --output-file '../results/backfill/rates_{start:%Y%m%d_%H%M}.csv'
+    python backfill.py --ranges '2021-12-10 06:00/2021-12-10 09:00,2021-12-10 12:00/2021-12-10 15:00' \
+        --output-file ../results/backfill --partition-by date
+"""
+import argparse
+import duckdb
+import os
+import sys
+import time
+from pathlib import Path
+
+# output sinks and backfill periods, like the other modules both tasks use, live in shared/
+SHARED_DIR = str(Path(__file__).resolve().parents[2] / 'shared')
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+from numpy_engine import to_micros  # noqa: E402
+from output_sinks import DEFAULT_ROW_GROUP_SIZE, OUTPUT_FORMATS  # noqa: E402
+from periods import date_ranges, parse_ranges, parse_timestamp  # noqa: E402
+from rates_calculation import FXRates  # noqa: E402
+
+
+class Backfill:
+    """
+    Runs FXRates for every period on a shared connection.
+
+    The inputs are loaded once for the span from the first start to the last end, with the spot file bounded by
+    the loaded prices as in a normal run. Each period then converts only its own prices against the shared spots.
+    `output_file` is either a template with `{start}`, `{end}` or `{index}` fields, giving one file per period,
+    or a single file or partitioned dataset that receives every period in order.
+    """
+    def __init__(self, ranges, output_file, **settings):
+        if not ranges:
+            raise ValueError("No ranges to backfill")
+        if settings.get('chunk_interval') is not None or settings.get('workers', 1) > 1:
+            raise ValueError("Backfill runs its periods on one connection and cannot use streaming or workers")
+        if settings.get('cache_file') is not None or settings.get('fingerprint_file') is not None:
+            raise ValueError("Backfill loads its inputs once and cannot use an input cache or change detection")
+        self.ranges = [(parse_timestamp(start), parse_timestamp(end)) for start, end in ranges]
+        if any(later[0] <= earlier[1] for earlier, later in zip(self.ranges, self.ranges[1:])):
+            raise ValueError("Backfill ranges must be sorted and must not overlap")
+        self.output_file = str(output_file)
+        self.per_range = any(f'{{{field}' in self.output_file for field in ('start', 'end', 'index'))
+        self.fx = FXRates(
+            output_file=self.output_file, start=self.ranges[0][0], end=self.ranges[-1][1], **settings
+        )
+        self.all_prices = None
+
+    def range_file(self, index, start, end):
+        return self.output_file.format(index=index, start=start, end=end)
+
+    def load_data(self):
+        """ Loads the whole span; the SQL engines keep its prices as backfill_price, `price` becomes a period view """
+        self.fx.load_data()
+        if self.fx.engine == 'numpy':
+            self.all_prices = self.fx.prices
+        else:
+            self.fx.con.execute("ALTER TABLE price RENAME TO backfill_price")
+
+    def load_range(self, start, end):
+        if self.fx.engine == 'numpy':
+            times = self.all_prices[1]
+            keep = (times >= to_micros([start])[0]) & (times <= to_micros([end])[0])
+            ccy_pairs, _, prices = self.all_prices
+            self.fx.prices = (ccy_pairs.filter(keep), times[keep], prices.filter(keep))
+        else:
+            self.fx.con.execute(f"""
+                CREATE OR REPLACE VIEW price AS
+                SELECT * FROM backfill_price
+                WHERE timestamp BETWEEN TIMESTAMP '{start}' AND TIMESTAMP '{end}'
+            """)
+
+    def run(self):
+        start_time = time.time()
+        fx = self.fx
+        print(f"Backfilling {len(self.ranges)} periods ({fx.engine} engine)...")
+        shared_sink = None
+        if not self.per_range:
+            shared_sink = fx.output_sink()
+        try:
+            with fx.instrumentation.stage('backfill', periods=len(self.ranges), engine=fx.engine):
+                self.load_data()
+                for index, (start, end) in enumerate(self.ranges):
+                    self.load_range(start, end)
+                    sink = shared_sink
+                    if sink is None:
+                        fx.output_file = self.range_file(index, start, end)
+                        os.makedirs(os.path.dirname(os.path.abspath(fx.output_file)), exist_ok=True)
+                        sink = fx.output_sink()
+                    fx.calculate_rates(sink, range=index)
+                    if shared_sink is None:
+                        sink.close()
+                        print(f"Saved {start} - {end} to: '{fx.output_file}'")
+            if shared_sink is not None:
+                shared_sink.close()
+                print(f"Saved to: '{self.output_file}'")
+            print(f"Execution time: {time.time() - start_time:.3f} seconds")
+        finally:
+            if fx._con is not None:
+                fx.con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate rates for many periods in one run")
+
+    script_dir = Path(__file__).parent
+    data_dir = script_dir.parent / "data"
+    result_dir = script_dir.parent / "results"
+
+    parser.add_argument('--price-file', default=data_dir / 'rates_price_data.parq', type=Path)
+    parser.add_argument('--spot-file', default=data_dir / 'rates_spot_rate_data.parq', type=Path)
+    parser.add_argument('--ccy-file', default=data_dir / 'rates_ccy_data.csv', type=Path)
+    parser.add_argument('--output-file', default=str(result_dir / 'backfill' / 'rates_{start:%Y%m%d_%H%M}.csv'),
+                        help="Output template with {start}, {end} or {index} fields for one file per period, "
+                             "or a single output file or dataset")
+    parser.add_argument('--ranges', default=None, type=parse_ranges,
+                        help="Comma-separated 'start/end' periods, e.g. '2021-12-10 06:00/2021-12-10 09:00,...'")
+    parser.add_argument('--start', default=None, help="First period start (default: the earliest price)")
+    parser.add_argument('--end', default=None, help="Last period end (default: the latest price)")
+    parser.add_argument('--step', default='1 day', help="Period length for --start/--end, e.g. '1 day' or '6 hours'")
+    parser.add_argument('--engine', default='asof', choices=FXRates.ENGINES)
+    parser.add_argument('--memory-limit', default=None, help="DuckDB memory budget, e.g. '1GB'")
+    parser.add_argument('--threads', default=None, type=int, help='DuckDB threads')
+    parser.add_argument('--temp-directory', default=None, type=Path,
+                        help='Spill to this directory when the memory budget is exceeded')
+    parser.add_argument('--max-temp-directory-size', default=None, help="Cap on spilled data, e.g. '20GB'")
+    parser.add_argument('--no-preserve-insertion-order', dest='preserve_insertion_order', action='store_false',
+                        help='Let DuckDB reorder rows internally to use less memory; the output order is unchanged')
+    parser.add_argument('--pairs', default=None, type=lambda value: value.split(','),
+                        help="Only convert these comma-separated ccy_pairs")
+    parser.add_argument('--output-format', default=None, choices=OUTPUT_FORMATS)
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--row-group-size', default=DEFAULT_ROW_GROUP_SIZE, type=int)
+    parser.add_argument('--partition-by', default=None, type=lambda value: value.split(','),
+                        help="Write one Parquet dataset partitioned by these columns, e.g. 'date'")
+    parser.add_argument('--no-encode-keys', dest='encode_keys', action='store_false', default=None,
+                        help='Join and sort on ccy_pair strings instead of ENUM codes, as --engine numpy and --cache-file do')
+    parser.add_argument('--dictionary-keys', action='store_true',
+                        help='Write ccy_pair as a dictionary-encoded column to Parquet and Arrow outputs')
+    parser.add_argument('--metrics-file', default=None, type=Path,
+                        help='Append per-stage timings and row counts to this file as JSON lines')
+
+    args = parser.parse_args()
+
+    try:
+        ranges = args.ranges
+        if ranges is None:
+            start, end = args.start, args.end
+            if start is None or end is None:
+                first, last = duckdb.execute(f"""
+                    SELECT date_trunc('day', MIN(CAST(timestamp AS TIMESTAMP))), MAX(CAST(timestamp AS TIMESTAMP))
+                    FROM read_parquet('{args.price_file}')
+                """).fetchone()
+                start, end = start or first, end or last
+            ranges = date_ranges(start, end, args.step)
+        Backfill(
+            ranges,
+            args.output_file,
+            price_file=args.price_file,
+            spot_file=args.spot_file,
+            ccy_file=args.ccy_file,
+            engine=args.engine,
+            memory_limit=args.memory_limit,
+            threads=args.threads,
+            temp_directory=args.temp_directory,
+            max_temp_directory_size=args.max_temp_directory_size,
+            preserve_insertion_order=args.preserve_insertion_order,
+            pairs=args.pairs,
+            output_format=args.output_format,
+            compression=args.compression,
+            row_group_size=args.row_group_size,
+            partition_by=args.partition_by,
+            encode_keys=args.encode_keys,
+            dictionary_keys=args.dictionary_keys,
+            metrics_file=args.metrics_file
+        ).run()
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        exit(1)
+    except (ValueError, duckdb.Error) as e:
+        print(f"Error: Invalid parameter - {e}")
+        exit(1)
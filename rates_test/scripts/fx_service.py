@@ -0,0 +1,143 @@
+"""
+Resident FX conversion service: keeps the ccy table and a per-ccy_pair spot index in memory and converts price
+batches over HTTP (or a Unix socket) in milliseconds, with the same results as FXRates.calculate_rates.
+
+Usage:
+    python fx_service.py --port 8080
+    python fx_service.py --unix-socket /tmp/fx.sock
+
+Endpoints (JSON bodies):
+    POST /convert  {"prices": [{"ccy_pair": "EURUSD", "timestamp": "2021-12-10 07:38:07.198474", "price": 1.2}]}
+    POST /spots    {"spots": [{"ccy_pair": "EURUSD", "timestamp": "...", "spot_mid_rate": 1.13}]}
+    GET  /health
+"""
+import argparse
+import json
+import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from numpy_engine import SpotIndex, convert_prices, read_ccy, to_micros
+from pathlib import Path
+
+
+class FXConversionService:
+    """ Loads the ccy table and spot file once, then converts price batches against the in-memory spot index """
+    def __init__(self, spot_file, ccy_file):
+        self.ccy = read_ccy(ccy_file)
+        self.index = SpotIndex()
+        spots = pq.read_table(spot_file, columns=['ccy_pair', 'timestamp', 'spot_mid_rate'])
+        self.index.add(
+            spots['ccy_pair'],
+            to_micros(spots['timestamp']),
+            spots['spot_mid_rate'].cast(pa.float64()).fill_null(np.nan).to_numpy(),
+        )
+
+    def add_spots(self, ccy_pairs, timestamps, spot_mid_rates):
+        return self.index.add(ccy_pairs, to_micros(timestamps), np.array(spot_mid_rates, dtype=np.float64))
+
+    def convert(self, ccy_pairs, timestamps, prices):
+        """
+        Same rows as FXRates.calculate_rates for this price batch: the first price per (ccy_pair, timestamp),
+        ordered by ccy_pair and timestamp, returned as an Arrow table with the output columns
+        """
+        table, _ = convert_prices(
+            self.ccy, self.index, ccy_pairs, to_micros(timestamps), pa.array(prices, type=pa.float64())
+        )
+        return table
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.reply(404, {'error': f"Unknown path '{self.path}'"})
+        self.reply(200, {'status': 'ok', 'spots': len(self.service.index)})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/convert':
+                prices = body['prices']
+                start = time.perf_counter()
+                table = self.service.convert(
+                    [row.get('ccy_pair') for row in prices],
+                    [row.get('timestamp') for row in prices],
+                    [row.get('price') for row in prices],
+                )
+                rows = table.to_pylist()
+                for row in rows:
+                    row['timestamp'] = row['timestamp'] and str(row['timestamp'])
+                self.reply(200, {'rows': rows, 'elapsed_ms': round((time.perf_counter() - start) * 1000, 3)})
+            elif self.path == '/spots':
+                spots = body['spots']
+                added = self.service.add_spots(
+                    [row.get('ccy_pair') for row in spots],
+                    [row.get('timestamp') for row in spots],
+                    [row.get('spot_mid_rate') for row in spots],
+                )
+                self.reply(200, {'added': added})
+            else:
+                self.reply(404, {'error': f"Unknown path '{self.path}'"})
+        except (KeyError, TypeError, ValueError) as e:
+            self.reply(400, {'error': f"Invalid request: {e}"})
+
+    def reply(self, status, payload):
+        body = json.dumps(payload, allow_nan=False, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if self.client_address else 'unix-socket'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host='127.0.0.1', port=8080, unix_socket=None):
+    """ HTTP server bound to host:port, or to a Unix socket path when given """
+    handler = type('BoundConversionHandler', (ConversionHandler,), {'service': service})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(str(unix_socket), handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve FX price conversions from an in-memory spot index")
+
+    script_dir = Path(__file__).parent
+    data_dir = script_dir.parent / "data"
+
+    parser.add_argument('--spot-file', default=data_dir / 'rates_spot_rate_data.parq', type=Path)
+    parser.add_argument('--ccy-file', default=data_dir / 'rates_ccy_data.csv', type=Path)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--unix-socket', default=None, type=Path, help='Listen on this Unix socket instead of TCP')
+
+    args = parser.parse_args()
+
+    start_time = time.time()
+    service = FXConversionService(args.spot_file, args.ccy_file)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print(f"Loaded {len(service.index)} spots in {time.time() - start_time:.3f} seconds")
+    print(f"Serving on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nService stopped")
+    finally:
+        server.server_close()
@@ -1,9 +1,18 @@
-from rates_calculation import FXRates
-from pathlib import Path
 import argparse
+import sys
+from pathlib import Path
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Calculate rates from price and spot data")
+# option defaults, like the other modules both tasks use, live in shared/
+SHARED_DIR = str(Path(__file__).resolve().parents[2] / 'shared')
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+from defaults import DEFAULT_CACHE_LIMIT, DEFAULT_ROW_GROUP_SIZE, OUTPUT_FORMATS  # noqa: E402
+from rates_options import ENGINES  # noqa: E402
+
+
+def build_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Calculate rates from price and spot data")
     
     # default paths
     script_dir = Path(__file__).parent
@@ -14,28 +23,106 @@ if __name__ == "__main__":
     parser.add_argument('--spot-file', default=data_dir / 'rates_spot_rate_data.parq', type=Path)
     parser.add_argument('--ccy-file', default=data_dir / 'rates_ccy_data.csv', type=Path)
     parser.add_argument('--output-file', default=result_dir / 'rates_final_prices.csv', type=Path)
+    parser.add_argument('--engine', default='asof', choices=ENGINES)
+    parser.add_argument('--chunk-interval', default=None,
+                        help="Streaming mode: process prices in time chunks of this interval, e.g. '1 hour'")
+    parser.add_argument('--memory-limit', default=None, help="DuckDB memory budget (per worker), e.g. '1GB'")
+    parser.add_argument('--threads', default=None, type=int, help='DuckDB threads (per worker)')
+    parser.add_argument('--temp-directory', default=None, type=Path,
+                        help='Spill to this directory when the memory budget is exceeded')
+    parser.add_argument('--max-temp-directory-size', default=None, help="Cap on spilled data, e.g. '20GB'")
+    parser.add_argument('--no-preserve-insertion-order', dest='preserve_insertion_order', action='store_false',
+                        help='Let DuckDB reorder rows internally to use less memory; the output order is unchanged')
+    parser.add_argument('--workers', default=1, type=int, help='Worker processes, each computing a ccy_pair range')
+    parser.add_argument('--output-format', default=None, choices=OUTPUT_FORMATS,
+                        help='Output format, inferred from the output file extension by default')
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--row-group-size', default=DEFAULT_ROW_GROUP_SIZE, type=int)
+    parser.add_argument('--partition-by', default=None, type=lambda value: value.split(','),
+                        help="Write a Parquet dataset partitioned by these columns, e.g. 'ccy_pair' or 'date'")
+    parser.add_argument('--start', default=None, help="Only convert prices at or after this timestamp")
+    parser.add_argument('--end', default=None, help="Only convert prices at or before this timestamp")
+    parser.add_argument('--pairs', default=None, type=lambda value: value.split(','),
+                        help="Only convert these comma-separated ccy_pairs")
+    parser.add_argument('--no-pushdown', dest='pushdown', action='store_false',
+                        help="Read the whole spot file instead of bounding it by the prices' time range and pairs")
+    parser.add_argument('--cache-file', default=None, type=Path,
+                        help='Keep the loaded input tables in this DuckDB file and reuse them while inputs are unchanged')
+    parser.add_argument('--cache-limit', default=DEFAULT_CACHE_LIMIT,
+                        help="Evict least recently used cache entries beyond this size, e.g. '2GB'")
+    parser.add_argument('--fingerprint-file', default=None, type=Path,
+                        help='Keep input fingerprints in this file and recompute only the hours changed since the last run')
+    parser.add_argument('--no-encode-keys', dest='encode_keys', action='store_false', default=None,
+                        help='Join and sort on ccy_pair strings instead of ENUM codes, as --engine numpy and --cache-file do')
+    parser.add_argument('--dictionary-keys', action='store_true',
+                        help='Write ccy_pair as a dictionary-encoded column to Parquet and Arrow outputs')
+    parser.add_argument('--metrics-file', default=None, type=Path,
+                        help='Append per-stage timings and row counts to this file as JSON lines')
+    parser.add_argument('--profile-dir', default=None, type=Path,
+                        help="Save DuckDB's JSON query profile of every stage to this directory")
     
-    args = parser.parse_args()
-    
+    return parser
+
+
+def calculate(args, connection=None):
+    """ Runs the conversion of parsed `args`, on `connection` if given; errors are raised """
+    # imported here, so that building the parser (--help, job files) does not import DuckDB, Arrow or NumPy
+    from rates_calculation import FXRates
+    calculation = FXRates(
+        price_file=args.price_file,
+        spot_file=args.spot_file,
+        ccy_file=args.ccy_file,
+        output_file=args.output_file,
+        engine=args.engine,
+        chunk_interval=args.chunk_interval,
+        memory_limit=args.memory_limit,
+        threads=args.threads,
+        temp_directory=args.temp_directory,
+        max_temp_directory_size=args.max_temp_directory_size,
+        preserve_insertion_order=args.preserve_insertion_order,
+        workers=args.workers,
+        output_format=args.output_format,
+        compression=args.compression,
+        row_group_size=args.row_group_size,
+        partition_by=args.partition_by,
+        encode_keys=args.encode_keys,
+        dictionary_keys=args.dictionary_keys,
+        metrics_file=args.metrics_file,
+        profile_dir=args.profile_dir,
+        start=args.start,
+        end=args.end,
+        pairs=args.pairs,
+        pushdown=args.pushdown,
+        cache_file=args.cache_file,
+        cache_limit=args.cache_limit,
+        fingerprint_file=args.fingerprint_file,
+        connection=connection
+    )
+    calculation.run()
+
+
+def run(args, connection=None):
+    """ Runs the conversion of parsed `args`, on `connection` if given; returns the exit status """
     try:
-        calculation = FXRates(
-            price_file=args.price_file,
-            spot_file=args.spot_file,
-            ccy_file=args.ccy_file,
-            output_file=args.output_file
-        )
-        
-        calculation.run()
-        
+        calculate(args, connection)
     except FileNotFoundError as e:
         print(f"Error: File not found - {e}")
-        exit(1)
+        return 1
     except ValueError as e:
         print(f"Error: Invalid parameter - {e}")
-        exit(1)
+        return 1
     except KeyboardInterrupt:
         print("\nOperation cancelled by user")
-        exit(1)
+        return 1
     except Exception as e:
         print(f"Unexpected error: {e}")
-        exit(1)
\ No newline at end of file
+        return 1
+    return 0
+
+
+def main(argv=None, prog=None):
+    return run(build_parser(prog).parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
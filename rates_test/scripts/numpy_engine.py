@@ -0,0 +1,186 @@
+"""
+Pure NumPy/PyArrow FX conversion: the rules of FXRates.rates_query without a DuckDB connection or SQL, for
+embedding in latency-sensitive services. Used by FXRates(engine='numpy') and the conversion service.
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import threading
+
+SPOT_WINDOW = 3600 * 10**6  # 1 hour in microseconds
+NAT = np.iinfo(np.int64).min  # NaT as int64, marks missing timestamps
+
+
+def to_micros(timestamps):
+    """ Timestamps (strings, datetimes or an Arrow timestamp column) as int64 microseconds, NAT for missing """
+    if not isinstance(timestamps, (pa.Array, pa.ChunkedArray)):
+        timestamps = pa.array(timestamps)
+    if pa.types.is_null(timestamps.type):
+        timestamps = timestamps.cast(pa.string())
+    return timestamps.cast(pa.timestamp('us')).cast(pa.int64()).fill_null(NAT).to_numpy()
+
+
+def round_half_away(values, decimals=2):
+    """ DuckDB's ROUND on DOUBLE: std::round of the scaled value, keeping the input where that overflows """
+    scale = 10.0 ** decimals
+    scaled = values * scale
+    whole = np.trunc(scaled)
+    with np.errstate(invalid='ignore'):
+        # adding 0 would turn -0.0 into 0.0, std::round keeps the sign
+        rounded = np.where(np.abs(scaled - whole) >= 0.5, whole + np.sign(scaled), whole) / scale
+    return np.where(np.isfinite(rounded), rounded, values)
+
+
+def group_codes(values):
+    """ Dense int codes of a string column, -1 for NULL; equal strings share a code """
+    encoded = pa.array(values, type=pa.string()) if not isinstance(values, (pa.Array, pa.ChunkedArray)) else values
+    encoded = encoded.cast(pa.string())
+    if isinstance(encoded, pa.ChunkedArray):
+        encoded = encoded.combine_chunks()
+    encoded = encoded.dictionary_encode()
+    return encoded.indices.fill_null(-1).to_numpy(), encoded.dictionary
+
+
+def lookup_by_pair(ccy_pairs, times, match):
+    """
+    Spot rates for prices of many ccy_pairs: `match(pair, times)` answers the int64 times of one pair with an array
+    of rates (NaN for none) or None when it has no spots. Prices without a ccy_pair get NaN.
+    """
+    codes, dictionary = group_codes(ccy_pairs)
+    times = np.asarray(times, dtype=np.int64)
+    result = np.full(len(times), np.nan)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    for rows in np.split(order, bounds):
+        if not len(rows) or codes[rows[0]] < 0:
+            continue
+        rates = match(dictionary[codes[rows[0]]].as_py(), times[rows])
+        if rates is not None:
+            result[rows] = rates
+    return result
+
+
+class SpotIndex:
+    """ Time-sorted spot_mid_rate arrays per ccy_pair, answering "latest spot at or before t within 1 hour" """
+    def __init__(self):
+        self.spots = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(times) for times, _ in self.spots.values())
+
+    def add(self, ccy_pairs, times, rates):
+        """ Adds ticks in any order; ticks without a ccy_pair or timestamp can never match and are dropped """
+        codes, dictionary = group_codes(ccy_pairs)
+        times = np.asarray(times, dtype=np.int64)
+        rates = np.asarray(rates, dtype=np.float64)
+        known = (codes >= 0) & (times != NAT)
+        codes, times, rates = codes[known], times[known], rates[known]
+        order = np.lexsort((times, codes))
+        codes, times, rates = codes[order], times[order], rates[order]
+        starts = np.flatnonzero(np.append(True, codes[1:] != codes[:-1])) if len(codes) else np.array([], dtype=int)
+        with self.lock:
+            for start, end in zip(starts, np.append(starts[1:], len(codes))):
+                pair = dictionary[codes[start]].as_py()
+                new_times, new_rates = times[start:end], rates[start:end]
+                if pair in self.spots:
+                    old_times, old_rates = self.spots[pair]
+                    if len(old_times) and new_times[0] < old_times[-1]:
+                        # late ticks: merge, keeping arrival order among equal timestamps
+                        merged_times = np.concatenate([old_times, new_times])
+                        order = np.argsort(merged_times, kind='stable')
+                        new_times, new_rates = merged_times[order], np.concatenate([old_rates, new_rates])[order]
+                    else:
+                        new_times = np.concatenate([old_times, new_times])
+                        new_rates = np.concatenate([old_rates, new_rates])
+                self.spots[pair] = (new_times, new_rates)
+        return len(times)
+
+    def lookup(self, ccy_pairs, times):
+        """ spot_mid_rate of the latest tick at or before each time and less than 1 hour older, NaN if none """
+        with self.lock:
+            spots = dict(self.spots)
+
+        def match(pair, pair_times):
+            if pair not in spots:
+                return None
+            spot_times, spot_rates = spots[pair]
+            # NAT is the smallest int64, so prices without a timestamp find no spot
+            latest = np.searchsorted(spot_times, pair_times, side='right') - 1
+            found = latest >= 0
+            found[found] &= spot_times[latest[found]] > pair_times[found] - SPOT_WINDOW
+            return np.where(found, spot_rates[np.maximum(latest, 0)], np.nan) if len(spot_rates) else None
+
+        return lookup_by_pair(ccy_pairs, times, match)
+
+
+def read_ccy(ccy_file):
+    """ The ccy table with the types DuckDB's read_csv_auto infers for it """
+    ccy = pv.read_csv(ccy_file)
+    return pa.table({
+        'ccy_pair': ccy['ccy_pair'].cast(pa.string()),
+        'convert_price': ccy['convert_price'].cast(pa.bool_()),
+        'conversion_factor': ccy['conversion_factor'],
+    })
+
+
+def convert_prices(ccy, index, ccy_pairs, times, prices):
+    """
+    Rows of FXRates.calculate_rates for a price batch in file order: the first price per (ccy_pair, timestamp),
+    ordered by ccy_pair and timestamp with NULLs last, converted with the ccy rules and the spots of `index`.
+
+    `ccy_pairs` is a string array, `times` int64 microseconds (NAT for missing) and `prices` an Arrow array.
+    Returns (Arrow table with the output columns, the matched spot_mid_rate per row with NaN for none).
+    """
+    ccy_pairs = pa.array(ccy_pairs, type=pa.string()) if not isinstance(ccy_pairs, (pa.Array, pa.ChunkedArray)) \
+        else ccy_pairs.cast(pa.string())
+    prices = prices if isinstance(prices, (pa.Array, pa.ChunkedArray)) else pa.array(prices, type=pa.float64())
+    times = np.asarray(times, dtype=np.int64)
+
+    keys = pa.table({
+        'ccy_pair': ccy_pairs,
+        'timestamp': pa.array(times, mask=times == NAT),
+        'price_id': np.arange(len(times)),
+    })
+    order = pc.sort_indices(keys, sort_keys=[('ccy_pair', 'ascending'), ('timestamp', 'ascending'),
+                                             ('price_id', 'ascending')], null_placement='at_end').to_numpy()
+    codes = group_codes(ccy_pairs)[0][order]
+    sorted_times = times[order]
+    first = np.append(len(order) > 0, (codes[1:] != codes[:-1]) | (sorted_times[1:] != sorted_times[:-1]))[:len(order)]
+    rows = order[first]
+
+    pairs = ccy_pairs.take(rows)
+    times = times[rows]
+    price = prices.take(rows)
+    spot = index.lookup(pairs, times)
+
+    # LEFT JOIN ccy: a ccy_pair listed more than once uses its first row
+    match = pc.index_in(pairs, value_set=ccy['ccy_pair'])
+    convert = ccy['convert_price'].take(match).fill_null(False).to_numpy(zero_copy_only=False)
+    factor = ccy['conversion_factor'].take(match).cast(pa.float64()).fill_null(np.nan).to_numpy(zero_copy_only=False)
+    price_values = price.cast(pa.float64()).fill_null(np.nan).to_numpy(zero_copy_only=False)
+    price_null = price.is_null().to_numpy(zero_copy_only=False)
+
+    has_factor = ~np.isnan(factor)
+    conversion_applied = convert & has_factor & ~np.isnan(spot)
+    insufficient_data = convert & ~conversion_applied
+    new_price = np.where(convert, np.nan, price_values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_price[conversion_applied] = round_half_away(
+            price_values[conversion_applied] / factor[conversion_applied] + spot[conversion_applied]
+        )
+    error_message = np.where(
+        insufficient_data & ~has_factor, 'No conversion factor',
+        np.where(insufficient_data, 'No spot rate in window', '')
+    )
+    table = pa.table({
+        'ccy_pair': pairs,
+        'timestamp': pa.array(times, mask=times == NAT).cast(pa.timestamp('us')),
+        'price': price,
+        'new_price': pa.array(new_price, mask=price_null | insufficient_data),
+        'conversion_applied': conversion_applied,
+        'insufficient_data': insufficient_data,
+        'error_message': error_message,
+    })
+    return table, spot
@@ -1,60 +1,672 @@
 import duckdb
+import hashlib
+import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import sys
+import tempfile
 import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# output sinks, resources, input cache, instrumentation, change detection, sharding and periods are shared with the other task
+SHARED_DIR = str(Path(__file__).resolve().parents[2] / 'shared')
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+from change_detection import ChangeDetector  # noqa: E402
+from input_cache import DEFAULT_CACHE_LIMIT, InputCache  # noqa: E402
+from instrumentation import Instrumentation  # noqa: E402
+from numpy_engine import NAT, SpotIndex, convert_prices, read_ccy, to_micros  # noqa: E402
+from output_sinks import COMPUTE_OUTPUTS, DEFAULT_ROW_GROUP_SIZE, OutputSink, chained_reader, collect, fetch_reader  # noqa: E402
+from periods import parse_timestamp  # noqa: E402
+from rates_options import ENGINES  # noqa: E402
+from resources import configure, describe_peaks, peak_rss_mb, stored_order  # noqa: E402
+from sharding import key_ranges  # noqa: E402
+
+
+def sql_string(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def pruned_row_groups(path, ranges):
+    """
+    Row groups of a parquet file whose min/max statistics rule out every (low, high) range of some column,
+    i.e. the row groups a reader with those filters can skip. Returns (total, skipped, total_bytes, skipped_bytes).
+    """
+    metadata = pq.ParquetFile(path).metadata
+    columns = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+    total = skipped = total_bytes = skipped_bytes = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        size = sum(row_group.column(c).total_compressed_size for c in range(row_group.num_columns))
+        total, total_bytes = total + 1, total_bytes + size
+        for column, column_ranges in ranges.items():
+            stats = row_group.column(columns[column]).statistics if column in columns else None
+            if stats is None or not stats.has_min_max:
+                continue
+            if not any(low <= stats.max and stats.min <= high for low, high in column_ranges):
+                skipped, skipped_bytes = skipped + 1, skipped_bytes + size
+                break
+    return total, skipped, total_bytes, skipped_bytes
+
+
+def price_extent(ccy_pairs, times):
+    """ MIN/MAX timestamp (None without any) and sorted distinct ccy_pairs of the prices that have a ccy_pair """
+    known = ccy_pairs.is_valid().to_numpy(zero_copy_only=False)
+    known_times = times[known & (times != NAT)]
+    if not len(known_times):
+        return None, None, sorted(pc.unique(ccy_pairs.filter(known)).to_pylist())
+    first, last = np.array([known_times.min(), known_times.max()]).astype('datetime64[us]').tolist()
+    return first, last, sorted(pc.unique(ccy_pairs.filter(known)).to_pylist())
+
+
+def _run_shard(settings, key_range, output_file, run_id, shard):
+    """ Worker process entry point: computes the rows of one ccy_pair range on its own connection """
+    fx = FXRates(output_file=output_file, output_format='parquet', **settings)
+    fx.key_range = key_range
+    fx.instrumentation.run_id = run_id
+    fx.instrumentation.fields = {'shard': shard}
+    fx.load_data()
+    fx.calculate_rates()
 
 
 class FXRates:
     """Computes adjusted FX rates using conversion rules and most recent spot mid rates within a 1-hour window"""
-    def __init__(self, price_file, spot_file, ccy_file, output_file):
+    # 'range' is the reference engine (range join + ROW_NUMBER), 'asof' matches spots with a sort-merge ASOF join,
+    # 'numpy' runs the same rules on NumPy/PyArrow arrays without DuckDB (see numpy_engine.py)
+    ENGINES = ENGINES
+
+    def __init__(self, price_file, spot_file, ccy_file, output_file=None, engine='asof',
+                 chunk_interval=None, memory_limit=None, workers=1, threads=None,
+                 temp_directory=None, max_temp_directory_size=None, preserve_insertion_order=True,
+                 output_format=None, compression='zstd', row_group_size=DEFAULT_ROW_GROUP_SIZE, partition_by=None,
+                 metrics_file=None, metrics_callback=None, profile_dir=None,
+                 start=None, end=None, pairs=None, pushdown=True,
+                 cache_file=None, cache_limit=DEFAULT_CACHE_LIMIT, encode_keys=None, dictionary_keys=False,
+                 fingerprint_file=None, connection=None):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {self.ENGINES}")
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        if workers > 1 and chunk_interval is not None:
+            raise ValueError("Streaming (chunk_interval) and parallel (workers) modes cannot be combined")
+        if engine == 'numpy' and chunk_interval is not None:
+            raise ValueError("Streaming mode (chunk_interval) requires a SQL engine")
+        if encode_keys and (engine == 'numpy' or cache_file is not None):
+            raise ValueError("Key encoding (encode_keys) needs a SQL engine and no cache")
+        if dictionary_keys and (encode_keys is False or engine == 'numpy' or cache_file is not None):
+            raise ValueError("dictionary_keys writes the encoded keys, it needs encode_keys, a SQL engine and no cache")
+        if fingerprint_file is not None and (engine == 'numpy' or chunk_interval is not None or workers > 1
+                                             or partition_by or dictionary_keys):
+            raise ValueError("Change detection (fingerprint_file) merges into a single output file on one connection, "
+                             "it needs a SQL engine without chunk_interval, workers, partition_by or dictionary_keys")
         self.price_file = price_file
         self.spot_file = spot_file
         self.ccy_file = ccy_file
         self.output_file = output_file
-        self.con = duckdb.connect()
+        self.engine = engine
+        # Output sink settings: format (inferred from the extension by default), Parquet options and partitioning
+        self.output_format = output_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.partition_by = partition_by
+        # Streaming mode: prices are processed in time chunks of this DuckDB interval (e.g. '1 hour')
+        self.chunk_interval = chunk_interval
+        # Parallel mode: ccy_pair ranges are computed in worker processes, each with its own connection
+        self.workers = workers
+        # DuckDB resources (per worker): memory budget, threads and where, and how much, to spill beyond it
+        self.memory_limit = memory_limit
+        self.threads = threads
+        self.temp_directory = temp_directory
+        self.max_temp_directory_size = max_temp_directory_size
+        # every SQL result is written with an ORDER BY, so DuckDB may drop insertion order to save memory
+        self.preserve_insertion_order = preserve_insertion_order
+        # (first, last) ccy_pair of the shard this instance loads; None loads every pair
+        self.key_range = None
+        # Optional run bounds on price timestamps and ccy_pairs; spots are read for [start - 1 hour, end]
+        self.start = parse_timestamp(start)
+        self.end = parse_timestamp(end)
+        self.pairs = sorted(pairs) if pairs is not None else None
+        # Derive the spot bounds from the loaded prices, so parquet statistics can skip unrelated row groups
+        self.pushdown = pushdown
+        self.pushdown_stats = None
+        # Persistent cache of the loaded price, spot and ccy tables, reused while the input files are unchanged
+        self.cache = InputCache(cache_file, cache_limit) if cache_file is not None else None
+        # Key encoding: ccy_pair is loaded as the ENUM ccy_key of the sorted price and ccy pairs, so joins, windows
+        # and sorts compare integer codes. The cache keeps string keys. Output decodes to VARCHAR, unless
+        # dictionary_keys keeps the codes (a dictionary column in Parquet and Arrow output). None, the default,
+        # encodes wherever it applies: not with the numpy engine, which has its own codes, nor with a cache
+        self.encode_keys = (engine != 'numpy' and cache_file is None) if encode_keys is None else encode_keys
+        self.dictionary_keys = dictionary_keys
+        # Change detection: input fingerprints per (ccy_pair, hour) of the previous run; only the partitions whose
+        # prices or spots changed since then are recomputed and merged into the existing output
+        self.fingerprint_file = fingerprint_file
+        # Per-stage timings and row counts as JSON lines and/or callback events, DuckDB profiles in profile_dir
+        self.metrics_file = metrics_file
+        self.profile_dir = profile_dir
+        self.instrumentation = Instrumentation('FXRates', metrics_file, metrics_callback, profile_dir)
+        # DuckDB connection, opened on first use; a given `connection` (e.g. shared by the jobs of a job file) is
+        # used instead and left open
+        self._con = None
+        self.connection = connection
+        # numpy engine inputs: deduplicated in convert_prices, spots indexed per ccy_pair
+        self.prices = None
+        self.spot_index = None
+        self.ccy = None
+
+    @property
+    def con(self):
+        """ DuckDB connection, opened on first use so the numpy engine can compute without one """
+        if self._con is None:
+            self._con = duckdb.connect() if self.connection is None else self.connection
+            configure(self._con, self.memory_limit, self.threads, self.temp_directory, self.max_temp_directory_size,
+                      self.preserve_insertion_order)
+            if self.engine == 'range':
+                # DuckDB 1.3.0 can drop matching spots when it pushes the range join's lower time bound into the
+                # spot scan as a join filter (seen on small bounded runs), so the reference engine goes without it
+                self._con.execute("SET disabled_optimizers = 'join_filter_pushdown'")
+        return self._con
+
+    def output_sink(self):
+        return OutputSink(
+            self.output_file,
+            output_format=self.output_format,
+            compression=self.compression,
+            row_group_size=self.row_group_size,
+            partition_by=self.partition_by,
+            time_column='timestamp',
+        )
+
+    def key_filter(self):
+        """ SQL predicate restricting ccy_pair to this instance's shard; NULL pairs belong to the last shard """
+        if self.key_range is None:
+            return "TRUE"
+        first, last, with_nulls = self.key_range
+        first, last = first.replace("'", "''"), last.replace("'", "''")
+        in_range = f"(ccy_pair >= '{first}' AND ccy_pair <= '{last}')"
+        return f"({in_range} OR ccy_pair IS NULL)" if with_nulls else in_range
+
+    def has_string_timestamps(self, file):
+        timestamp_type = pq.read_schema(file).field('timestamp').type
+        return pa.types.is_string(timestamp_type) or pa.types.is_large_string(timestamp_type)
+
+    def bounds_filter(self, file, start=None, end=None, pairs=None):
+        """
+        SQL predicate on a file's raw ccy_pair and timestamp columns, written so DuckDB can push it into the
+        parquet scan. String timestamps are first bounded by their date prefix, which any ISO format sorts within.
+        """
+        conditions = []
+        if pairs is not None:
+            conditions.append(f"ccy_pair IN ({', '.join(map(sql_string, pairs))})" if pairs else "FALSE")
+        if start is not None or end is not None:
+            if self.has_string_timestamps(file):
+                if start is not None:
+                    conditions.append(f"timestamp >= '{start:%Y-%m-%d}'")
+                if end is not None:
+                    conditions.append(f"timestamp < '{end + timedelta(days=1):%Y-%m-%d}'")
+            if start is not None:
+                conditions.append(f"CAST(timestamp AS TIMESTAMP) >= TIMESTAMP '{start}'")
+            if end is not None:
+                conditions.append(f"CAST(timestamp AS TIMESTAMP) <= TIMESTAMP '{end}'")
+        return ' AND '.join(conditions) or "TRUE"
+
+    def spot_bounds(self, prices=None):
+        """
+        (start, end, pairs) of the spots that can match: from the run bounds or, with pushdown, from the min/max
+        timestamp and distinct ccy_pairs of `prices` (a relation with a TIMESTAMP column, or the numpy engine's
+        (ccy_pairs, times, prices) arrays)
+        """
+        start, end, pairs = self.start, self.end, self.pairs
+        if self.pushdown and prices is not None:
+            if isinstance(prices, str):
+                first, last, price_pairs = self.con.execute(f"""
+                    SELECT MIN(timestamp), MAX(timestamp), LIST(DISTINCT ccy_pair ORDER BY ccy_pair)
+                    FROM {prices}
+                    WHERE ccy_pair IS NOT NULL
+                """).fetchone()
+            else:
+                first, last, price_pairs = price_extent(*prices[:2])
+            if first is None:
+                # no price can match a spot
+                return None, None, []
+            start, end, pairs = first, last, price_pairs
+        return start and start - timedelta(hours=1), end, pairs
+
+    def record_pushdown(self, start, end, pairs):
+        """ Row groups and bytes of the spot file that the pushed-down bounds let the parquet reader skip """
+        self.pushdown_stats = None
+        if start is None and end is None and pairs is None:
+            return
+        ranges = {}
+        if pairs is not None:
+            ranges['ccy_pair'] = [(pair, pair) for pair in pairs]
+        if start is not None or end is not None:
+            if self.has_string_timestamps(self.spot_file):
+                low = f'{start:%Y-%m-%d}' if start is not None else ''
+                high = f'{end + timedelta(days=1):%Y-%m-%d}' if end is not None else '\uffff'
+            else:
+                low, high = start or datetime.min, end or datetime.max
+            ranges['timestamp'] = [(low, high)]
+        total, skipped, total_bytes, skipped_bytes = pruned_row_groups(self.spot_file, ranges)
+        self.pushdown_stats = {
+            'spot_row_groups': total,
+            'spot_row_groups_skipped': skipped,
+            'spot_bytes': total_bytes,
+            'spot_bytes_skipped': skipped_bytes,
+        }
 
     def load_data(self):
+        if self.engine == 'numpy':
+            with self.instrumentation.stage('load_data') as stage:
+                self.load_arrays()
+                stage.record(**self.pushdown_stats or {}, price_rows=len(self.prices[1]), spot_rows=len(self.spot_index),
+                             ccy_rows=self.ccy.num_rows)
+            return
+        with self.instrumentation.stage('load_data', self.con) as stage:
+            self.load_tables()
+            stage.record(**self.pushdown_stats or {}, **self.cache.stats() if self.cache is not None else {})
+            stage.count(self.con, self.table_counts_query())
+
+    def load_tables(self):
+        price_filter = f"{self.key_filter()} AND {self.bounds_filter(self.price_file, self.start, self.end, self.pairs)}"
+        self.create_key_type(price_filter)
+        # price_id keeps the file order, used to pick a deterministic row among prices sharing ccy_pair and timestamp
+        self.create_input_table('price', f"""
+            SELECT
+                {self.encoded_key()} AS ccy_pair,
+                CAST(timestamp AS TIMESTAMP) AS timestamp,
+                price,
+                file_row_number AS price_id
+            FROM read_parquet('{self.price_file}', file_row_number = true)
+            WHERE {price_filter}
+        """, [self.price_file], order_by='ccy_pair, timestamp, price_id')
+
+        spot_bounds = self.spot_bounds('price')
+        self.record_pushdown(*spot_bounds)
+        self.create_input_table('spot', f"""
+            SELECT
+                {self.encoded_key()} AS ccy_pair,
+                CAST(timestamp AS TIMESTAMP) AS timestamp,
+                spot_mid_rate
+            FROM read_parquet('{self.spot_file}')
+            WHERE {self.key_filter()} AND {self.bounds_filter(self.spot_file, *spot_bounds)} AND {self.known_key()}
+        """, [self.spot_file], order_by='ccy_pair, timestamp')
+
+        self.create_input_table('ccy', self.ccy_query(), [self.ccy_file])
+
+    def create_key_type(self, price_filter):
+        """
+        Key encoding: the ENUM ccy_key of the distinct ccy_pairs of the prices within `price_filter` and of the
+        ccy table, sorted so that ordering by code is ordering by ccy_pair
+        """
+        if not self.encode_keys:
+            return
         self.con.execute(f"""
-            CREATE TABLE price AS 
-            SELECT 
-                ccy_pair, 
-                CAST(timestamp AS TIMESTAMP) AS timestamp, 
-                price 
-            FROM read_parquet('{self.price_file}');
+            CREATE OR REPLACE TYPE ccy_key AS ENUM (
+                SELECT ccy_pair FROM (
+                    SELECT ccy_pair FROM read_parquet('{self.price_file}') WHERE {price_filter}
+                    UNION
+                    SELECT CAST(ccy_pair AS VARCHAR) FROM read_csv_auto('{self.ccy_file}')
+                )
+                WHERE ccy_pair IS NOT NULL
+                ORDER BY ccy_pair
+            )
         """)
 
+    def key_type(self):
+        return 'ccy_key' if self.encode_keys else 'VARCHAR'
+
+    def encoded_key(self):
+        """ ccy_pair of a file as loaded: its ccy_key code when keys are encoded """
+        return "CAST(ccy_pair AS ccy_key)" if self.encode_keys else "ccy_pair"
+
+    def known_key(self):
+        """ Keeps only spots whose ccy_pair has a code; the others can match no price """
+        return "TRY_CAST(ccy_pair AS ccy_key) IS NOT NULL" if self.encode_keys else "TRUE"
+
+    def ccy_query(self):
+        return f"SELECT * REPLACE ({self.encoded_key()} AS ccy_pair) FROM read_csv_auto('{self.ccy_file}')" \
+            if self.encode_keys else f"SELECT * FROM read_csv_auto('{self.ccy_file}')"
+
+    def create_input_table(self, name, query, sources, order_by=None):
+        """ Creates an input table from `query`, or a view on its cached copy when a cache file is configured """
+        if self.cache is not None and self.cache.attach(self.con):
+            self.cache.table(self.con, name, query, sources, order_by)
+        else:
+            self.con.execute(f"CREATE TABLE {name} AS {query}")
+
+    def arrow_filter(self, file, start=None, end=None, pairs=None):
+        """
+        bounds_filter and key_filter as a PyArrow expression, which lets the parquet reader skip row groups by
+        their statistics. Exact time bounds need parsed timestamps and are applied by read_arrays.
+        """
+        condition = pc.scalar(True)
+        if self.key_range is not None:
+            first, last, with_nulls = self.key_range
+            in_range = (pc.field('ccy_pair') >= first) & (pc.field('ccy_pair') <= last)
+            condition &= (in_range | pc.field('ccy_pair').is_null()) if with_nulls else in_range
+        if pairs is not None:
+            condition &= pc.field('ccy_pair').isin(pa.array(pairs, type=pa.string()))
+        if self.has_string_timestamps(file):
+            if start is not None:
+                condition &= pc.field('timestamp') >= f'{start:%Y-%m-%d}'
+            if end is not None:
+                condition &= pc.field('timestamp') < f'{end + timedelta(days=1):%Y-%m-%d}'
+        return condition
+
+    def read_arrays(self, file, columns, start=None, end=None, pairs=None):
+        """ (ccy_pairs, times in microseconds, *columns) of a file's rows within the bounds, in file order """
+        table = pq.read_table(file, columns=['ccy_pair', 'timestamp', *columns],
+                              filters=self.arrow_filter(file, start, end, pairs))
+        times = to_micros(table['timestamp'])
+        if start is not None or end is not None:
+            keep = times != NAT
+            if start is not None:
+                keep &= times >= to_micros([start])[0]
+            if end is not None:
+                keep &= times <= to_micros([end])[0]
+            table, times = table.filter(keep), times[keep]
+        return (table['ccy_pair'], times, *(table[column] for column in columns))
+
+    def load_arrays(self):
+        """ numpy engine counterpart of load_tables, reading the files with PyArrow """
+        self.prices = self.read_arrays(self.price_file, ['price'], self.start, self.end, self.pairs)
+        spot_bounds = self.spot_bounds(self.prices)
+        self.record_pushdown(*spot_bounds)
+        spot_pairs, spot_times, spot_rates = self.read_arrays(self.spot_file, ['spot_mid_rate'], *spot_bounds)
+        self.spot_index = SpotIndex()
+        self.spot_index.add(spot_pairs, spot_times, spot_rates.cast(pa.float64()).fill_null(np.nan).to_numpy())
+        self.ccy = read_ccy(self.ccy_file)
+
+    def table_counts_query(self):
+        return """
+            SELECT
+                (SELECT COUNT(*) FROM price) AS price_rows,
+                (SELECT COUNT(*) FROM spot) AS spot_rows,
+                (SELECT COUNT(*) FROM ccy) AS ccy_rows
+        """
+
+    def partition_inputs(self, temp_dir):
+        """
+        Splits prices and spots into time-chunk partitions on disk in one streaming pass each. A spot is copied
+        to every chunk whose prices can see it within 1 hour, so chunks can be computed independently.
+        """
+        chunk = f"INTERVAL '{self.chunk_interval}'"
+        price_filter = self.bounds_filter(self.price_file, self.start, self.end, self.pairs)
+        self.create_key_type(price_filter)
+        spot_bounds = self.spot_bounds(f"""(
+            SELECT ccy_pair, CAST(timestamp AS TIMESTAMP) AS timestamp
+            FROM read_parquet('{self.price_file}')
+            WHERE {price_filter}
+        )""")
+        self.record_pushdown(*spot_bounds)
         self.con.execute(f"""
-            CREATE TABLE spot AS 
-            SELECT 
-                ccy_pair, 
-                CAST(timestamp AS TIMESTAMP) AS timestamp, 
-                spot_mid_rate 
-            FROM read_parquet('{self.spot_file}');
+            COPY (
+                SELECT
+                    ccy_pair,
+                    CAST(timestamp AS TIMESTAMP) AS timestamp,
+                    price,
+                    file_row_number AS price_id,
+                    epoch_us(time_bucket({chunk}, CAST(timestamp AS TIMESTAMP))) AS chunk
+                FROM read_parquet('{self.price_file}', file_row_number = true)
+                WHERE {price_filter}
+            ) TO '{os.path.join(temp_dir, 'price')}' (FORMAT parquet, PARTITION_BY (chunk))
         """)
+        self.con.execute(f"""
+            COPY (
+                SELECT
+                    ccy_pair,
+                    timestamp,
+                    spot_mid_rate,
+                    epoch_us(UNNEST(RANGE(
+                        time_bucket({chunk}, timestamp),
+                        time_bucket({chunk}, timestamp + INTERVAL '1 hour') + {chunk},
+                        {chunk}
+                    ))) AS chunk
+                FROM (
+                    SELECT ccy_pair, CAST(timestamp AS TIMESTAMP) AS timestamp, spot_mid_rate
+                    FROM read_parquet('{self.spot_file}')
+                    WHERE timestamp IS NOT NULL AND {self.bounds_filter(self.spot_file, *spot_bounds)}
+                )
+            ) TO '{os.path.join(temp_dir, 'spot')}' (FORMAT parquet, PARTITION_BY (chunk))
+        """)
+
+        chunks = [name.split('=', 1)[1] for name in os.listdir(os.path.join(temp_dir, 'price'))]
+        # prices without a timestamp land in the NULL partition, which sorts last like in the batch query
+        return sorted((c for c in chunks if c != 'NULL'), key=int) + [c for c in chunks if c == 'NULL']
 
+    def load_chunk(self, temp_dir, chunk):
+        price_dir = os.path.join(temp_dir, 'price', f'chunk={chunk}')
+        spot_dir = os.path.join(temp_dir, 'spot', f'chunk={chunk}')
         self.con.execute(f"""
-            CREATE TABLE ccy AS 
-            SELECT * FROM read_csv_auto('{self.ccy_file}');
+            CREATE OR REPLACE TABLE price AS
+            SELECT {self.encoded_key()} AS ccy_pair, timestamp, price, price_id FROM read_parquet('{price_dir}/*.parquet');
         """)
+        if os.path.isdir(spot_dir):
+            self.con.execute(f"""
+                CREATE OR REPLACE TABLE spot AS
+                SELECT {self.encoded_key()} AS ccy_pair, timestamp, spot_mid_rate FROM read_parquet('{spot_dir}/*.parquet')
+                WHERE {self.known_key()};
+            """)
+        else:
+            self.con.execute(f"""
+                CREATE OR REPLACE TABLE spot (ccy_pair {self.key_type()}, timestamp TIMESTAMP, spot_mid_rate DOUBLE);
+            """)
 
-    def calculate_rates(self):
-        query = """
-        WITH matched_spot AS (
-            SELECT 
+    def stream_chunks(self, temp_dir):
+        """ Partitions the inputs into `temp_dir`, then loads each time chunk in turn and yields it once loaded """
+        with self.instrumentation.stage('partition_inputs', self.con) as stage:
+            chunks = self.partition_inputs(temp_dir)
+            stage.record(chunks=len(chunks), **self.pushdown_stats or {})
+        self.con.execute(f"CREATE TABLE ccy AS {self.ccy_query()}")
+        if not chunks:
+            # no prices at all: still write an empty result like the batch query does
+            self.con.execute(f"""
+                CREATE TABLE price (ccy_pair {self.key_type()}, timestamp TIMESTAMP, price DOUBLE, price_id BIGINT);
+                CREATE TABLE spot (ccy_pair {self.key_type()}, timestamp TIMESTAMP, spot_mid_rate DOUBLE);
+            """)
+
+        for chunk in chunks or [None]:
+            if chunk is not None:
+                with self.instrumentation.stage('load_chunk', self.con, chunk=chunk) as stage:
+                    self.load_chunk(temp_dir, chunk)
+                    stage.count(self.con, self.table_counts_query())
+            yield chunk
+
+    def calculate_rates_streaming(self):
+        """ Computes one time chunk at a time and appends each chunk's rows to the output file """
+        sink = self.output_sink()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for chunk in self.stream_chunks(temp_dir):
+                self.calculate_rates(sink, chunk=chunk)
+        sink.close()
+
+    def run_shards(self, temp_dir):
+        """
+        Splits the sorted ccy_pairs into contiguous ranges of similar price counts and computes each range in a
+        worker process, writing its shard to `temp_dir`. Returns the queries reading the shards back in key order,
+        which together give the same rows as the single query, or None when there are no ccy_pairs to split.
+        """
+        with self.instrumentation.stage('plan_shards', self.con) as stage:
+            key_counts = self.con.execute(f"""
+                SELECT ccy_pair, COUNT(*)
+                FROM read_parquet('{self.price_file}')
+                WHERE ccy_pair IS NOT NULL AND {self.bounds_filter(self.price_file, self.start, self.end, self.pairs)}
+                GROUP BY ccy_pair
+                ORDER BY ccy_pair
+            """).fetchall()
+            ranges = key_ranges(key_counts, self.workers)
+            stage.record(keys=len(key_counts), shards=len(ranges))
+        if not ranges:
+            return None
+
+        settings = {
+            'price_file': self.price_file,
+            'spot_file': self.spot_file,
+            'ccy_file': self.ccy_file,
+            'engine': self.engine,
+            'memory_limit': self.memory_limit,
+            'threads': self.threads or max(1, (os.cpu_count() or 1) // len(ranges)),
+            'max_temp_directory_size': self.max_temp_directory_size,
+            'preserve_insertion_order': self.preserve_insertion_order,
+            'metrics_file': self.metrics_file,
+            'profile_dir': self.profile_dir,
+            'start': self.start,
+            'end': self.end,
+            'pairs': self.pairs,
+            'pushdown': self.pushdown,
+            'encode_keys': self.encode_keys,
+        }
+        shard_files = [os.path.join(temp_dir, f'shard_{i}.parquet') for i in range(len(ranges))]
+        # each worker spills to its own directory, DuckDB's temp file names are only unique within a process
+        spill_dirs = [os.path.join(self.temp_directory or temp_dir, f'spill_{i}') for i in range(len(ranges))]
+        # imported here, like every import only some runs need, to keep the startup of other runs short
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn, not fork: the parent already holds a DuckDB connection and its threads
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+            futures = [
+                pool.submit(_run_shard, dict(settings, temp_directory=spill_dirs[i]),
+                            (first, last, i == len(ranges) - 1), shard_file, self.instrumentation.run_id, i)
+                for i, ((first, last), shard_file) in enumerate(zip(ranges, shard_files))
+            ]
+            for future in futures:
+                future.result()
+
+        # shards hold decoded keys; with dictionary_keys they are encoded again with one ENUM for all shards
+        columns = "*"
+        if self.dictionary_keys:
+            self.create_key_type(self.bounds_filter(self.price_file, self.start, self.end, self.pairs))
+            columns = f"* REPLACE ({self.encoded_key()} AS ccy_pair)"
+        return [f"SELECT {columns} FROM read_parquet('{shard_file}')" for shard_file in shard_files]
+
+    def calculate_rates_parallel(self):
+        """ Computes the shards of run_shards in worker processes and writes them out in key order """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_queries = self.run_shards(temp_dir)
+            if shard_queries is None:
+                self.load_data()
+                self.calculate_rates()
+                return
+            with self.instrumentation.stage('merge_shards', self.con) as stage:
+                sink = self.output_sink()
+                with stored_order(self.con, self.preserve_insertion_order):
+                    for query in shard_queries:
+                        sink.write(self.con, query)
+                sink.close()
+                stage.record(output_rows=sink.rows)
+
+    def change_detector(self):
+        with open(self.ccy_file, 'rb') as ccy:
+            ccy_digest = hashlib.sha256(ccy.read()).hexdigest()
+        # a changed ccy table or different bounds reach every partition, so they are part of the settings
+        return ChangeDetector(self.fingerprint_file, {
+            'start': self.start,
+            'end': self.end,
+            'pairs': self.pairs,
+            'ccy': ccy_digest,
+            'output_file': os.path.abspath(self.output_file),
+            'output_format': self.output_sink().output_format,
+        })
+
+    def calculate_rates_changes(self):
+        """
+        Change detection: compares the loaded prices and spots with the fingerprints of the previous run and
+        recomputes only the (ccy_pair, hour) partitions with changed prices, or with changed spots in that hour or
+        the hour before, merging them into the existing output. Without a previous run everything is computed.
+        """
+        detector = self.change_detector()
+        self.load_data()
+        with self.instrumentation.stage('detect_changes', self.con) as stage:
+            detector.add('price', 'price', 'ccy_pair', 'timestamp', ['timestamp', 'price'], order='price_id')
+            detector.add('spot', 'spot', 'ccy_pair', 'timestamp', ['timestamp', 'spot_mid_rate'])
+            # a spot is matched by prices up to 1 hour later
+            merge = detector.detect(self.con, {'price': 0, 'spot': 1}, os.path.exists(self.output_file))
+            stage.record(**detector.stats)
+        if not merge:
+            self.calculate_rates()
+        elif detector.stats['changed_partitions']:
+            with self.instrumentation.stage('merge_output', self.con) as stage:
+                detector.restrict(self.con, 'price', 'ccy_pair', 'timestamp')
+                detector.restrict(self.con, 'spot', 'ccy_pair', 'timestamp', hours_before=1)
+                # write next to the target and swap in, the previous output is read while merging
+                tmp_file = f"{self.output_file}.tmp"
+                sink = OutputSink(tmp_file, self.output_sink().output_format, self.compression, self.row_group_size)
+                detector.merge(self.con, sink, self.output_file, self.rates_query(), 'ccy_pair', 'timestamp',
+                               'ccy_pair, timestamp', self.preserve_insertion_order)
+                sink.close()
+                os.replace(tmp_file, self.output_file)
+                stage.record(**detector.stats)
+        detector.save(self.con)
+        print(detector.describe())
+
+    def range_match_query(self):
+        """ Reference engine: joins every spot in the trailing hour, then keeps the latest one per price """
+        return """
+            SELECT
+                ccy_pair,
+                timestamp,
+                price,
+                spot_mid_rate
+            FROM (
+                SELECT
+                    p.ccy_pair,
+                    p.timestamp,
+                    p.price,
+                    s.spot_mid_rate,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY p.ccy_pair, p.timestamp
+                        ORDER BY s.timestamp DESC, p.price_id
+                    ) AS rn
+                FROM price p
+                LEFT JOIN spot s
+                  ON p.ccy_pair = s.ccy_pair
+                 AND s.timestamp <= p.timestamp
+                 AND s.timestamp > p.timestamp - INTERVAL '1 hour'
+            )
+            WHERE rn = 1 OR rn IS NULL
+        """
+
+    def asof_match_query(self):
+        """ Takes the latest spot at or before each price via ASOF join, then applies the 1-hour tolerance """
+        return """
+            SELECT
                 p.ccy_pair,
                 p.timestamp,
                 p.price,
-                s.spot_mid_rate,
-                ROW_NUMBER() OVER (
-                    PARTITION BY p.ccy_pair, p.timestamp 
-                    ORDER BY s.timestamp DESC
-                ) AS rn
-            FROM price p
-            LEFT JOIN spot s 
-              ON p.ccy_pair = s.ccy_pair 
-             AND s.timestamp <= p.timestamp 
-             AND s.timestamp > p.timestamp - INTERVAL '1 hour'
+                CASE
+                    WHEN s.timestamp > p.timestamp - INTERVAL '1 hour' THEN s.spot_mid_rate
+                END AS spot_mid_rate
+            FROM (
+                SELECT * FROM price
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY ccy_pair, timestamp ORDER BY price_id) = 1
+            ) p
+            ASOF LEFT JOIN spot s
+              ON p.ccy_pair = s.ccy_pair
+             AND p.timestamp >= s.timestamp
+        """
+
+    def match_query(self):
+        return self.range_match_query() if self.engine == 'range' else self.asof_match_query()
+
+    def match_counts_query(self):
+        """ Cardinality of the matched_spot intermediate: prices left after matching and how many found a spot """
+        return f"""
+            SELECT COUNT(*) AS matched_prices, COUNT(spot_mid_rate) AS matched_spots
+            FROM ({self.match_query()})
+        """
+
+    def rates_query(self):
+        return f"""
+        WITH matched_spot AS (
+            {self.match_query()}
         ),
         final_result AS (
-            SELECT 
+            SELECT
                 m.ccy_pair,
                 m.timestamp,
                 m.price,
@@ -63,29 +675,28 @@ class FXRates:
                 m.spot_mid_rate,
                CASE
                 WHEN c.convert_price IS NOT TRUE THEN m.price
-                WHEN c.convert_price IS TRUE 
-                    AND c.conversion_factor IS NOT NULL 
+                WHEN c.convert_price IS TRUE
+                    AND c.conversion_factor IS NOT NULL
                     AND m.spot_mid_rate IS NOT NULL
                     THEN ROUND( (m.price / c.conversion_factor) + m.spot_mid_rate, 2)
                 ELSE NULL
                 END AS new_price,
                 -- Helps identify whether conversion logic was successfully applied
-                (c.convert_price IS TRUE 
-                 AND c.conversion_factor IS NOT NULL 
+                (c.convert_price IS TRUE
+                 AND c.conversion_factor IS NOT NULL
                  AND m.spot_mid_rate IS NOT NULL) AS conversion_applied,
-                (c.convert_price IS TRUE 
+                (c.convert_price IS TRUE
                  AND (c.conversion_factor IS NULL OR m.spot_mid_rate IS NULL)) AS insufficient_data,
                 c.conversion_factor
             FROM matched_spot m
             LEFT JOIN ccy c ON m.ccy_pair = c.ccy_pair
-            WHERE m.rn = 1 OR m.rn IS NULL
         )
-        SELECT 
-            ccy_pair, 
-            timestamp, 
-            price, 
-            new_price, 
-            conversion_applied, 
+        SELECT
+            {self.output_key()},
+            timestamp,
+            price,
+            new_price,
+            conversion_applied,
             insufficient_data,
             CASE
                 WHEN conversion_applied THEN ''
@@ -94,19 +705,119 @@ class FXRates:
                 ELSE ''
             END AS error_message
         FROM final_result
+        ORDER BY final_result.ccy_pair, timestamp
         """
-        self.con.execute(f"COPY ({query}) TO '{self.output_file}' (HEADER, DELIMITER ';')")
+
+    def output_key(self, column='ccy_pair'):
+        """ Output ccy_pair: decoded to VARCHAR, or its ccy_key code with dictionary_keys """
+        return f"CAST({column} AS VARCHAR) AS ccy_pair" if self.encode_keys and not self.dictionary_keys \
+            else f"{column} AS ccy_pair"
+
+    def calculate_rates(self, sink=None, **fields):
+        """ Writes the rates of the loaded tables to `sink`, or to a new sink on output_file that is closed after """
+        if self.engine == 'numpy':
+            with self.instrumentation.stage('calculate_rates', **fields) as stage:
+                result, spots = convert_prices(self.ccy, self.spot_index, *self.prices)
+                stage.record(matched_prices=result.num_rows, matched_spots=int((~np.isnan(spots)).sum()))
+                # DuckDB only writes the output, so CSV formatting matches the SQL engines
+                self.con.register('rates_result', result)
+                output = sink or self.output_sink()
+                with stored_order(self.con, self.preserve_insertion_order):
+                    stage.record(output_rows=output.write(self.con, "SELECT * FROM rates_result"))
+                if sink is None:
+                    output.close()
+            return
+        with self.instrumentation.stage('calculate_rates', self.con, **fields) as stage:
+            output = sink or self.output_sink()
+            stage.record(output_rows=output.write(self.con, self.rates_query()))
+            if sink is None:
+                output.close()
+            stage.count(self.con, self.match_counts_query())
+
+    def result_readers(self, batch_size):
+        """
+        Yields RecordBatchReaders over the pieces of the result in output order, in the mode of this instance.
+        Each piece is only computed once the reader before it has been read to the end, so a streaming run holds
+        one time chunk at a time.
+        """
+        if self.engine == 'numpy':
+            self.load_data()
+            yield convert_prices(self.ccy, self.spot_index, *self.prices)[0].to_reader(max_chunksize=batch_size)
+        elif self.chunk_interval is not None:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                for _ in self.stream_chunks(temp_dir):
+                    yield fetch_reader(self.con, self.rates_query(), batch_size)
+        elif self.workers > 1:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                shard_queries = self.run_shards(temp_dir)
+                if shard_queries is None:
+                    self.load_data()
+                    yield fetch_reader(self.con, self.rates_query(), batch_size)
+                    return
+                with stored_order(self.con, self.preserve_insertion_order):
+                    for query in shard_queries:
+                        yield fetch_reader(self.con, query, batch_size)
+        else:
+            self.load_data()
+            yield fetch_reader(self.con, self.rates_query(), batch_size)
+
+    def compute(self, batch_size=DEFAULT_ROW_GROUP_SIZE, output='batches'):
+        """
+        Computes the rates in process, in the same mode and order as run(), without writing a file.
+
+        Returns a RecordBatchReader of at most `batch_size` rows per batch, or with `output` 'pandas' or 'polars'
+        all rows as one DataFrame. The inputs and the first piece of the result are prepared up front; rows are
+        fetched from DuckDB as the reader is consumed, and the connection must not run other queries until then.
+        A connection opened by this instance is closed once the reader is read to the end or released; a given
+        `connection` is left open.
+        """
+        if output not in COMPUTE_OUTPUTS:
+            raise ValueError(f"Unknown output '{output}', expected one of {COMPUTE_OUTPUTS}")
+        return collect(chained_reader(self.closing_readers(batch_size)), output)
+
+    def closing_readers(self, batch_size):
+        """ result_readers, closing the connection this instance opened after the last of them """
+        try:
+            yield from self.result_readers(batch_size)
+        finally:
+            if self.connection is None and self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def to_arrow(self):
+        """ Computes the rates in process and returns them as an Arrow table, without writing a file """
+        return self.compute().read_all()
+
+    def to_record_batches(self, batch_size=DEFAULT_ROW_GROUP_SIZE):
+        """ Like to_arrow, but returns a RecordBatchReader; see compute() """
+        return self.compute(batch_size)
 
     def run(self):
         start_time = time.time()
-        print("Starting calculation with direct file loading...")
+        print(f"Starting calculation with direct file loading ({self.engine} engine)...")
 
+        mode = 'streaming' if self.chunk_interval is not None else 'parallel' if self.workers > 1 \
+            else 'changes' if self.fingerprint_file is not None else 'batch'
         try:
-            self.load_data()
-            self.calculate_rates()
+            with self.instrumentation.stage('run', mode=mode, engine=self.engine) as stage:
+                if mode == 'streaming':
+                    self.calculate_rates_streaming()
+                elif mode == 'parallel':
+                    self.calculate_rates_parallel()
+                elif mode == 'changes':
+                    self.calculate_rates_changes()
+                else:
+                    self.load_data()
+                    self.calculate_rates()
+                stage.record(peak_rss_mb=peak_rss_mb(), **self.instrumentation.peaks)
             elapsed = time.time() - start_time
+            if self.pushdown_stats is not None:
+                stats = self.pushdown_stats
+                print(f"Spot file: skipped {stats['spot_row_groups_skipped']} of {stats['spot_row_groups']} row groups "
+                      f"({stats['spot_bytes_skipped'] / 2**20:.1f} of {stats['spot_bytes'] / 2**20:.1f} MB)")
             print(f"Saved to: '{self.output_file}'")
             print(f"Execution time: {elapsed:.3f} seconds")
+            print(describe_peaks(peak_rss_mb(), self.instrumentation.peaks))
 
         except Exception as e:
             elapsed = time.time() - start_time
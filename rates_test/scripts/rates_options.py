@@ -0,0 +1,5 @@
+"""
+Choices of the FX rate options. This module imports nothing, so main.py builds its parser without importing
+DuckDB, Arrow or NumPy.
+"""
+ENGINES = ('range', 'asof', 'numpy')
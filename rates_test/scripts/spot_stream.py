@@ -0,0 +1,321 @@
+"""
+Live spot ticks for FX conversion: an asyncio ingestion loop keeps only the ticks of the last hour per ccy_pair in
+array-backed ring buffers and converts incoming prices against them with FXRates.calculate_rates semantics, so
+memory follows the tick rate, not the length of the stream.
+
+Usage:
+    python spot_stream.py --tail-file spots.jsonl --unix-socket /tmp/fx_stream.sock
+
+Ticks are JSON objects {"ccy_pair", "timestamp", "spot_mid_rate"}, one per line in a tailed file. On the socket
+every line is a JSON request answered with one JSON line:
+    {"spots": [{"ccy_pair": "EURUSD", "timestamp": "2021-12-10 07:38:07.198474", "spot_mid_rate": 1.13}]}
+    {"prices": [{"ccy_pair": "EURUSD", "timestamp": "2021-12-10 07:38:07.198474", "price": 1.2}]}
+"""
+import argparse
+import asyncio
+import json
+import numpy as np
+import os
+import pyarrow as pa
+import time
+from numpy_engine import NAT, SPOT_WINDOW, convert_prices, group_codes, lookup_by_pair, read_ccy, to_micros
+from pathlib import Path
+
+DEFAULT_CAPACITY = 256
+DEFAULT_BATCH_SIZE = 10000
+
+
+class SpotRing:
+    """
+    Time-sorted ticks of one ccy_pair in a circular buffer of int64 times and float64 rates. Evicting old ticks
+    only moves the head, so a steady stream reuses the same arrays; they double when a full hour no longer fits,
+    or drop the oldest ticks beyond `max_ticks`.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_ticks=None):
+        self.times = np.empty(capacity, dtype=np.int64)
+        self.rates = np.empty(capacity)
+        self.head = 0
+        self.size = 0
+        self.max_ticks = max_ticks
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.times)
+
+    def segments(self):
+        """ The ticks as one or two contiguous (times, rates) slices, oldest first """
+        end = self.head + self.size
+        if end <= self.capacity:
+            return [(self.times[self.head:end], self.rates[self.head:end])]
+        return [(self.times[self.head:], self.rates[self.head:]),
+                (self.times[:end - self.capacity], self.rates[:end - self.capacity])]
+
+    def ordered(self):
+        segments = self.segments()
+        return np.concatenate([t for t, _ in segments]), np.concatenate([r for _, r in segments])
+
+    def rewrite(self, times, rates, capacity):
+        """ Replaces the contents with sorted `times` and `rates`, keeping the newest `max_ticks` """
+        if self.max_ticks is not None and len(times) > self.max_ticks:
+            self.dropped += len(times) - self.max_ticks
+            times, rates = times[-self.max_ticks:], rates[-self.max_ticks:]
+        if capacity != self.capacity:
+            self.times, self.rates = np.empty(capacity, dtype=np.int64), np.empty(capacity)
+        self.times[:len(times)], self.rates[:len(times)] = times, rates
+        self.head, self.size = 0, len(times)
+
+    def extend(self, times, rates):
+        """ Adds ticks sorted by time; late ticks are merged, keeping arrival order among equal timestamps """
+        size = self.size + len(times)
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        if self.max_ticks is not None:
+            capacity = min(capacity, max(self.capacity, self.max_ticks))
+        late = self.size and times[0] < self.newest()
+        if late or capacity != self.capacity or size > capacity:
+            old_times, old_rates = self.ordered() if self.size else (times[:0], rates[:0])
+            merged_times = np.concatenate([old_times, times])
+            order = np.argsort(merged_times, kind='stable')
+            self.rewrite(merged_times[order], np.concatenate([old_rates, rates])[order], capacity)
+            return
+        positions = (self.head + self.size + np.arange(len(times))) % self.capacity
+        self.times[positions], self.rates[positions] = times, rates
+        self.size = size
+
+    def newest(self):
+        return self.times[(self.head + self.size - 1) % self.capacity]
+
+    def evict(self, cutoff):
+        """ Drops the ticks at or before `cutoff`; returns how many """
+        count = sum(int(np.searchsorted(times, cutoff, side='right')) for times, _ in self.segments())
+        self.head = (self.head + count) % self.capacity
+        self.size -= count
+        return count
+
+    def lookup(self, times, window=SPOT_WINDOW):
+        """ Rate of the latest tick at or before each time and less than `window` older, NaN if none """
+        # the number of ticks at or before t, counted over both slices, is the position of its match plus one
+        latest = sum(np.searchsorted(ticks, times, side='right') for ticks, _ in self.segments()) - 1
+        found = latest >= 0
+        slots = (self.head + np.maximum(latest, 0)) % self.capacity
+        found &= self.times[slots] > times - window
+        return np.where(found, self.rates[slots], np.nan)
+
+
+class SpotWindow:
+    """
+    The ticks that can still match a price: those within `window` of the newest tick seen (the event-time
+    watermark), or `max_delay` more for prices that arrive late. Answers SpotIndex lookups for convert_prices.
+    """
+    def __init__(self, window=SPOT_WINDOW, max_delay=0, capacity=DEFAULT_CAPACITY, max_ticks=None):
+        self.window = window
+        self.max_delay = max_delay
+        self.capacity = capacity
+        self.max_ticks = max_ticks
+        self.rings = {}
+        self.watermark = NAT
+        self.evicted = 0
+
+    def __len__(self):
+        return sum(len(ring) for ring in self.rings.values())
+
+    @property
+    def nbytes(self):
+        return sum(ring.times.nbytes + ring.rates.nbytes for ring in self.rings.values())
+
+    @property
+    def dropped(self):
+        return sum(ring.dropped for ring in self.rings.values())
+
+    def horizon(self):
+        """ Prices at or after this time see every tick they could match """
+        return self.watermark - self.max_delay if self.watermark != NAT else NAT
+
+    def add(self, ccy_pairs, times, rates):
+        """ Adds ticks in any order, then evicts what fell out of the window; returns how many were added """
+        codes, dictionary = group_codes(ccy_pairs)
+        times = np.asarray(times, dtype=np.int64)
+        rates = np.asarray(rates, dtype=np.float64)
+        known = (codes >= 0) & (times != NAT)
+        codes, times, rates = codes[known], times[known], rates[known]
+        order = np.lexsort((times, codes))
+        codes, times, rates = codes[order], times[order], rates[order]
+        starts = np.flatnonzero(np.append(True, codes[1:] != codes[:-1])) if len(codes) else np.array([], dtype=int)
+        for start, end in zip(starts, np.append(starts[1:], len(codes))):
+            pair = dictionary[codes[start]].as_py()
+            if pair not in self.rings:
+                self.rings[pair] = SpotRing(self.capacity, self.max_ticks)
+            self.rings[pair].extend(times[start:end], rates[start:end])
+        if len(times):
+            self.watermark = max(self.watermark, int(times.max()))
+        self.evict()
+        return len(times)
+
+    def evict(self):
+        if self.watermark == NAT:
+            return
+        cutoff = self.watermark - self.window - self.max_delay
+        for pair in list(self.rings):
+            self.evicted += self.rings[pair].evict(cutoff)
+            if not len(self.rings[pair]):
+                # a pair that stopped ticking frees its buffer
+                del self.rings[pair]
+
+    def lookup(self, ccy_pairs, times):
+        def match(pair, pair_times):
+            ring = self.rings.get(pair)
+            return ring.lookup(pair_times, self.window) if ring is not None else None
+
+        return lookup_by_pair(ccy_pairs, times, match)
+
+
+async def tail_file(path, follow=True, poll_interval=0.1, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Source yielding lists of tick dicts from a JSON lines file, like `tail -f`: lines appended later are read as
+    they arrive, and a line is only parsed once its newline has been written. Without `follow` it stops at the end.
+    """
+    with open(path) as ticks:
+        pending = ''
+        while True:
+            pending += ticks.read(1 << 20)
+            *lines, pending = pending.split('\n')
+            lines = [line for line in lines if line.strip()]
+            for start in range(0, len(lines), batch_size):
+                yield [json.loads(line) for line in lines[start:start + batch_size]]
+            if not lines:
+                if not follow:
+                    return
+                await asyncio.sleep(poll_interval)
+
+
+class SpotStream:
+    """ Ingests spot ticks from async sources into a SpotWindow and converts price batches against it """
+    def __init__(self, ccy_file, window=SPOT_WINDOW, max_delay=0, capacity=DEFAULT_CAPACITY, max_ticks=None):
+        self.ccy = read_ccy(ccy_file)
+        self.spots = SpotWindow(window, max_delay, capacity, max_ticks)
+        self.ticks = 0
+        self.late_prices = 0
+
+    def add_ticks(self, ticks):
+        """ Adds a batch of tick dicts; the whole batch is indexed before the next conversion sees it """
+        added = self.spots.add(
+            [tick.get('ccy_pair') for tick in ticks],
+            to_micros([tick.get('timestamp') for tick in ticks]),
+            np.array([tick.get('spot_mid_rate') for tick in ticks], dtype=np.float64),
+        )
+        self.ticks += added
+        return added
+
+    async def consume(self, source):
+        """ Adds every batch of an async source, e.g. tail_file(...), until it ends """
+        async for ticks in source:
+            self.add_ticks(ticks)
+
+    def convert(self, ccy_pairs, timestamps, prices):
+        """
+        Same rows as FXRates.calculate_rates for this price batch against the ticks seen so far. Prices older than
+        the window's horizon may have lost spots to eviction; they are counted in `late_prices`.
+        """
+        times = to_micros(timestamps)
+        self.late_prices += int(((times != NAT) & (times < self.spots.horizon())).sum())
+        table, _ = convert_prices(self.ccy, self.spots, ccy_pairs, times, pa.array(prices, type=pa.float64()))
+        return table
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'buffered': len(self.spots),
+            'pairs': len(self.spots.rings),
+            'buffer_bytes': self.spots.nbytes,
+            'evicted': self.spots.evicted,
+            'dropped': self.spots.dropped,
+            'late_prices': self.late_prices,
+        }
+
+    def handle(self, request):
+        """ Answers one socket request: {"spots": [...]} or {"prices": [...]} """
+        if 'spots' in request:
+            return {'added': self.add_ticks(request['spots'])}
+        prices = request['prices']
+        start = time.perf_counter()
+        rows = self.convert(
+            [row.get('ccy_pair') for row in prices],
+            [row.get('timestamp') for row in prices],
+            [row.get('price') for row in prices],
+        ).to_pylist()
+        for row in rows:
+            row['timestamp'] = row['timestamp'] and str(row['timestamp'])
+        return {'rows': rows, 'elapsed_ms': round((time.perf_counter() - start) * 1000, 3)}
+
+    async def serve_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = self.handle(json.loads(line))
+                except (KeyError, TypeError, ValueError) as e:
+                    reply = {'error': f"Invalid request: {e}"}
+                writer.write(json.dumps(reply, allow_nan=False, default=str).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, unix_socket):
+        """ Unix socket server answering one JSON line per request line """
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return await asyncio.start_unix_server(self.serve_client, path=str(unix_socket))
+
+
+async def main(args):
+    stream = SpotStream(args.ccy_file, max_delay=int(args.max_delay * 10**6), capacity=args.capacity,
+                        max_ticks=args.max_ticks)
+    tasks = []
+    if args.tail_file is not None:
+        tasks.append(asyncio.create_task(stream.consume(tail_file(args.tail_file, follow=not args.no_follow))))
+    server = None
+    if args.unix_socket is not None:
+        server = await stream.serve(args.unix_socket)
+        print(f"Serving on {args.unix_socket}")
+        tasks.append(asyncio.create_task(server.serve_forever()))
+    try:
+        while not all(task.done() for task in tasks):
+            await asyncio.sleep(args.stats_interval)
+            print(json.dumps(stream.stats()))
+        for task in tasks:
+            task.result()
+    finally:
+        if server is not None:
+            server.close()
+    print(json.dumps(stream.stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest live spot ticks and convert prices against the last hour")
+
+    script_dir = Path(__file__).parent
+    data_dir = script_dir.parent / "data"
+
+    parser.add_argument('--ccy-file', default=data_dir / 'rates_ccy_data.csv', type=Path)
+    parser.add_argument('--tail-file', default=None, type=Path, help='Read ticks appended to this JSON lines file')
+    parser.add_argument('--no-follow', action='store_true', help='Stop at the end of --tail-file instead of waiting')
+    parser.add_argument('--unix-socket', default=None, type=Path, help='Accept spot and price requests here')
+    parser.add_argument('--max-delay', default=0.0, type=float,
+                        help='Keep ticks this many seconds longer, for prices that arrive late')
+    parser.add_argument('--capacity', default=DEFAULT_CAPACITY, type=int, help='Initial ticks per ccy_pair buffer')
+    parser.add_argument('--max-ticks', default=None, type=int,
+                        help='Cap per ccy_pair buffer; the oldest ticks beyond it are dropped')
+    parser.add_argument('--stats-interval', default=10.0, type=float, help='Seconds between stats lines')
+
+    args = parser.parse_args()
+    if args.tail_file is None and args.unix_socket is None:
+        parser.error("nothing to do: give --tail-file and/or --unix-socket")
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\nStream stopped")
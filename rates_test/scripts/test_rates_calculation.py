@@ -1,10 +1,31 @@
+import asyncio
+import duckdb
+import importlib.util
+import json
+import numpy as np
 import pytest
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import tempfile
+import threading
+import urllib.request
 import os
-from datetime import datetime
+import shutil
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
 from unittest.mock import patch, MagicMock
 from rates_calculation import FXRates
+from fx_service import FXConversionService, make_server
+from backfill import Backfill, date_ranges, parse_ranges
+from numpy_engine import SpotIndex
+from resources import reset
+from sharding import key_ranges
+from spot_stream import SpotRing, SpotStream, SpotWindow, tail_file
+
+DATA_DIR = Path(__file__).parent.parent / "data"
 
 
 class TestFXRates:
@@ -19,10 +40,17 @@ class TestFXRates:
         with patch("duckdb.connect") as mock_connect:
             mock_con = MagicMock()
             mock_connect.return_value = mock_con
-            fx = FXRates("p.parquet", "s.parquet", "c.csv", "o.csv")
+            # without pushdown no bounds are derived from the prices before reading spots
+            fx = FXRates("p.parquet", "s.parquet", "c.csv", "o.csv", pushdown=False, encode_keys=False)
             fx.load_data()
             assert mock_con.execute.call_count == 3
 
+            # key encoding first creates the ccy_key ENUM
+            mock_con.reset_mock()
+            FXRates("p.parquet", "s.parquet", "c.csv", "o.csv", pushdown=False).load_data()
+            assert mock_con.execute.call_count == 4
+            assert "CREATE OR REPLACE TYPE ccy_key AS ENUM" in mock_con.execute.call_args_list[0].args[0]
+
     @pytest.mark.parametrize("price_data, spot_data, ccy_data, expected_price, test_case", [
         (
             pd.DataFrame({
@@ -152,6 +180,819 @@ class TestFXRates:
                 assert abs(actual_price - expected_price) < 0.005, \
                     f"{test_case}: Expected {expected_price}, got {actual_price}"
 
+    def test_unknown_engine(self):
+        with pytest.raises(ValueError):
+            FXRates("p.parquet", "s.parquet", "c.csv", "o.csv", engine="hash")
+
+    def run_engines(self, price_file, spot_file, ccy_file, temp_dir):
+        outputs = {}
+        for engine in FXRates.ENGINES:
+            output_file = os.path.join(temp_dir, f"output_{engine}.csv")
+            FXRates(price_file, spot_file, ccy_file, output_file, engine=engine).run()
+            with open(output_file, "rb") as f:
+                outputs[engine] = f.read()
+        return outputs
+
+    def test_engines_identical_on_bundled_data(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            outputs = self.run_engines(
+                DATA_DIR / "rates_price_data.parq",
+                DATA_DIR / "rates_spot_rate_data.parq",
+                DATA_DIR / "rates_ccy_data.csv",
+                temp_dir,
+            )
+            assert outputs["asof"] == outputs["range"]
+
+    def test_engines_identical_on_edge_cases(self):
+        # duplicate prices per timestamp, spot exactly 1 hour old, spot after price, missing factor and pair
+        price_data = pd.DataFrame({
+            'timestamp': [datetime(2021, 12, 10, 12, 0, 0), datetime(2021, 12, 10, 12, 0, 0),
+                          datetime(2021, 12, 10, 13, 0, 0), datetime(2021, 12, 10, 13, 30, 0),
+                          datetime(2021, 12, 10, 12, 0, 0), datetime(2021, 12, 10, 12, 0, 0)],
+            'security_id': ['id_1', 'id_1', 'id_2', 'id_3', 'id_4', 'id_5'],
+            'price': [101.0, 99.0, 50.0, 75.0, 10.0, 20.0],
+            'ccy_pair': ['USDVND', 'USDVND', 'USDVND', 'USDVND', 'USDUAH', 'USDXXX']
+        })
+        spot_data = pd.DataFrame({
+            'timestamp': [datetime(2021, 12, 10, 11, 0, 0), datetime(2021, 12, 10, 11, 30, 0),
+                          datetime(2021, 12, 10, 12, 0, 0), datetime(2021, 12, 10, 13, 10, 0),
+                          datetime(2021, 12, 10, 11, 45, 0)],
+            'ccy_pair': ['USDVND', 'USDVND', 'USDVND', 'USDVND', 'USDUAH'],
+            'spot_mid_rate': [1.0, 2.0, 3.0, 4.0, 5.0]
+        })
+        ccy_data = pd.DataFrame({
+            'ccy_pair': ['USDVND', 'USDUAH'],
+            'conversion_factor': [10.0, None],
+            'convert_price': [True, True]
+        })
+        with tempfile.TemporaryDirectory() as temp_dir:
+            price_file = os.path.join(temp_dir, "price.parquet")
+            spot_file = os.path.join(temp_dir, "spot.parquet")
+            ccy_file = os.path.join(temp_dir, "ccy.csv")
+            price_data.to_parquet(price_file, index=False)
+            spot_data.to_parquet(spot_file, index=False)
+            ccy_data.to_csv(ccy_file, index=False)
+
+            outputs = self.run_engines(price_file, spot_file, ccy_file, temp_dir)
+            assert outputs["asof"] == outputs["range"]
+
+            results = pd.read_csv(os.path.join(temp_dir, "output_asof.csv"), delimiter=';')
+            assert len(results) == 5
+            assert results["error_message"].iloc[0] == "No conversion factor"
+            assert results["new_price"].iloc[1] == round(101.0 / 10 + 3.0, 2)
+            assert results["error_message"].iloc[2] == "No spot rate in window"
+            assert results["new_price"].iloc[3] == round(75.0 / 10 + 4.0, 2)
+            assert results["new_price"].iloc[4] == 20.0
+
+    def test_numpy_engine_matches_sql_on_random_inputs(self):
+        # duplicate prices, NULL keys, unknown pairs, NULL factors and spots on both edges of the 1 hour window
+        rng = np.random.default_rng(7)
+        pairs = ['USDVND', 'USDUAH', 'EURUSD', 'USDXXX', None]
+        base = datetime(2021, 12, 10, 8, 0, 0)
+        minutes = rng.integers(0, 240, 400)
+        price_times = [base + timedelta(minutes=int(m)) if m % 37 else None for m in minutes]
+        price_data = pd.DataFrame({
+            'timestamp': price_times,
+            'security_id': [f'id_{i % 50}' for i in range(400)],
+            'price': np.where(rng.random(400) < 0.05, np.nan, rng.normal(0, 100, 400)),
+            'ccy_pair': rng.choice(pairs, 400),
+        })
+        spot_minutes = np.concatenate([rng.integers(-60, 240, 300), minutes[:20] - 60, minutes[20:40]])
+        spot_data = pd.DataFrame({
+            'timestamp': [base + timedelta(minutes=int(m)) for m in spot_minutes],
+            'ccy_pair': rng.choice(pairs[:3], len(spot_minutes)),
+            'spot_mid_rate': rng.normal(1, 0.1, len(spot_minutes)),
+        }).drop_duplicates(['ccy_pair', 'timestamp'])  # which of two equal-time spots matches is unspecified
+        ccy_data = pd.DataFrame({
+            'ccy_pair': ['USDVND', 'USDUAH', 'EURUSD'],
+            'conversion_factor': [10.0, None, 3.0],
+            'convert_price': [True, True, False]
+        })
+        with tempfile.TemporaryDirectory() as temp_dir:
+            price_file = os.path.join(temp_dir, "price.parquet")
+            spot_file = os.path.join(temp_dir, "spot.parquet")
+            ccy_file = os.path.join(temp_dir, "ccy.csv")
+            price_data.to_parquet(price_file, index=False)
+            spot_data.to_parquet(spot_file, index=False)
+            ccy_data.to_csv(ccy_file, index=False)
+
+            tables = {engine: FXRates(price_file, spot_file, ccy_file, None, engine=engine).to_arrow()
+                      for engine in FXRates.ENGINES}
+            expected = tables['asof'].to_pydict()
+            actual = tables['numpy'].to_pydict()
+            assert tables['numpy'].column_names == tables['asof'].column_names
+            for column in expected:
+                if column == 'new_price':
+                    assert [v is None for v in actual[column]] == [v is None for v in expected[column]]
+                    assert actual[column] == pytest.approx(expected[column], nan_ok=True)
+                else:
+                    assert actual[column] == expected[column], column
+            assert sum(expected['conversion_applied']) > 0 and sum(expected['insufficient_data']) > 0
+
+    def test_numpy_engine_needs_no_connection(self):
+        fx = FXRates(DATA_DIR / "rates_price_data.parq", DATA_DIR / "rates_spot_rate_data.parq",
+                     DATA_DIR / "rates_ccy_data.csv", None, engine="numpy")
+        assert fx.to_arrow().num_rows > 0
+        assert fx._con is None
+        with pytest.raises(ValueError):
+            FXRates("p.parquet", "s.parquet", "c.csv", "o.csv", engine="numpy", chunk_interval="1 hour")
+
+    @pytest.mark.parametrize("engine", [engine for engine in FXRates.ENGINES if engine != "numpy"])
+    @pytest.mark.parametrize("chunk_interval", ["1 hour", "20 minutes"])
+    def test_streaming_matches_batch_on_bundled_data(self, engine, chunk_interval):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            batch_file = os.path.join(temp_dir, "batch.csv")
+            streaming_file = os.path.join(temp_dir, "streaming.csv")
+            FXRates(*inputs, batch_file, engine=engine).run()
+            FXRates(*inputs, streaming_file, engine=engine, chunk_interval=chunk_interval, memory_limit="256MB").run()
+
+            with open(batch_file) as f:
+                batch = f.read().splitlines()
+            with open(streaming_file) as f:
+                streaming = f.read().splitlines()
+            # chunks are appended in time order, each sorted by ccy_pair and timestamp
+            assert streaming[0] == batch[0]
+            assert sorted(streaming[1:]) == sorted(batch[1:])
+
+    def test_streaming_keeps_prices_without_timestamp(self):
+        price_data = pd.DataFrame({
+            'timestamp': [datetime(2021, 12, 10, 12, 0, 0), None],
+            'security_id': ['id_1', 'id_2'],
+            'price': [100.0, 200.0],
+            'ccy_pair': ['USDVND', 'USDVND']
+        })
+        spot_data = pd.DataFrame({
+            'timestamp': [datetime(2021, 12, 10, 11, 30, 0)],
+            'ccy_pair': ['USDVND'],
+            'spot_mid_rate': [1.0]
+        })
+        ccy_data = pd.DataFrame({'ccy_pair': ['USDVND'], 'conversion_factor': [10.0], 'convert_price': [True]})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            price_file = os.path.join(temp_dir, "price.parquet")
+            spot_file = os.path.join(temp_dir, "spot.parquet")
+            ccy_file = os.path.join(temp_dir, "ccy.csv")
+            output_file = os.path.join(temp_dir, "output.csv")
+            price_data.to_parquet(price_file, index=False)
+            spot_data.to_parquet(spot_file, index=False)
+            ccy_data.to_csv(ccy_file, index=False)
+
+            FXRates(price_file, spot_file, ccy_file, output_file, chunk_interval="1 hour").run()
+            results = pd.read_csv(output_file, delimiter=';')
+            assert results["new_price"].iloc[0] == 11.0
+            assert results["error_message"].iloc[1] == "No spot rate in window"
+
+    def test_key_ranges_balance_rows(self):
+        counts = [("A", 10), ("B", 10), ("C", 30), ("D", 5), ("E", 5)]
+        assert key_ranges(counts, 1) == [("A", "E")]
+        assert key_ranges(counts, 2) == [("A", "C"), ("D", "E")]
+        assert key_ranges(counts, 10) == [("A", "A"), ("B", "B"), ("C", "C"), ("D", "D"), ("E", "E")]
+        assert key_ranges([], 4) == []
+
+    def test_parallel_matches_single_query(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            single_file = os.path.join(temp_dir, "single.csv")
+            parallel_file = os.path.join(temp_dir, "parallel.csv")
+            FXRates(*inputs, single_file).run()
+            FXRates(*inputs, parallel_file, workers=3, memory_limit="256MB").run()
+
+            with open(single_file, "rb") as single, open(parallel_file, "rb") as parallel:
+                assert parallel.read() == single.read()
+
+    @pytest.mark.parametrize("engine,workers", [("asof", 1), ("range", 1), ("numpy", 1), ("asof", 2)])
+    def test_resource_settings_keep_output(self, engine, workers):
+        """ A memory budget, spill directory and relaxed insertion order change nothing in the output """
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            default_file = os.path.join(temp_dir, "default.csv")
+            budgeted_file = os.path.join(temp_dir, "budgeted.csv")
+            spill_dir = os.path.join(temp_dir, "spill")
+            FXRates(*inputs, default_file, engine=engine).run()
+            events = []
+            fx = FXRates(*inputs, budgeted_file, engine=engine, workers=workers, memory_limit="256MB", threads=2,
+                         temp_directory=spill_dir, max_temp_directory_size="1GB", preserve_insertion_order=False,
+                         metrics_callback=events.append)
+            assert fx.con.execute("SELECT current_setting('temp_directory'), current_setting('threads'), "
+                                  "current_setting('preserve_insertion_order')").fetchone() == (spill_dir, 2, False)
+            fx.run()
+
+            with open(default_file, "rb") as default, open(budgeted_file, "rb") as budgeted:
+                assert budgeted.read() == default.read()
+            run = next(event for event in events if event["stage"] == "run")
+            assert run["rows"]["peak_rss_mb"] > 0
+
+    @pytest.mark.parametrize("engine,options", [
+        ("asof", {}), ("range", {}), ("asof", {"chunk_interval": "1 hour"}), ("asof", {"workers": 2}),
+    ])
+    def test_encoded_keys_match_string_keys(self, engine, options):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            string_file = os.path.join(temp_dir, "strings.csv")
+            encoded_file = os.path.join(temp_dir, "encoded.csv")
+            FXRates(*inputs, string_file, engine=engine, encode_keys=False, **options).run()
+            # without pushdown spots are kept by whether their pair has a code instead of by the pushed-down pairs
+            FXRates(*inputs, encoded_file, engine=engine, pushdown=False, **options).run()
+
+            with open(string_file, "rb") as strings, open(encoded_file, "rb") as encoded:
+                assert encoded.read() == strings.read()
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_dictionary_keys_output(self, workers):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            string_file = os.path.join(temp_dir, "strings.parquet")
+            dictionary_file = os.path.join(temp_dir, "dictionary.parquet")
+            FXRates(*inputs, string_file).run()
+            FXRates(*inputs, dictionary_file, workers=workers, dictionary_keys=True).run()
+
+            strings = pq.read_table(string_file)
+            encoded = pq.read_table(dictionary_file)
+            assert pa.types.is_dictionary(encoded.schema.field("ccy_pair").type)
+            assert encoded.column("ccy_pair").chunk(0).dictionary.to_pylist() == sorted(
+                set(strings.column("ccy_pair").drop_null().to_pylist())
+                | set(pd.read_csv(inputs[2])["ccy_pair"].dropna())
+            )
+            assert encoded.set_column(0, "ccy_pair", encoded.column("ccy_pair").cast(pa.string())).equals(strings)
+
+        with pytest.raises(ValueError, match="dictionary_keys"):
+            FXRates(*inputs, "output.parquet", engine="numpy", dictionary_keys=True)
+
+    def test_encode_keys_needs_sql_engine_and_no_cache(self):
+        inputs = ("p.parquet", "s.parquet", "c.csv", "o.csv")
+        # on by default only where it applies
+        assert FXRates(*inputs).encode_keys
+        assert not FXRates(*inputs, engine="numpy").encode_keys
+        assert not FXRates(*inputs, cache_file="cache.duckdb").encode_keys
+        with pytest.raises(ValueError, match="encode_keys"):
+            FXRates(*inputs, engine="numpy", encode_keys=True)
+        with pytest.raises(ValueError, match="encode_keys"):
+            FXRates(*inputs, cache_file="cache.duckdb", encode_keys=True)
+        with pytest.raises(ValueError, match="dictionary_keys"):
+            FXRates(*inputs, encode_keys=False, dictionary_keys=True)
+
+    @pytest.mark.parametrize("options", [
+        {},
+        {"engine": "numpy"},
+        {"chunk_interval": "1 hour"},
+        {"workers": 2, "dictionary_keys": True},
+    ])
+    def test_compute_matches_run(self, options):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_file = os.path.join(temp_dir, "output.parquet")
+            FXRates(*inputs, output_file, **options).run()
+
+            reader = FXRates(*inputs, **options).compute(batch_size=100)
+            batches = list(reader)
+            assert batches and all(batch.num_rows <= 100 for batch in batches)
+            assert pa.Table.from_batches(batches, reader.schema).equals(pq.read_table(output_file))
+
+    def test_compute_is_lazy(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        events = []
+        reader = FXRates(*inputs, chunk_interval="1 hour", metrics_callback=events.append).compute(batch_size=10)
+        first = reader.read_next_batch()
+        chunks = next(event for event in events if event["stage"] == "partition_inputs")["rows"]["chunks"]
+        assert chunks > 1
+        # only the first time chunk has been loaded so far
+        assert [event["stage"] for event in events].count("load_chunk") == 1
+        rows = first.num_rows + sum(batch.num_rows for batch in reader)
+        assert [event["stage"] for event in events].count("load_chunk") == chunks
+        assert rows == FXRates(*inputs).to_arrow().num_rows
+
+    def test_compute_closes_its_own_connection(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        fx = FXRates(*inputs)
+        reader = fx.compute(batch_size=10)
+        connection = fx.con
+        reader.read_next_batch()
+        reader.read_all()
+        with pytest.raises(duckdb.ConnectionException):
+            connection.execute("SELECT 1")
+        assert fx._con is None
+
+        connection = duckdb.connect()
+        FXRates(*inputs, connection=connection).to_arrow()
+        assert connection.execute("SELECT 1").fetchone() == (1,)
+        connection.close()
+
+    def test_compute_frames(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        expected = FXRates(*inputs).to_arrow()
+        pd.testing.assert_frame_equal(FXRates(*inputs).compute(output="pandas"), expected.to_pandas())
+        with pytest.raises(ValueError, match="Unknown output"):
+            FXRates(*inputs).compute(output="csv")
+        polars = pytest.importorskip("polars")
+        assert FXRates(*inputs).compute(output="polars").equals(polars.from_arrow(expected))
+
+    @pytest.mark.parametrize("extension", ["parquet", "arrow"])
+    def test_binary_output_matches_csv(self, extension):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            csv_file = os.path.join(temp_dir, "output.csv")
+            binary_file = os.path.join(temp_dir, f"output.{extension}")
+            FXRates(*inputs, csv_file).run()
+            FXRates(*inputs, binary_file, row_group_size=1000).run()
+
+            expected = pd.read_csv(csv_file, delimiter=";", parse_dates=["timestamp"])
+            # CSV cannot tell an empty error message from a missing one
+            expected["error_message"] = expected["error_message"].fillna("")
+            if extension == "parquet":
+                actual = pd.read_parquet(binary_file)
+            else:
+                actual = pd.read_feather(binary_file)
+            assert pd.api.types.is_float_dtype(actual["new_price"])
+            pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    def test_partitioned_output(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_dir = os.path.join(temp_dir, "output")
+            fx_rates = FXRates(*inputs, output_dir, partition_by=["ccy_pair", "date"], chunk_interval="1 day")
+            fx_rates.run()
+
+            expected = FXRates(*inputs).to_arrow().to_pandas()
+            actual = pd.read_parquet(output_dir)
+            assert sorted(os.listdir(output_dir)) == sorted(f"ccy_pair={pair}" for pair in expected["ccy_pair"].unique())
+            assert len(actual) == len(expected)
+
+    def test_instrumentation_events(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        assert not FXRates(*inputs).instrumentation.enabled
+
+        events = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_file = os.path.join(temp_dir, "output.csv")
+            profile_dir = os.path.join(temp_dir, "profiles")
+            FXRates(*inputs, output_file, metrics_callback=events.append, profile_dir=profile_dir).run()
+
+            assert [event["stage"] for event in events] == ["load_data", "calculate_rates", "run"]
+            assert len({event["run_id"] for event in events}) == 1
+            load, rates, run = events
+            assert load["rows"]["price_rows"] == 13404
+            assert rates["rows"]["output_rows"] == rates["rows"]["matched_prices"] == 6696
+            assert 0 < rates["rows"]["matched_spots"] <= rates["rows"]["matched_prices"]
+            assert os.path.exists(rates["profile"]["file"])
+            assert run["mode"] == "batch" and run["elapsed_seconds"] >= rates["elapsed_seconds"]
+
+    @pytest.mark.parametrize("chunk_interval", [None, "6 hours"])
+    def test_spot_pushdown_skips_row_groups(self, chunk_interval):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # time-sorted spots in many row groups, prices covering a few hours of one day
+            spot_file = os.path.join(temp_dir, "spot.parquet")
+            spots = pd.read_parquet(DATA_DIR / "rates_spot_rate_data.parq").sort_values("timestamp")
+            spots.to_parquet(spot_file, index=False, row_group_size=10000)
+            price_file = os.path.join(temp_dir, "price.parquet")
+            prices = pd.read_parquet(DATA_DIR / "rates_price_data.parq")
+            prices[prices["timestamp"] >= "2021-12-10 12:00:00"].to_parquet(price_file, index=False)
+
+            outputs = {}
+            for pushdown in (True, False):
+                outputs[pushdown] = os.path.join(temp_dir, f"output_{pushdown}.csv")
+                fx = FXRates(price_file, spot_file, DATA_DIR / "rates_ccy_data.csv", outputs[pushdown],
+                             pushdown=pushdown, chunk_interval=chunk_interval)
+                fx.run()
+                if pushdown:
+                    stats = fx.pushdown_stats
+                    assert stats["spot_row_groups"] == 23
+                    assert 0 < stats["spot_row_groups_skipped"] < stats["spot_row_groups"]
+
+            with open(outputs[True], "rb") as pushed, open(outputs[False], "rb") as full:
+                assert pushed.read() == full.read()
+
+    def test_run_bounds_restrict_prices(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_file = os.path.join(temp_dir, "output.csv")
+            FXRates(
+                DATA_DIR / "rates_price_data.parq",
+                DATA_DIR / "rates_spot_rate_data.parq",
+                DATA_DIR / "rates_ccy_data.csv",
+                output_file,
+                start="2021-12-10 12:00:00",
+                end="2021-12-10 13:00:00",
+                pairs=["USDNOK", "USDHKD"],
+            ).run()
+            results = pd.read_csv(output_file, delimiter=";", parse_dates=["timestamp"])
+            assert len(results) > 0
+            assert set(results["ccy_pair"]) == {"USDNOK", "USDHKD"}
+            assert results["timestamp"].between("2021-12-10 12:00:00", "2021-12-10 13:00:00").all()
+
+    @pytest.mark.parametrize("engine", FXRates.ENGINES)
+    def test_backfill_matches_separate_runs(self, engine):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        # the 2021-12-09 18:00 period's separate range-engine run hits DuckDB's join filter pushdown issue
+        ranges = date_ranges("2021-12-09 12:00:00", "2021-12-10 23:59:59", "6 hours")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            template = os.path.join(temp_dir, "backfill", "rates_{index}.csv")
+            Backfill(ranges, template, price_file=inputs[0], spot_file=inputs[1], ccy_file=inputs[2],
+                     engine=engine).run()
+            for index, (start, end) in enumerate(ranges):
+                expected_file = os.path.join(temp_dir, "expected.csv")
+                FXRates(*inputs, expected_file, engine=engine, start=start, end=end).run()
+                assert Path(expected_file).read_bytes() == Path(template.format(index=index)).read_bytes(), index
+
+    def test_backfill_partitioned_output(self):
+        ranges = parse_ranges("2021-12-10 12:00:00/2021-12-10 12:59:59,2021-12-10 06:00:00/2021-12-10 06:59:59")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_dir = os.path.join(temp_dir, "dataset")
+            Backfill(ranges, output_dir, price_file=DATA_DIR / "rates_price_data.parq",
+                     spot_file=DATA_DIR / "rates_spot_rate_data.parq", ccy_file=DATA_DIR / "rates_ccy_data.csv",
+                     partition_by=["date"]).run()
+            results = pd.read_parquet(output_dir).sort_values(["ccy_pair", "timestamp"], ignore_index=True)
+            expected = pd.concat([
+                FXRates(DATA_DIR / "rates_price_data.parq", DATA_DIR / "rates_spot_rate_data.parq",
+                        DATA_DIR / "rates_ccy_data.csv", start=start, end=end).to_arrow().to_pandas()
+                for start, end in ranges
+            ]).sort_values(["ccy_pair", "timestamp"], ignore_index=True)
+            assert len(results) == len(expected) > 0
+            assert results["new_price"].equals(expected["new_price"])
+            assert results["timestamp"].dt.hour.isin([6, 12]).all()
+
+        with pytest.raises(ValueError):
+            parse_ranges("2021-12-10 06:00:00/2021-12-10 07:00:00,2021-12-10 07:00:00/2021-12-10 08:00:00")
+        with pytest.raises(ValueError):
+            Backfill(ranges, "out.csv", price_file="p.parquet", spot_file="s.parquet", ccy_file="c.csv",
+                     chunk_interval="1 hour")
+
+    def test_input_cache_reuses_unchanged_inputs(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ccy_file = os.path.join(temp_dir, "rates_ccy_data.csv")
+            shutil.copy(DATA_DIR / "rates_ccy_data.csv", ccy_file)
+            cache_file = os.path.join(temp_dir, "cache", "inputs.duckdb")
+
+            def run(name, **params):
+                events = []
+                output_file = os.path.join(temp_dir, f"{name}.csv")
+                FXRates(
+                    DATA_DIR / "rates_price_data.parq",
+                    DATA_DIR / "rates_spot_rate_data.parq",
+                    ccy_file,
+                    output_file,
+                    metrics_callback=events.append,
+                    **params
+                ).run()
+                load = next(event for event in events if event['stage'] == 'load_data')
+                with open(output_file, 'rb') as output:
+                    return output.read(), load['rows']
+
+            expected, _ = run("plain")
+            first, rows = run("first", cache_file=cache_file)
+            assert (rows['cache_hits'], rows['cache_misses']) == (0, 3)
+            second, rows = run("second", cache_file=cache_file)
+            assert (rows['cache_hits'], rows['cache_misses']) == (3, 0)
+            assert first == second == expected
+
+            # other bounds reload prices and spots, a touched file is reloaded too
+            _, rows = run("bounded", cache_file=cache_file, start="2021-12-10 12:00:00")
+            assert (rows['cache_hits'], rows['cache_misses']) == (1, 2)
+            os.utime(ccy_file, ns=(0, 0))
+            _, rows = run("touched", cache_file=cache_file)
+            assert (rows['cache_hits'], rows['cache_misses']) == (2, 1)
+
+            # a limit below one run's tables keeps only the entries of the latest run
+            _, rows = run("evicting", cache_file=cache_file, cache_limit=1, pairs=["USDNOK"])
+            assert rows['cache_evictions'] >= 5
+            con = duckdb.connect(cache_file, read_only=True)
+            assert con.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] == 3
+            con.close()
+
+    @pytest.mark.parametrize("extension", ["csv", "parquet", "arrow"])
+    def test_change_detection_recomputes_changed_hours(self, extension):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            price_file = os.path.join(temp_dir, "price.parquet")
+            spot_file = os.path.join(temp_dir, "spot.parquet")
+            shutil.copy(DATA_DIR / "rates_price_data.parq", price_file)
+            shutil.copy(DATA_DIR / "rates_spot_rate_data.parq", spot_file)
+            fingerprint_file = os.path.join(temp_dir, "fingerprints.parquet")
+
+            def run(name, **params):
+                events = []
+                output_file = os.path.join(temp_dir, f"{name}.{extension}")
+                FXRates(price_file, spot_file, DATA_DIR / "rates_ccy_data.csv", output_file,
+                        metrics_callback=events.append, **params).run()
+                with open(output_file, 'rb') as output:
+                    return output.read(), {event['stage']: event['rows'] for event in events}
+
+            first, stages = run("changes", fingerprint_file=fingerprint_file)
+            assert 'merge_output' not in stages and first == run("plain")[0]
+            second, stages = run("changes", fingerprint_file=fingerprint_file)
+            assert stages['detect_changes']['changed_partitions'] == 0 and 'merge_output' not in stages
+            assert second == first
+
+            # restate the USDBRL prices of one hour and the EURUSD spots of another, which also reach the next hour
+            duckdb.execute(f"""
+                COPY (SELECT * REPLACE (CASE WHEN ccy_pair = 'USDBRL' AND hour(CAST(timestamp AS TIMESTAMP)) = 19
+                                             THEN price * 1.01 ELSE price END AS price)
+                      FROM read_parquet('{DATA_DIR / "rates_price_data.parq"}')) TO '{price_file}' (FORMAT parquet)
+            """)
+            duckdb.execute(f"""
+                COPY (SELECT * REPLACE (CASE WHEN ccy_pair = 'EURUSD' AND hour(CAST(timestamp AS TIMESTAMP)) = 18
+                                             THEN spot_mid_rate + 0.5 ELSE spot_mid_rate END AS spot_mid_rate)
+                      FROM read_parquet('{DATA_DIR / "rates_spot_rate_data.parq"}')) TO '{spot_file}' (FORMAT parquet)
+            """)
+            merged, stages = run("changes", fingerprint_file=fingerprint_file)
+            expected = run("restated")[0]
+            if extension == "csv":
+                assert merged == expected
+            elif extension == "parquet":
+                assert pq.read_table(pa.BufferReader(merged)).equals(pq.read_table(pa.BufferReader(expected)))
+            else:
+                assert pa.ipc.open_file(merged).read_all().equals(pa.ipc.open_file(expected).read_all())
+            assert stages['detect_changes']['changed_partitions'] == 2
+            assert stages['detect_changes']['affected_partitions'] == 3
+            rows = stages['merge_output']
+            assert 0 < rows['recomputed_rows'] < rows['output_rows']
+            assert rows['recomputed_input_rows'] < rows['input_rows']
+
+            # other settings do not trust the previous fingerprints
+            _, stages = run("changes", fingerprint_file=fingerprint_file, pairs=["USDBRL"])
+            assert 'changed_partitions' not in stages['detect_changes']
+
+    def test_change_detection_options(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+            "output.csv",
+        )
+        for params in ({"engine": "numpy"}, {"chunk_interval": "1 hour"}, {"workers": 2},
+                       {"partition_by": ["ccy_pair"]}, {"dictionary_keys": True}):
+            with pytest.raises(ValueError, match="fingerprint_file"):
+                FXRates(*inputs, fingerprint_file="fingerprints.parquet", **params)
+        with pytest.raises(ValueError, match="change detection"):
+            Backfill([("2021-12-10 06:00:00", "2021-12-10 07:00:00")], "out.csv", price_file=inputs[0],
+                     spot_file=inputs[1], ccy_file=inputs[2], fingerprint_file="fingerprints.parquet")
+
+    def test_shared_connection_matches_separate_runs(self):
+        inputs = (
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        )
+        runs = [dict(), dict(engine="range", pairs=["USDBRL", "USDNOK"]),
+                dict(encode_keys=False, chunk_interval="6 hours", preserve_insertion_order=False, threads=1),
+                dict(start="2021-12-10 12:00:00")]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            con = duckdb.connect()
+            runs.append(dict(cache_file=os.path.join(temp_dir, "cache.duckdb")))
+            for i, params in enumerate(runs):
+                shared_file = os.path.join(temp_dir, f"shared_{i}.csv")
+                own_file = os.path.join(temp_dir, f"own_{i}.csv")
+                FXRates(*inputs, shared_file, connection=con, **params).run()
+                reset(con)
+                FXRates(*inputs, own_file, **params).run()
+                assert Path(shared_file).read_bytes() == Path(own_file).read_bytes()
+            assert con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE NOT internal").fetchone()[0] == 0
+            assert con.execute("SELECT current_setting('preserve_insertion_order')").fetchone()[0]
+            con.close()
+
+    def test_cli_runs_job_file(self, capsys):
+        spec = importlib.util.spec_from_file_location("cli", Path(__file__).parent.parent.parent / "cli.py")
+        cli = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cli)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_file = os.path.join(temp_dir, "jobs.txt")
+            with open(job_file, "w") as jobs:
+                jobs.write(f"""
+                    # comments and blank lines are skipped
+                    fx-rates --output-file '{temp_dir}/all.csv'
+                    rolling-stdev --output-file '{temp_dir}/stdev.parquet' --encode-keys
+                    fx-rates --output-file '{temp_dir}/brl.csv' --pairs USDBRL --engine range
+                """)
+            assert cli.main(["jobs", job_file]) == 0
+            assert cli.main(["fx-rates", "--output-file", f"{temp_dir}/brl_alone.csv", "--pairs", "USDBRL"]) == 0
+            FXRates(
+                DATA_DIR / "rates_price_data.parq",
+                DATA_DIR / "rates_spot_rate_data.parq",
+                DATA_DIR / "rates_ccy_data.csv",
+                f"{temp_dir}/all_alone.csv",
+            ).run()
+            assert Path(f"{temp_dir}/all.csv").read_bytes() == Path(f"{temp_dir}/all_alone.csv").read_bytes()
+            assert Path(f"{temp_dir}/brl.csv").read_bytes() == Path(f"{temp_dir}/brl_alone.csv").read_bytes()
+            assert pq.read_table(f"{temp_dir}/stdev.parquet").num_rows > 0
+
+            # every job is parsed before the first one runs
+            with open(job_file, "w") as jobs:
+                jobs.write(f"fx-rates --output-file '{temp_dir}/never.csv'\nbackfill --step '1 day'\n")
+            assert cli.main(["jobs", job_file]) == 1
+            with open(job_file, "w") as jobs:
+                jobs.write(f"fx-rates --output-file '{temp_dir}/never.csv'\nfx-rates --engine nope\n")
+            with pytest.raises(SystemExit):
+                cli.main(["jobs", job_file])
+            assert not os.path.exists(f"{temp_dir}/never.csv")
+
+            # a job failing while it runs is reported as failed, and the jobs after it do not run
+            with open(job_file, "w") as jobs:
+                jobs.write(f"fx-rates --price-file '{temp_dir}/missing.parq' --output-file '{temp_dir}/failed.csv'\n"
+                           f"fx-rates --output-file '{temp_dir}/never.csv'\n")
+            capsys.readouterr()
+            assert cli.main(["jobs", job_file]) == 1
+            output = capsys.readouterr().out
+            assert "Job 1/2 (fx-rates) failed after" in output and "missing.parq" in output
+            assert "finished" not in output
+            assert not os.path.exists(f"{temp_dir}/never.csv")
+
+    def test_cli_parsers_import_no_engines(self):
+        # a fresh interpreter, since this one has imported everything already
+        script = f"""
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location("cli", {str(Path(__file__).parent.parent.parent / "cli.py")!r})
+cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cli)
+for command in cli.JOB_COMMANDS:
+    cli.load(command).build_parser().parse_args([])
+print(sorted(name for name in ("duckdb", "numpy", "pyarrow", "pandas") if name in sys.modules))
+"""
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == "[]"
+
+    def test_service_matches_calculate_rates(self):
+        service = FXConversionService(DATA_DIR / "rates_spot_rate_data.parq", DATA_DIR / "rates_ccy_data.csv")
+        prices = pd.read_parquet(DATA_DIR / "rates_price_data.parq")
+        actual = service.convert(prices["ccy_pair"].tolist(), prices["timestamp"].tolist(), prices["price"].tolist())
+
+        expected = FXRates(
+            DATA_DIR / "rates_price_data.parq",
+            DATA_DIR / "rates_spot_rate_data.parq",
+            DATA_DIR / "rates_ccy_data.csv",
+        ).to_arrow()
+        pd.testing.assert_frame_equal(actual.to_pandas(), expected.to_pandas())
+
+    def test_service_http_with_new_spots(self):
+        spot_data = pd.DataFrame({
+            'timestamp': [datetime(2021, 12, 10, 11, 0, 0)],
+            'ccy_pair': ['USDVND'],
+            'spot_mid_rate': [1.0]
+        })
+        ccy_data = pd.DataFrame({'ccy_pair': ['USDVND'], 'conversion_factor': [10.0], 'convert_price': [True]})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spot_file = os.path.join(temp_dir, "spot.parquet")
+            ccy_file = os.path.join(temp_dir, "ccy.csv")
+            spot_data.to_parquet(spot_file, index=False)
+            ccy_data.to_csv(ccy_file, index=False)
+
+            server = make_server(FXConversionService(spot_file, ccy_file), port=0)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+
+            def post(path, payload):
+                request = urllib.request.Request(url + path, data=json.dumps(payload).encode(), method="POST")
+                with urllib.request.urlopen(request) as response:
+                    return json.loads(response.read())
+
+            try:
+                prices = {"prices": [{"ccy_pair": "USDVND", "timestamp": "2021-12-10 12:30:00", "price": 100.0}]}
+                assert post("/convert", prices)["rows"][0]["error_message"] == "No spot rate in window"
+
+                # a late tick arriving out of order is merged into the index
+                ticks = [{"ccy_pair": "USDVND", "timestamp": "2021-12-10 12:15:00", "spot_mid_rate": 2.0},
+                         {"ccy_pair": "USDVND", "timestamp": "2021-12-10 11:45:00", "spot_mid_rate": 3.0}]
+                assert post("/spots", {"spots": ticks})["added"] == 2
+                row = post("/convert", prices)["rows"][0]
+                assert row["new_price"] == 12.0 and row["conversion_applied"]
+                assert row["timestamp"] == "2021-12-10 12:30:00"
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_spot_stream_matches_calculate_rates(self):
+        spots = pd.read_parquet(DATA_DIR / "rates_spot_rate_data.parq")
+        prices = pd.read_parquet(DATA_DIR / "rates_price_data.parq")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tick_file = os.path.join(temp_dir, "spots.jsonl")
+            spots.to_json(tick_file, orient="records", lines=True)
+            # a full day of delay keeps every tick of the bundled file, so all prices can be compared
+            stream = SpotStream(DATA_DIR / "rates_ccy_data.csv", max_delay=86400 * 10**6)
+            asyncio.run(stream.consume(tail_file(tick_file, follow=False, batch_size=5000)))
+            assert stream.stats()["ticks"] == len(spots.dropna(subset=["ccy_pair", "timestamp"]))
+
+            expected = FXRates(DATA_DIR / "rates_price_data.parq", DATA_DIR / "rates_spot_rate_data.parq",
+                               DATA_DIR / "rates_ccy_data.csv").to_arrow()
+            actual = stream.convert(prices["ccy_pair"].tolist(), prices["timestamp"].tolist(), prices["price"].tolist())
+            assert actual.cast(expected.schema).equals(expected)
+
+    def test_spot_stream_memory_stays_bounded(self):
+        rng = np.random.default_rng(3)
+        hour = 3600 * 10**6
+        stream_spots = SpotWindow(max_delay=hour // 2, capacity=16)
+        full = SpotIndex()
+        pairs = np.array(["EURUSD", "USDJPY", "USDNOK"])
+        sizes = []
+        for batch in range(240):
+            # ten hours of ticks every ~2 seconds, each batch shuffled so some ticks arrive late
+            times = batch * 150 * 10**6 + np.sort(rng.integers(0, 150 * 10**6, 200))
+            batch_pairs = pairs[rng.integers(0, 3, 200)]
+            rates = rng.normal(1, 0.01, 200)
+            shuffle = rng.permutation(200)
+            stream_spots.add(batch_pairs[shuffle], times[shuffle], rates[shuffle])
+            full.add(batch_pairs[shuffle], times[shuffle], rates[shuffle])
+
+            query_times = stream_spots.watermark - rng.integers(0, hour // 2, 100)
+            query_pairs = pairs[rng.integers(0, 3, 100)]
+            np.testing.assert_array_equal(stream_spots.lookup(query_pairs, query_times),
+                                          full.lookup(query_pairs, query_times))
+            sizes.append((len(stream_spots), stream_spots.nbytes))
+
+        # after the first 1.5 hours the buffers neither grow nor keep old ticks
+        assert max(size for size, _ in sizes[60:]) <= 1.5 * 3600 / 0.75 + 200
+        assert len({nbytes for _, nbytes in sizes[80:]}) == 1
+        assert stream_spots.evicted == len(full) - len(stream_spots)
+
+        capped = SpotRing(capacity=4, max_ticks=8)
+        capped.extend(np.arange(10), np.arange(10.0))
+        capped.extend(np.array([3]), np.array([-1.0]))
+        assert len(capped) == 8 and capped.dropped == 3
+        assert capped.ordered()[0].tolist() == [3, 3, 4, 5, 6, 7, 8, 9]
+
+    def test_spot_stream_socket(self):
+        ccy_data = pd.DataFrame({'ccy_pair': ['USDVND'], 'conversion_factor': [10.0], 'convert_price': [True]})
+
+        async def session(socket_path, stream):
+            server = await stream.serve(socket_path)
+            try:
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+
+                async def request(payload):
+                    writer.write(json.dumps(payload).encode() + b"\n")
+                    await writer.drain()
+                    return json.loads(await reader.readline())
+
+                ticks = [{"ccy_pair": "USDVND", "timestamp": "2021-12-10 11:45:00", "spot_mid_rate": 3.0},
+                         {"ccy_pair": "USDVND", "timestamp": "2021-12-10 13:00:00", "spot_mid_rate": 2.0}]
+                replies = [await request({"spots": ticks})]
+                replies.append(await request({"prices": [
+                    {"ccy_pair": "USDVND", "timestamp": "2021-12-10 12:30:00", "price": 100.0}
+                ]}))
+                replies.append(await request({"unknown": []}))
+                writer.close()
+                return replies
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ccy_file = os.path.join(temp_dir, "ccy.csv")
+            ccy_data.to_csv(ccy_file, index=False)
+            stream = SpotStream(ccy_file, max_delay=3600 * 10**6)
+            added, converted, error = asyncio.run(session(os.path.join(temp_dir, "fx.sock"), stream))
+            assert added == {"added": 2}
+            assert converted["rows"][0]["new_price"] == 13.0
+            assert "error" in error
+
     def test_error_handling_missing_files(self):
         fx_rates = FXRates("missing.parquet", "missing.parquet", "missing.csv", "output.csv")
         with pytest.raises(Exception):
@@ -0,0 +1,293 @@
+"""
+Change detection: fingerprints of the inputs per (key, hour) partition, kept between runs so that a rerun over
+restated inputs recomputes only the output partitions the changes can reach and merges them into the previous
+output.
+
+A fingerprint is the row count, the XOR and the sum of the upper halves of the row hashes of one partition of one
+input table: both are order-independent, and the sum still sees a change to rows that appear twice. The
+fingerprint file also records the run's settings; a run with other settings, or whose previous output is gone,
+recomputes everything and starts a new fingerprint file.
+"""
+import bisect
+import json
+import os
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from resources import stored_order
+
+NS_IN_HOUR = 3_600_000_000_000
+# NULL times sort after every other time, as in the output
+NULL_TIME = np.iinfo(np.int64).max
+
+
+def hour_of(column):
+    """ Hour partition of a timestamp column, NULL for NULL timestamps """
+    return f"date_trunc('hour', CAST({column} AS TIMESTAMP))"
+
+
+def replace_table(con, name, query):
+    """ Replaces the table or view `name` (e.g. a cached input) with a temp table of the rows of `query` """
+    con.execute(f"CREATE OR REPLACE TEMP TABLE changed_{name} AS {query}")
+    kind = 'VIEW' if con.execute("SELECT 1 FROM duckdb_views() WHERE view_name = ?", [name]).fetchone() else 'TABLE'
+    con.execute(f"DROP {kind} {name}")
+    con.execute(f"ALTER TABLE changed_{name} RENAME TO {name}")
+
+
+def read_table(path, output_format):
+    """ A previous Parquet or Arrow output as an Arrow table """
+    if output_format == 'parquet':
+        return pq.read_table(path)
+    with pa.ipc.open_file(str(path)) as reader:
+        return reader.read_all()
+
+
+def partition_runs(table, key, time, partitions):
+    """
+    [start, end) rows of every (key, hour in epoch nanoseconds) of `partitions`, sorted like the rows, in `table`
+    sorted by `key` and `time` with NULLs last. A partition without rows gets the empty run where they would be.
+    """
+    codes = table[key].combine_chunks().dictionary_encode().indices.fill_null(-1).to_numpy(zero_copy_only=False)
+    times = pc.cast(pc.cast(table[time], pa.timestamp('ns')), pa.int64()).fill_null(NULL_TIME).to_numpy()
+    starts = np.flatnonzero(np.diff(codes, prepend=-2))
+    ends = np.append(starts[1:], len(codes))
+    run_keys = table[key].take(starts).to_pylist()
+    present = {run_key: (start, end) for run_key, start, end in zip(run_keys, starts, ends)}
+    sorted_keys = [run_key for run_key in run_keys if run_key is not None]
+    runs = []
+    for partition_key, hour in partitions:
+        if partition_key in present:
+            start, end = present[partition_key]
+        else:
+            position = len(sorted_keys) if partition_key is None else bisect.bisect_left(sorted_keys, partition_key)
+            start = end = starts[position] if position < len(starts) else len(codes)
+        key_times = times[start:end]
+        if hour is None:
+            runs.append((start + np.searchsorted(key_times, NULL_TIME), end))
+        else:
+            runs.append((start + np.searchsorted(key_times, hour),
+                         start + np.searchsorted(key_times, hour + NS_IN_HOUR)))
+    return runs
+
+
+def splice(previous_runs, recomputed_runs, previous_rows):
+    """ (source, start, end) row ranges of the merged output: previous rows with each run swapped for its new one """
+    pieces, position = [], 0
+    for (start, end), (new_start, new_end) in zip(previous_runs, recomputed_runs):
+        pieces += [('previous', position, start), ('recomputed', new_start, new_end)]
+        position = end
+    return [*pieces, ('previous', position, previous_rows)]
+
+
+def line_offsets(data):
+    """ Offsets of the line starts in CSV bytes `data`, ending with the offset of the data's end """
+    return np.append(0, np.flatnonzero(data == ord('\n')) + 1)
+
+
+def splice_csv(con, output_file, target, recomputed, key, time, partitions):
+    """
+    Writes the previous CSV output with the affected runs of lines swapped for the lines of the `recomputed`
+    rows to `target`, returning the rows written, or None when a value spans lines so that lines are not rows
+    """
+    try:
+        previous = pv.read_csv(
+            output_file,
+            parse_options=pv.ParseOptions(delimiter=';'),
+            convert_options=pv.ConvertOptions(
+                include_columns=[key, time],
+                column_types={key: pa.string(), time: pa.timestamp('ns')},
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+    except pa.ArrowInvalid:
+        return None
+    data = np.memmap(output_file, dtype=np.uint8, mode='r')
+    # the rows' lines follow the header line
+    lines = line_offsets(data)[1:]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        part_file = os.path.join(temp_dir, 'recomputed.csv')
+        con.execute(f"COPY (SELECT * FROM recomputed) TO '{part_file}' (HEADER FALSE, DELIMITER ';')")
+        new_data = np.fromfile(part_file, dtype=np.uint8)
+    new_lines = line_offsets(new_data)
+    if len(lines) != previous.num_rows + 1 or len(new_lines) != recomputed.num_rows + 1:
+        return None
+    previous_runs = partition_runs(previous, key, time, partitions)
+    with open(target, 'wb') as merged:
+        merged.write(data[:lines[0]])
+        recomputed_runs = partition_runs(recomputed, key, time, partitions)
+        for source, start, end in splice(previous_runs, recomputed_runs, previous.num_rows):
+            offsets, source_data = (lines, data) if source == 'previous' else (new_lines, new_data)
+            merged.write(source_data[offsets[start]:offsets[end]])
+    return previous.num_rows - sum(end - start for start, end in previous_runs) + recomputed.num_rows
+
+
+class ChangeDetector:
+    """
+    Compares the fingerprints of the loaded inputs with those of the previous run.
+
+    Inputs are added with `add`, then `detect` finds the changed partitions and the output partitions they reach,
+    `restrict` cuts the input tables down to what recomputing those needs and `merge` writes the previous output
+    with the recomputed partitions swapped in. `save` stores the new fingerprints once the output is written.
+    """
+    def __init__(self, path, settings):
+        self.path = str(path)
+        self.settings = json.dumps(settings, sort_keys=True, default=str)
+        self.queries = []
+        self.stats = {}
+
+    def add(self, source, table, key, time, columns, order=None):
+        """
+        Fingerprints `table` per (key, hour of `time`) over `columns`. `order` ranks the rows that share a key and
+        time, for inputs whose first such row is used, so reordering them is a change too.
+        """
+        rank = f", ROW_NUMBER() OVER (PARTITION BY {key}, {time} ORDER BY {order}) AS row_rank" if order else ""
+        values = ', '.join([*columns, 'row_rank'] if order else columns)
+        self.queries.append(f"""
+            SELECT
+                '{source}' AS source,
+                CAST({key} AS VARCHAR) AS key,
+                {hour_of(time)} AS hour,
+                COUNT(*) AS rows,
+                bit_xor(row_hash) AS digest,
+                -- 32-bit halves: the sum fits a BIGINT, which aggregates much faster than a HUGEINT
+                CAST(SUM(CAST(row_hash >> 32 AS BIGINT)) AS BIGINT) AS digest_sum
+            FROM (SELECT *, hash({values}) AS row_hash FROM (SELECT *{rank} FROM {table}))
+            GROUP BY ALL
+        """)
+
+    def has_previous(self):
+        """ Whether a fingerprint file of a previous run with the same settings exists """
+        if not os.path.exists(self.path):
+            return False
+        return (pq.read_schema(self.path).metadata or {}).get(b'settings', b'').decode() == self.settings
+
+    def detect(self, con, downstream, output_exists=True):
+        """
+        Fingerprints the added inputs into `input_fingerprints`. With a previous run to compare with, also creates
+        `affected_partitions` (key, hour): every partition of a changed input `source` and the `downstream[source]`
+        hours after it. Returns whether the previous output can be merged with, otherwise everything is recomputed.
+        """
+        con.execute(f"CREATE OR REPLACE TEMP TABLE input_fingerprints AS {' UNION ALL '.join(self.queries)}")
+        self.stats = {'input_partitions': con.execute("SELECT COUNT(*) FROM input_fingerprints").fetchone()[0]}
+        if not output_exists or not self.has_previous():
+            return False
+        # a partition that appears, disappears or differs in rows or digests is changed
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE changed_partitions AS
+            SELECT COALESCE(c.source, p.source) AS source, COALESCE(c.key, p.key) AS key, COALESCE(c.hour, p.hour) AS hour
+            FROM input_fingerprints c
+            FULL OUTER JOIN read_parquet('{self.path}') p
+              ON c.source = p.source AND c.key IS NOT DISTINCT FROM p.key AND c.hour IS NOT DISTINCT FROM p.hour
+            WHERE c.rows IS DISTINCT FROM p.rows OR c.digest IS DISTINCT FROM p.digest
+               OR c.digest_sum IS DISTINCT FROM p.digest_sum
+        """)
+        reach = ' UNION ALL '.join(
+            f"SELECT '{source}' AS source, {hours} AS hours" for source, hours in downstream.items()
+        )
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE affected_partitions AS
+            SELECT DISTINCT c.key, c.hour + to_hours(step) AS hour
+            FROM changed_partitions c
+            JOIN ({reach}) r ON c.source = r.source
+            CROSS JOIN range(0, (SELECT MAX(hours) FROM ({reach})) + 1) steps(step)
+            WHERE step <= r.hours
+        """)
+        self.stats['changed_partitions'], self.stats['affected_partitions'] = con.execute("""
+            SELECT (SELECT COUNT(*) FROM changed_partitions), (SELECT COUNT(*) FROM affected_partitions)
+        """).fetchone()
+        return True
+
+    def in_affected(self, key, time, hours_before=0):
+        """ SEMI JOIN condition body keeping rows in an affected partition or the `hours_before` hours before one """
+        return f"""SEMI JOIN (
+                SELECT DISTINCT key, hour - to_hours(step) AS hour
+                FROM affected_partitions, range(0, {hours_before} + 1) steps(step)
+            ) a
+            ON CAST({key} AS VARCHAR) IS NOT DISTINCT FROM a.key AND {hour_of(time)} IS NOT DISTINCT FROM a.hour"""
+
+    def restrict(self, con, table, key, time, hours_before=0, order_by=None):
+        """ Keeps only the rows of input `table` that recomputing the affected partitions reads """
+        rows = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        order = f" ORDER BY {order_by}" if order_by else ""
+        affected = self.in_affected(f't.{key}', f't.{time}', hours_before)
+        replace_table(con, table, f"SELECT * FROM {table} t {affected}{order}")
+        kept = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        self.stats['input_rows'] = self.stats.get('input_rows', 0) + rows
+        self.stats['recomputed_input_rows'] = self.stats.get('recomputed_input_rows', 0) + kept
+
+    def merge(self, con, sink, output_file, query, key, time, order, preserve_insertion_order=True):
+        """
+        Writes the previous output `output_file` with the rows of its affected partitions replaced by the rows of
+        `query` in them to `sink`. The previous output is ordered by `order`, which starts with `key` and `time`, so
+        every partition is one run of rows: those between are copied as they are instead of merged and sorted again,
+        CSV lines byte for byte.
+        """
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE recomputed AS
+            SELECT * FROM ({query}) r {self.in_affected(f'r.{key}', f'r.{time}')} ORDER BY {order}
+        """)
+        partitions = con.execute(
+            "SELECT key, epoch_ns(hour) FROM affected_partitions ORDER BY key NULLS LAST, hour NULLS LAST"
+        ).fetchall()
+        with stored_order(con, preserve_insertion_order):
+            recomputed = con.execute("SELECT * FROM recomputed").arrow()
+            if sink.output_format != 'csv':
+                previous = read_table(output_file, sink.output_format)
+                recomputed = recomputed.cast(previous.schema)
+                pieces = splice(partition_runs(previous, key, time, partitions),
+                                partition_runs(recomputed, key, time, partitions), previous.num_rows)
+                con.register('merged_output', pa.concat_tables(
+                    (previous if source == 'previous' else recomputed).slice(start, end - start)
+                    for source, start, end in pieces
+                ))
+                rows = sink.write(con, "SELECT * FROM merged_output")
+                con.unregister('merged_output')
+            elif (rows := splice_csv(con, output_file, sink.path, recomputed, key, time, partitions)) is None:
+                rows = self.merge_sorted(con, sink, output_file, key, time, order)
+        self.stats['output_rows'] = rows
+        self.stats['recomputed_rows'] = recomputed.num_rows
+
+    def merge_sorted(self, con, sink, output_file, key, time, order):
+        """ The previous output outside the affected partitions and the recomputed rows, merged and sorted by SQL """
+        columns = [(name, column_type) for name, column_type, *_ in con.execute("DESCRIBE recomputed").fetchall()]
+        types = ', '.join(f"'{name}': '{column_type}'" for name, column_type in columns)
+        names = ', '.join(name for name, _ in columns)
+        # quoted empty strings are error messages, not NULLs
+        return sink.write(con, f"""
+            SELECT * FROM (
+                SELECT {names}
+                FROM read_csv('{output_file}', delim = ';', header = true, allow_quoted_nulls = false, columns = {{{types}}}) o
+                ANTI JOIN affected_partitions a
+                ON CAST(o.{key} AS VARCHAR) IS NOT DISTINCT FROM a.key AND {hour_of(f'o.{time}')} IS NOT DISTINCT FROM a.hour
+                UNION ALL
+                SELECT {names} FROM recomputed
+            )
+            ORDER BY {order}
+        """)
+
+    def save(self, con):
+        """ Stores the fingerprints of this run next to the target and swaps them in, unless they are unchanged """
+        if self.stats.get('changed_partitions') == 0:
+            return
+        tmp_file = f"{self.path}.tmp"
+        settings = self.settings.replace("'", "''")
+        con.execute(f"COPY input_fingerprints TO '{tmp_file}' (FORMAT parquet, KV_METADATA {{settings: '{settings}'}})")
+        os.replace(tmp_file, self.path)
+
+    def describe(self):
+        """ One line for the run summary on how much of the inputs and output was recomputed """
+        stats = self.stats
+        if 'changed_partitions' not in stats:
+            return f"Changes: no previous run to compare with, computed all {stats['input_partitions']} partitions"
+        line = f"Changes: {stats['changed_partitions']} of {stats['input_partitions']} input partitions changed"
+        if 'output_rows' not in stats:
+            return f"{line}, output unchanged"
+        skipped = 1 - stats['recomputed_rows'] / stats['output_rows'] if stats['output_rows'] else 1
+        return (f"{line}, recomputed {stats['recomputed_rows']} of {stats['output_rows']} output rows from "
+                f"{stats['recomputed_input_rows']} of {stats['input_rows']} input rows ({skipped:.1%} skipped)")
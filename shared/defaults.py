@@ -0,0 +1,9 @@
+"""
+Choices and defaults of the options both tasks share. This module imports nothing, so command lines can be built
+without importing DuckDB, Arrow or NumPy.
+"""
+OUTPUT_FORMATS = ('csv', 'parquet', 'arrow')
+DEFAULT_ROW_GROUP_SIZE = 122880
+# what compute() returns: a RecordBatchReader, or all rows as a DataFrame
+COMPUTE_OUTPUTS = ('batches', 'pandas', 'polars')
+DEFAULT_CACHE_LIMIT = '4GB'
@@ -0,0 +1,126 @@
+import duckdb
+import hashlib
+import os
+import re
+from defaults import DEFAULT_CACHE_LIMIT
+
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12,
+              'KIB': 2**10, 'MIB': 2**20, 'GIB': 2**30, 'TIB': 2**40}
+
+
+def parse_size(size):
+    """ Bytes of an int or a DuckDB-style size string such as '500MB' or '2GiB' """
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', str(size))
+    if match is None or match.group(2).upper() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size '{size}', expected e.g. '500MB' or '2GiB'")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def fingerprint(path):
+    """ Absolute path, size and modification time: a changed input never matches an older entry """
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class InputCache:
+    """
+    Typed, sorted input tables kept in a DuckDB database file between runs.
+
+    An entry is keyed by the query that loads it and the fingerprints of the files it reads, so a rerun over
+    unchanged inputs and bounds finds its tables and reads them in place through a view instead of decoding
+    the source files again. Entries beyond `limit` bytes are evicted least recently used first.
+    The database file is opened by one run at a time; a run that finds it locked proceeds without the cache.
+    """
+    def __init__(self, path, limit=DEFAULT_CACHE_LIMIT, alias='input_cache'):
+        self.path = path
+        self.limit = parse_size(limit)
+        self.alias = alias
+        self.attached = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # keys this instance has served; their views must stay valid, so they are never evicted
+        self.in_use = set()
+
+    def attach(self, con):
+        """ Attaches the cache database to `con`; returns False if another process holds it """
+        if self.attached:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        try:
+            con.execute(f"ATTACH '{self.path}' AS {self.alias}")
+        except duckdb.IOException as e:
+            print(f"Input cache unavailable, loading from source: {e}")
+            return False
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.alias}.cache_entries (
+                key VARCHAR PRIMARY KEY,
+                table_name VARCHAR,
+                sources VARCHAR,
+                rows BIGINT,
+                bytes BIGINT,
+                last_used BIGINT
+            )
+        """)
+        self.attached = True
+        return True
+
+    def used_bytes(self, con):
+        con.execute(f"CHECKPOINT {self.alias}")
+        return con.execute(f"""
+            SELECT used_blocks * block_size FROM pragma_database_size() WHERE database_name = '{self.alias}'
+        """).fetchone()[0]
+
+    def next_use(self, con):
+        return con.execute(f"SELECT COALESCE(MAX(last_used), 0) + 1 FROM {self.alias}.cache_entries").fetchone()[0]
+
+    def table(self, con, name, query, sources, order_by=None, temp=False):
+        """
+        Creates `name` as a view on the cached result of `query`, storing the result first if it is not cached.
+        Returns True on a cache hit.
+        """
+        sources = [fingerprint(source) for source in sources]
+        key = hashlib.sha256('\n'.join([query, order_by or '', *sources]).encode()).hexdigest()
+        table = f't_{key[:24]}'
+        self.in_use.add(key)
+        hit = con.execute(f"SELECT 1 FROM {self.alias}.cache_entries WHERE key = ?", [key]).fetchone() is not None
+        if hit:
+            self.hits += 1
+            con.execute(f"UPDATE {self.alias}.cache_entries SET last_used = ? WHERE key = ?", [self.next_use(con), key])
+        else:
+            self.misses += 1
+            before = self.used_bytes(con)
+            order = f" ORDER BY {order_by}" if order_by else ""
+            con.execute(f"CREATE OR REPLACE TABLE {self.alias}.{table} AS SELECT * FROM ({query}){order}")
+            rows = con.execute(f"SELECT COUNT(*) FROM {self.alias}.{table}").fetchone()[0]
+            con.execute(f"INSERT INTO {self.alias}.cache_entries VALUES (?, ?, ?, ?, ?, ?)", [
+                key, table, '\n'.join(sources), rows, max(0, self.used_bytes(con) - before), self.next_use(con)
+            ])
+            self.evict(con)
+        con.execute(f"CREATE OR REPLACE {'TEMP ' if temp else ''}VIEW {name} AS SELECT * FROM {self.alias}.{table}")
+        return hit
+
+    def evict(self, con):
+        """ Drops least recently used entries until the cached tables fit in `limit`, except those in use """
+        entries = con.execute(f"""
+            SELECT key, table_name, bytes FROM {self.alias}.cache_entries ORDER BY last_used DESC
+        """).fetchall()
+        total = sum(size for _, _, size in entries)
+        evicted = 0
+        for key, table, size in reversed(entries):
+            if total <= self.limit:
+                break
+            if key in self.in_use:
+                continue
+            con.execute(f"DROP TABLE IF EXISTS {self.alias}.{table}")
+            con.execute(f"DELETE FROM {self.alias}.cache_entries WHERE key = ?", [key])
+            total -= size
+            evicted += 1
+        self.evictions += evicted
+        if evicted:
+            con.execute(f"CHECKPOINT {self.alias}")
+
+    def stats(self):
+        return {'cache_hits': self.hits, 'cache_misses': self.misses, 'cache_evictions': self.evictions}
@@ -0,0 +1,123 @@
+import json
+import os
+import time
+import uuid
+
+# DuckDB profile metrics copied into stage events, the full profile is kept in profile_dir
+PROFILE_METRICS = ('latency', 'cpu_time', 'cumulative_cardinality', 'cumulative_rows_scanned',
+                   'system_peak_buffer_memory', 'system_peak_temp_dir_size')
+# profile metrics whose maximum over the run's stages is kept in Instrumentation.peaks
+PEAK_METRICS = ('system_peak_buffer_memory', 'system_peak_temp_dir_size')
+
+
+class Instrumentation:
+    """
+    Per-stage timings, row counts and optional DuckDB query profiles, emitted as one event per stage.
+
+    Events are dicts appended as JSON lines to `metrics_file` and/or passed to `callback`. With neither (and no
+    `profile_dir`) instrumentation is disabled: stages return a shared no-op object and no extra queries run.
+    Row counts are queried after a stage's timer stops, so they do not inflate its elapsed time.
+    """
+    def __init__(self, calculator, metrics_file=None, callback=None, profile_dir=None, run_id=None, **fields):
+        self.calculator = calculator
+        self.metrics_file = metrics_file
+        self.callback = callback
+        self.profile_dir = profile_dir
+        self.enabled = metrics_file is not None or callback is not None or profile_dir is not None
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        # added to every event, e.g. the shard of a parallel worker
+        self.fields = fields
+        self.profiles = 0
+        # highest DuckDB buffer memory and spill size seen in the profiled stages of this process
+        self.peaks = {}
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def stage(self, name, con=None, **fields):
+        """ Context manager timing one stage; profiles its last query when `con` is given and profiling is on """
+        if not self.enabled:
+            return DISABLED_STAGE
+        return Stage(self, name, con, fields)
+
+    def profile_name(self, stage):
+        """ Unique per run and worker, numbered in stage order """
+        self.profiles += 1
+        worker = ''.join(f'-{value}' for value in self.fields.values())
+        return f'{self.run_id}{worker}-{self.profiles:03d}-{stage}.json'
+
+    def emit(self, stage, **fields):
+        event = {'run_id': self.run_id, 'calculator': self.calculator, 'stage': stage, **self.fields, **fields}
+        if self.metrics_file is not None:
+            with open(self.metrics_file, 'a') as metrics:
+                metrics.write(json.dumps(event, default=str) + '\n')
+        if self.callback is not None:
+            self.callback(event)
+
+
+class Stage:
+    def __init__(self, instrumentation, name, con, fields):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.con = con
+        self.fields = fields
+        self.rows = {}
+        self.count_queries = []
+        self.profile_file = None
+
+    def __enter__(self):
+        if self.con is not None and self.instrumentation.profile_dir is not None:
+            profile_name = self.instrumentation.profile_name(self.name)
+            self.profile_file = os.path.join(self.instrumentation.profile_dir, profile_name)
+            self.con.execute("PRAGMA enable_profiling = 'json'")
+            self.con.execute(f"SET profiling_output = '{self.profile_file}'")
+        self.start = time.perf_counter()
+        return self
+
+    def record(self, **rows):
+        """ Adds row counts that are already known """
+        self.rows.update(rows)
+
+    def count(self, con, query):
+        """ Adds the columns of a one-row count query, run once the stage has finished """
+        self.count_queries.append((con, query))
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self.start
+        event = {'elapsed_seconds': round(elapsed, 6), **self.fields}
+        if self.profile_file is not None:
+            self.con.execute("PRAGMA disable_profiling")
+            if os.path.exists(self.profile_file):
+                with open(self.profile_file) as profile:
+                    metrics = json.load(profile)
+                event['profile'] = {'file': self.profile_file, **{m: metrics.get(m) for m in PROFILE_METRICS}}
+                peaks = self.instrumentation.peaks
+                for metric in PEAK_METRICS:
+                    if metrics.get(metric) is not None:
+                        peaks[metric] = max(peaks.get(metric, 0), metrics[metric])
+        if exc_type is None:
+            for con, query in self.count_queries:
+                cursor = con.execute(query)
+                names = [column[0] for column in cursor.description]
+                self.rows.update(zip(names, cursor.fetchone()))
+        else:
+            event['error'] = repr(exc)
+        event['rows'] = self.rows
+        self.instrumentation.emit(self.name, **event)
+        return False
+
+
+class DisabledStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def record(self, **rows):
+        pass
+
+    def count(self, con, query):
+        pass
+
+
+DISABLED_STAGE = DisabledStage()
@@ -0,0 +1,153 @@
+import itertools
+import os
+import shutil
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from defaults import COMPUTE_OUTPUTS, DEFAULT_ROW_GROUP_SIZE, OUTPUT_FORMATS
+
+FORMAT_BY_EXTENSION = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.parq': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+
+
+def infer_format(path):
+    """ Output format from the file extension; paths without a known extension default to CSV """
+    return FORMAT_BY_EXTENSION.get(os.path.splitext(str(path))[1].lower(), 'csv')
+
+
+def signed_dictionaries(schema):
+    """ `schema` with int32 dictionary indices: DuckDB exports ENUMs with unsigned ones, which pandas cannot read """
+    return pa.schema([
+        field.with_type(pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type)
+        else field
+        for field in schema
+    ], metadata=schema.metadata)
+
+
+def fetch_reader(con, query, batch_size=DEFAULT_ROW_GROUP_SIZE):
+    """ RecordBatchReader over the rows of `query`, with dictionary (ENUM) columns on signed indices """
+    reader = con.execute(query).fetch_record_batch(batch_size)
+    schema = signed_dictionaries(reader.schema)
+    if schema.equals(reader.schema):
+        return reader
+    return pa.RecordBatchReader.from_batches(schema, (batch.cast(schema) for batch in reader))
+
+
+def chained_reader(readers):
+    """
+    One RecordBatchReader over an iterator of readers with the same schema. Only the first reader is taken up
+    front, for the schema; the next one is taken once the previous one is read to the end.
+    """
+    first = next(readers)
+    batches = itertools.chain.from_iterable(itertools.chain([first], readers))
+    return pa.RecordBatchReader.from_batches(first.schema, batches)
+
+
+def collect(reader, output):
+    """ `reader` itself for 'batches', otherwise all its rows as a pandas or polars DataFrame """
+    if output == 'batches':
+        return reader
+    if output == 'pandas':
+        return reader.read_pandas()
+    try:
+        import polars
+    except ImportError:
+        raise ImportError("output='polars' requires the polars package") from None
+    return polars.from_arrow(reader.read_all())
+
+
+class OutputSink:
+    """
+    Writes query results to semicolon CSV, Parquet, hive-partitioned Parquet or Arrow IPC.
+
+    Every write() appends the rows of one query in order, so chunked and sharded runs can stream their pieces
+    into a single output. CSV goes through DuckDB's COPY to keep its formatting, the other formats are written
+    from Arrow record batches without an intermediate text encoding.
+    """
+    def __init__(self, path, output_format=None, compression='zstd', row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 partition_by=None, time_column=None):
+        output_format = output_format or ('parquet' if partition_by else infer_format(path))
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}")
+        if partition_by and output_format != 'parquet':
+            raise ValueError("partition_by is only supported for Parquet output")
+        self.path = path
+        self.output_format = output_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        # columns to partition by; 'date' is derived from time_column
+        self.partition_by = list(partition_by or [])
+        self.time_column = time_column
+        self.writer = None
+        self.writes = 0
+        self.rows = 0
+
+    def partition_query(self, query):
+        if 'date' in self.partition_by:
+            return f"SELECT *, CAST({self.time_column} AS DATE) AS date FROM ({query})"
+        return query
+
+    def write(self, con, query):
+        """ Appends the rows of `query` and returns how many were written """
+        rows = self.rows
+        if self.output_format == 'csv':
+            self.write_csv(con, query)
+        elif self.partition_by:
+            # only datasets need it, and it imports pandas
+            import pyarrow.dataset as ds
+            reader = fetch_reader(con, self.partition_query(query), self.row_group_size)
+            if self.writes == 0 and os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            ds.write_dataset(
+                pa.RecordBatchReader.from_batches(reader.schema, self.counted(reader)),
+                self.path,
+                format='parquet',
+                partitioning=self.partition_by,
+                partitioning_flavor='hive',
+                basename_template=f'part-{self.writes}-{{i}}.parquet',
+                existing_data_behavior='overwrite_or_ignore',
+                file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+                max_rows_per_group=self.row_group_size,
+            )
+        else:
+            reader = fetch_reader(con, query, self.row_group_size)
+            if self.writer is None:
+                if self.output_format == 'parquet':
+                    self.writer = pq.ParquetWriter(self.path, reader.schema, compression=self.compression)
+                else:
+                    self.writer = pa.ipc.new_file(str(self.path), reader.schema)
+            for batch in self.counted(reader):
+                if self.output_format == 'parquet':
+                    self.writer.write_batch(batch, row_group_size=self.row_group_size)
+                else:
+                    self.writer.write_batch(batch)
+        self.writes += 1
+        return self.rows - rows
+
+    def counted(self, reader):
+        for batch in reader:
+            self.rows += batch.num_rows
+            yield batch
+
+    def write_csv(self, con, query):
+        if self.writes == 0:
+            self.rows += con.execute(f"COPY ({query}) TO '{self.path}' (HEADER, DELIMITER ';')").fetchone()[0]
+            return
+        with tempfile.TemporaryDirectory() as temp_dir:
+            part_file = os.path.join(temp_dir, 'part.csv')
+            self.rows += con.execute(f"COPY ({query}) TO '{part_file}' (HEADER FALSE, DELIMITER ';')").fetchone()[0]
+            with open(self.path, 'ab') as output, open(part_file, 'rb') as part:
+                shutil.copyfileobj(part, output)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
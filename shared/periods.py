@@ -0,0 +1,34 @@
+"""
+Output periods of a backfill: consecutive periods of a fixed step, or an explicit list of 'start/end' ranges.
+"""
+import duckdb
+from datetime import datetime, timedelta
+
+# periods made from --step end just before the next one starts; TIMESTAMP literals have microsecond precision
+RANGE_END_OFFSET = timedelta(microseconds=1)
+
+
+def parse_timestamp(value):
+    return value if value is None or isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+
+def date_ranges(start, end, step):
+    """ Consecutive (start, end) periods of a DuckDB interval `step` covering [start, end]; ends are inclusive """
+    start, end = parse_timestamp(start), parse_timestamp(end)
+    if end < start:
+        raise ValueError(f"End '{end}' is before start '{start}'")
+    bounds = duckdb.execute(
+        f"SELECT unnest(range(TIMESTAMP '{start}', TIMESTAMP '{end}', INTERVAL '{step}'))"
+    ).fetchall()
+    starts = [bound for bound, in bounds] or [start]
+    return [(first, next_start - RANGE_END_OFFSET) for first, next_start in zip(starts, starts[1:])] + [(starts[-1], end)]
+
+
+def parse_ranges(value):
+    """ 'start/end,start/end' into sorted (start, end) periods; overlapping periods are rejected """
+    ranges = sorted(tuple(parse_timestamp(bound) for bound in item.split('/')) for item in value.split(','))
+    if any(len(bounds) != 2 or bounds[1] < bounds[0] for bounds in ranges):
+        raise ValueError(f"Invalid ranges '{value}', expected 'start/end' pairs with start <= end")
+    if any(later[0] <= earlier[1] for earlier, later in zip(ranges, ranges[1:])):
+        raise ValueError(f"Ranges '{value}' overlap")
+    return ranges
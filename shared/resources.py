@@ -0,0 +1,92 @@
+"""
+DuckDB resource settings of a calculation: memory budget, threads, spill directory and insertion order.
+
+Under a memory budget DuckDB offloads the sorts, joins and windows that do not fit to `temp_directory` and keeps
+going instead of failing. `preserve_insertion_order=False` lets it do so with less memory where the query's
+ORDER BY defines the output order anyway.
+"""
+import os
+import sys
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def configure(con, memory_limit=None, threads=None, temp_directory=None, max_temp_directory_size=None,
+              preserve_insertion_order=True):
+    """ Applies the settings that are given to `con`, keeping DuckDB's defaults for the others """
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+    if threads is not None:
+        con.execute(f"SET threads = {threads}")
+    if temp_directory is not None:
+        con.execute(f"SET temp_directory = '{os.path.abspath(temp_directory)}'")
+    if max_temp_directory_size is not None:
+        con.execute(f"SET max_temp_directory_size = '{max_temp_directory_size}'")
+    if not preserve_insertion_order:
+        con.execute("SET preserve_insertion_order = false")
+
+
+# settings that `configure`, the engines and profiling change on a connection
+SETTINGS = ('memory_limit', 'threads', 'temp_directory', 'max_temp_directory_size', 'preserve_insertion_order',
+            'disabled_optimizers', 'enable_profiling', 'profiling_output')
+
+
+def reset(con):
+    """
+    Returns a connection shared by several runs (a job file's) to the state of a new one: detaches the databases
+    a run attached, drops the tables, views and types it created and resets the settings it changed
+    """
+    attached = con.execute(
+        "SELECT database_name FROM duckdb_databases() WHERE NOT internal AND database_name <> 'memory'"
+    ).fetchall()
+    for (name,) in attached:
+        con.execute(f'DETACH "{name}"')
+    for kind, objects in (('VIEW', 'duckdb_views()'), ('TABLE', 'duckdb_tables()'), ('TYPE', 'duckdb_types()')):
+        column = f'{kind.lower()}_name'
+        for database, schema, name in con.execute(
+            f"SELECT database_name, schema_name, {column} FROM {objects} WHERE NOT internal"
+        ).fetchall():
+            con.execute(f'DROP {kind} IF EXISTS "{database}"."{schema}"."{name}"')
+    for setting in SETTINGS:
+        con.execute(f"RESET {setting}")
+
+
+@contextmanager
+def stored_order(con, preserve_insertion_order):
+    """
+    Keeps the row order for queries without an ORDER BY that read rows already in output order (shards, results
+    computed outside DuckDB), which a connection that relaxes insertion order would be free to shuffle
+    """
+    if preserve_insertion_order:
+        yield
+        return
+    con.execute("SET preserve_insertion_order = true")
+    try:
+        yield
+    finally:
+        con.execute("SET preserve_insertion_order = false")
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process and its finished workers, None where unavailable """
+    if resource is None:
+        return None
+    # ru_maxrss is bytes on macOS and kilobytes elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(usage * unit / 2**20, 1)
+
+
+def describe_peaks(peak_rss, peaks):
+    """ One line for the run summary; `peaks` holds DuckDB's profiled buffer and spill peaks when profiling ran """
+    parts = [f"{peak_rss:.1f} MB resident" if peak_rss is not None else "resident size unavailable"]
+    if 'system_peak_buffer_memory' in peaks:
+        parts.append(f"DuckDB buffers {peaks['system_peak_buffer_memory'] / 2**20:.1f} MB")
+    if 'system_peak_temp_dir_size' in peaks:
+        parts.append(f"spilled {peaks['system_peak_temp_dir_size'] / 2**20:.1f} MB")
+    return f"Peak memory: {', '.join(parts)}"
@@ -0,0 +1,19 @@
+"""
+Splitting of the input into security_id ranges for parallel workers. Each worker reads and writes one contiguous
+key range, so the ranges are balanced on the row counts of the keys rather than on the number of keys.
+"""
+
+
+def key_ranges(key_counts, workers):
+    """ Splits sorted (key, rows) pairs into at most `workers` contiguous (first, last) ranges of similar size """
+    total = sum(rows for _, rows in key_counts)
+    ranges, first, seen = [], None, 0
+    for key, rows in key_counts:
+        first = key if first is None else first
+        seen += rows
+        if len(ranges) < workers - 1 and seen >= total * (len(ranges) + 1) / workers:
+            ranges.append((first, key))
+            first = None
+    if first is not None:
+        ranges.append((first, key_counts[-1][0]))
+    return ranges
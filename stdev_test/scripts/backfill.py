@@ -0,0 +1,196 @@
+"""
+Backfill: rolling statistics for many output periods on one connection. Each period's rows match a separate
+RollingStdev run over that period, but the lookback is read only once: the last rows of the longest window per
+security slide forward from one period to the next.
+
+Usage:
+    python backfill.py --start 2021-11-20 --end '2021-11-23 09:00:00' --step '1 day' \
+        --output-file '../results/backfill/stdev_{start:%Y%m%d}.csv'
+    python backfill.py --ranges '2021-11-20/2021-11-20 23:00:00,2021-11-22/2021-11-22 23:00:00' \
+        --output-file ../results/backfill --partition-by date
+"""
+import argparse
+import duckdb
+import os
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+# output sinks and backfill periods, like the other modules both tasks use, live in shared/
+SHARED_DIR = str(Path(__file__).resolve().parents[2] / 'shared')
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+from output_sinks import DEFAULT_ROW_GROUP_SIZE, OUTPUT_FORMATS  # noqa: E402
+from periods import date_ranges, parse_ranges, parse_timestamp  # noqa: E402
+from rolling_stdev_calculation import FRAMES, LAYOUTS, STATISTICS, RollingStdev, read_bar_intervals  # noqa: E402
+
+
+class Backfill:
+    """
+    Runs one RollingStdev per output period on a shared connection.
+
+    A period whose lookback reaches back into the previous period keeps the previous `trades` rows it needs (the
+    last max(windows) rows per security within its lookback) and reads only the rows after the previous period
+    from the input. Other periods load their lookback like a normal run. `output_file` is either a template with
+    `{start}`, `{end}` or `{index}` fields, giving one file per period, or a single file or partitioned dataset
+    that receives every period in order.
+    """
+    def __init__(self, ranges, output_file, **settings):
+        if not ranges:
+            raise ValueError("No ranges to backfill")
+        if any(settings.get(option) for option in ('state_file', 'run_index', 'cache_file', 'fingerprint_file')):
+            raise ValueError("Backfill keeps its own window state and cannot use a state file, run index, cache "
+                             "or change detection")
+        if settings.get('workers', 1) > 1:
+            raise ValueError("Backfill runs its periods on one connection and cannot use workers")
+        self.ranges = [(parse_timestamp(start), parse_timestamp(end)) for start, end in ranges]
+        if any(later[0] <= earlier[1] for earlier, later in zip(self.ranges, self.ranges[1:])):
+            raise ValueError("Backfill ranges must be sorted and must not overlap")
+        self.output_file = str(output_file)
+        self.per_range = any(f'{{{field}' in self.output_file for field in ('start', 'end', 'index'))
+        first, last = self.ranges[0][0], self.ranges[-1][1]
+        self.calculation = RollingStdev(
+            start_output=str(first), end_output=str(last), output_file=self.output_file, **settings
+        )
+        self.slides = 0
+
+    def range_file(self, index, start, end):
+        return self.output_file.format(index=index, start=start, end=end)
+
+    def load_range(self, index, start, end, previous_end):
+        calculation = self.calculation
+        calculation.start_output, calculation.end_output = str(start), str(end)
+        lookback_start = start - timedelta(days=calculation.lookback_days)
+        # the slide keeps the last rows of a window, bar mode windows span bars that may hold several rows
+        slide = previous_end is not None and lookback_start <= previous_end and not calculation.bucketed
+        with calculation.instrumentation.stage('load_range', calculation.conn, range=index, slide=slide) as stage:
+            if slide:
+                calculation.slide_trades(previous_end)
+                self.slides += 1
+            else:
+                calculation.conn.execute("DROP TABLE IF EXISTS trades")
+                calculation.load_trades()
+            stage.count(calculation.conn, "SELECT COUNT(*) AS input_rows FROM trades")
+
+    def run(self):
+        start_time = time.time()
+        calculation = self.calculation
+        print(f"Backfilling {len(self.ranges)} periods ({calculation.engine} engine)...")
+        shared_sink = None
+        if not self.per_range:
+            shared_sink = calculation.output_sink()
+        try:
+            with calculation.instrumentation.stage('backfill', periods=len(self.ranges), engine=calculation.engine):
+                previous_end = None
+                for index, (start, end) in enumerate(self.ranges):
+                    self.load_range(index, start, end, previous_end)
+                    sink = shared_sink
+                    if sink is None:
+                        calculation.output_file = self.range_file(index, start, end)
+                        os.makedirs(os.path.dirname(os.path.abspath(calculation.output_file)), exist_ok=True)
+                        sink = calculation.output_sink()
+                    if calculation.engine == 'numpy':
+                        calculation.run_and_save_numpy(sink, range=index)
+                    else:
+                        calculation.run_and_save_query(sink, range=index)
+                    if shared_sink is None:
+                        sink.close()
+                        print(f"Saved {start} - {end} to: '{calculation.output_file}'")
+                    previous_end = end
+            if shared_sink is not None:
+                shared_sink.close()
+                print(f"Saved to: '{self.output_file}'")
+            print(f"Execution time: {time.time() - start_time:.3f} seconds ({self.slides} periods reused the lookback)")
+        finally:
+            calculation.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate rolling statistics for many periods in one run")
+
+    script_dir = Path(__file__).parent
+    data_dir = script_dir.parent / "data"
+    result_dir = script_dir.parent / "results"
+
+    parser.add_argument('--input-file', default=data_dir / 'stdev_price_data.parq', type=Path)
+    parser.add_argument('--output-file', default=str(result_dir / 'backfill' / 'rolling_stdev_{start:%Y%m%d_%H%M}.csv'),
+                        help="Output template with {start}, {end} or {index} fields for one file per period, "
+                             "or a single output file or dataset")
+    parser.add_argument('--ranges', default=None, type=parse_ranges,
+                        help="Comma-separated 'start/end' periods, e.g. '2021-11-20/2021-11-20 23:00:00,...'")
+    parser.add_argument('--start', default='2021-11-20 00:00:00')
+    parser.add_argument('--end', default='2021-11-23 09:00:00')
+    parser.add_argument('--step', default='1 day', help="Period length for --start/--end, e.g. '1 day' or '6 hours'")
+    parser.add_argument('--lookback-days', default=7, type=int)
+    parser.add_argument('--rolling-window', default=20, type=int)
+    parser.add_argument('--windows', default=None, type=lambda value: [int(w) for w in value.split(',')],
+                        help="Compute several windows in one pass, e.g. '20,50,168' (overrides --rolling-window)")
+    parser.add_argument('--statistics', default=['stdev'], type=lambda value: value.split(','),
+                        help=f"Statistics per window, any of {','.join(STATISTICS)}")
+    parser.add_argument('--layout', default='wide', choices=LAYOUTS)
+    parser.add_argument('--engine', default='sql', choices=RollingStdev.ENGINES)
+    parser.add_argument('--bar-interval', default='1 hour',
+                        help="Spacing of the snaps a window counts, e.g. '15 minutes'")
+    parser.add_argument('--bar-intervals-file', default=None, type=Path,
+                        help='CSV of security_id,bar_interval overriding --bar-interval per security')
+    parser.add_argument('--snap-tolerance', default=None,
+                        help="Bucket snaps into bars, counting snaps up to this early as on time, e.g. '1 minute'")
+    parser.add_argument('--window-frame', default='rows', choices=FRAMES,
+                        help='rows: only windows with a snap in every bar, range: windows over the bars present')
+    parser.add_argument('--memory-limit', default=None, help="DuckDB memory budget, e.g. '1GB'")
+    parser.add_argument('--threads', default=None, type=int, help='DuckDB threads')
+    parser.add_argument('--temp-directory', default=None, type=Path,
+                        help='Spill to this directory when the memory budget is exceeded')
+    parser.add_argument('--max-temp-directory-size', default=None, help="Cap on spilled data, e.g. '20GB'")
+    parser.add_argument('--no-preserve-insertion-order', dest='preserve_insertion_order', action='store_false',
+                        help='Let DuckDB reorder rows internally to use less memory; the output order is unchanged')
+    parser.add_argument('--output-format', default=None, choices=OUTPUT_FORMATS)
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--row-group-size', default=DEFAULT_ROW_GROUP_SIZE, type=int)
+    parser.add_argument('--partition-by', default=None, type=lambda value: value.split(','),
+                        help="Write one Parquet dataset partitioned by these columns, e.g. 'date'")
+    parser.add_argument('--encode-keys', action='store_true',
+                        help='Partition and sort on security_id ENUM codes instead of strings (sql engine)')
+    parser.add_argument('--dictionary-keys', action='store_true',
+                        help='With --encode-keys, write security_id dictionary-encoded to Parquet and Arrow outputs')
+    parser.add_argument('--metrics-file', default=None, type=Path,
+                        help='Append per-stage timings and row counts to this file as JSON lines')
+
+    args = parser.parse_args()
+
+    try:
+        Backfill(
+            args.ranges or date_ranges(args.start, args.end, args.step),
+            args.output_file,
+            file_path=args.input_file,
+            lookback_days=args.lookback_days,
+            rolling_window=args.rolling_window,
+            windows=args.windows,
+            statistics=args.statistics,
+            layout=args.layout,
+            engine=args.engine,
+            bar_interval=args.bar_interval,
+            bar_intervals=args.bar_intervals_file and read_bar_intervals(args.bar_intervals_file),
+            snap_tolerance=args.snap_tolerance,
+            window_frame=args.window_frame,
+            memory_limit=args.memory_limit,
+            threads=args.threads,
+            temp_directory=args.temp_directory,
+            max_temp_directory_size=args.max_temp_directory_size,
+            preserve_insertion_order=args.preserve_insertion_order,
+            output_format=args.output_format,
+            compression=args.compression,
+            row_group_size=args.row_group_size,
+            partition_by=args.partition_by,
+            encode_keys=args.encode_keys,
+            dictionary_keys=args.dictionary_keys,
+            metrics_file=args.metrics_file
+        ).run()
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        exit(1)
+    except (ValueError, duckdb.Error) as e:
+        print(f"Error: Invalid parameter - {e}")
+        exit(1)
@@ -1,9 +1,18 @@
-from rolling_stdev_calculation import RollingStdev
-from pathlib import Path
 import argparse
+import sys
+from pathlib import Path
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Calculate rolling standard deviation")
+# option defaults, like the other modules both tasks use, live in shared/
+SHARED_DIR = str(Path(__file__).resolve().parents[2] / 'shared')
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+from defaults import DEFAULT_CACHE_LIMIT, DEFAULT_ROW_GROUP_SIZE, OUTPUT_FORMATS  # noqa: E402
+from stdev_options import ENGINES, FRAMES, LAYOUTS, STATISTICS  # noqa: E402
+
+
+def build_parser(prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Calculate rolling standard deviation")
 
     script_dir = Path(__file__).parent
     data_dir = script_dir.parent / "data"
@@ -15,31 +24,122 @@ if __name__ == "__main__":
     parser.add_argument('--end-date', default='2021-11-23 09:00:00')
     parser.add_argument('--lookback-days', default=7, type=int)
     parser.add_argument('--rolling-window', default=20, type=int)
+    parser.add_argument('--windows', default=None, type=lambda value: [int(w) for w in value.split(',')],
+                        help="Compute several windows in one pass, e.g. '20,50,168' (overrides --rolling-window)")
+    parser.add_argument('--statistics', default=['stdev'], type=lambda value: value.split(','),
+                        help=f"Statistics per window, any of {','.join(STATISTICS)}")
+    parser.add_argument('--layout', default='wide', choices=LAYOUTS,
+                        help='wide: columns per window, long: one row per snap_time and window')
+    parser.add_argument('--engine', default='sql', choices=ENGINES)
+    parser.add_argument('--bar-interval', default='1 hour',
+                        help="Spacing of the snaps a window counts, e.g. '15 minutes'")
+    parser.add_argument('--bar-intervals-file', default=None, type=Path,
+                        help='CSV of security_id,bar_interval overriding --bar-interval per security')
+    parser.add_argument('--snap-tolerance', default=None,
+                        help="Bucket snaps into bars, counting snaps up to this early as on time, e.g. '1 minute'")
+    parser.add_argument('--window-frame', default='rows', choices=FRAMES,
+                        help='rows: only windows with a snap in every bar, range: windows over the bars present')
+    parser.add_argument('--state-file', default=None, type=Path,
+                        help='Incremental mode: persisted window state, only rows newer than it are computed')
+    parser.add_argument('--workers', default=1, type=int, help='Worker processes, each computing a security_id range')
+    parser.add_argument('--memory-limit', default=None, help="DuckDB memory budget (per worker), e.g. '1GB'")
+    parser.add_argument('--threads', default=None, type=int, help='DuckDB threads (per worker)')
+    parser.add_argument('--temp-directory', default=None, type=Path,
+                        help='Spill to this directory when the memory budget is exceeded')
+    parser.add_argument('--max-temp-directory-size', default=None, help="Cap on spilled data, e.g. '20GB'")
+    parser.add_argument('--no-preserve-insertion-order', dest='preserve_insertion_order', action='store_false',
+                        help='Let DuckDB reorder rows internally to use less memory; the output order is unchanged')
+    parser.add_argument('--output-format', default=None, choices=OUTPUT_FORMATS,
+                        help='Output format, inferred from the output file extension by default')
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--row-group-size', default=DEFAULT_ROW_GROUP_SIZE, type=int)
+    parser.add_argument('--partition-by', default=None, type=lambda value: value.split(','),
+                        help="Write a Parquet dataset partitioned by these columns, e.g. 'security_id' or 'date'")
+    parser.add_argument('--run-index', action='store_true',
+                        help='Skip segments too short for a window using the run index stored next to the input')
+    parser.add_argument('--cache-file', default=None, type=Path,
+                        help='Keep the loaded trades in this DuckDB file and reuse them while the input is unchanged')
+    parser.add_argument('--cache-limit', default=DEFAULT_CACHE_LIMIT,
+                        help="Evict least recently used cache entries beyond this size, e.g. '2GB'")
+    parser.add_argument('--fingerprint-file', default=None, type=Path,
+                        help='Keep input fingerprints in this file and recompute only the windows changed since the last run')
+    parser.add_argument('--encode-keys', action='store_true',
+                        help='Partition and sort on security_id ENUM codes instead of strings (sql engine)')
+    parser.add_argument('--dictionary-keys', action='store_true',
+                        help='With --encode-keys, write security_id dictionary-encoded to Parquet and Arrow outputs')
+    parser.add_argument('--metrics-file', default=None, type=Path,
+                        help='Append per-stage timings and row counts to this file as JSON lines')
+    parser.add_argument('--profile-dir', default=None, type=Path,
+                        help="Save DuckDB's JSON query profile of every stage to this directory")
 
-    args = parser.parse_args()
+    return parser
 
-    try: 
 
-        calculation = RollingStdev(
-            file_path=args.input_file,
-            start_output=args.start_date,
-            end_output=args.end_date,
-            lookback_days=args.lookback_days,
-            output_file=args.output_file,
-            rolling_window=args.rolling_window
-        )
+def calculate(args, connection=None):
+    """ Runs the calculation of parsed `args`, on `connection` if given; errors are raised """
+    # imported here, so that building the parser (--help, job files) does not import DuckDB, Arrow or NumPy
+    from rolling_stdev_calculation import RollingStdev, read_bar_intervals
+    calculation = RollingStdev(
+        file_path=args.input_file,
+        start_output=args.start_date,
+        end_output=args.end_date,
+        lookback_days=args.lookback_days,
+        output_file=args.output_file,
+        rolling_window=args.rolling_window,
+        engine=args.engine,
+        state_file=args.state_file,
+        workers=args.workers,
+        memory_limit=args.memory_limit,
+        threads=args.threads,
+        temp_directory=args.temp_directory,
+        max_temp_directory_size=args.max_temp_directory_size,
+        preserve_insertion_order=args.preserve_insertion_order,
+        output_format=args.output_format,
+        compression=args.compression,
+        row_group_size=args.row_group_size,
+        partition_by=args.partition_by,
+        encode_keys=args.encode_keys,
+        dictionary_keys=args.dictionary_keys,
+        metrics_file=args.metrics_file,
+        profile_dir=args.profile_dir,
+        windows=args.windows,
+        statistics=args.statistics,
+        layout=args.layout,
+        bar_interval=args.bar_interval,
+        bar_intervals=args.bar_intervals_file and read_bar_intervals(args.bar_intervals_file),
+        snap_tolerance=args.snap_tolerance,
+        window_frame=args.window_frame,
+        run_index=args.run_index,
+        cache_file=args.cache_file,
+        cache_limit=args.cache_limit,
+        fingerprint_file=args.fingerprint_file,
+        connection=connection
+    )
+    calculation.run()
 
-        calculation.run()
-        
+
+def run(args, connection=None):
+    """ Runs the calculation of parsed `args`, on `connection` if given; returns the exit status """
+    try:
+        calculate(args, connection)
     except FileNotFoundError as e:
         print(f"Error: File not found - {e}")
-        exit(1)
+        return 1
     except ValueError as e:
         print(f"Error: Invalid parameter - {e}")
-        exit(1)
+        return 1
     except KeyboardInterrupt:
         print("\nOperation cancelled by user")
-        exit(1)
+        return 1
     except Exception as e:
         print(f"Unexpected error: {e}")
-        exit(1)
\ No newline at end of file
+        return 1
+    return 0
+
+
+def main(argv=None, prog=None):
+    return run(build_parser(prog).parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,320 @@
 import duckdb
+import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import sys
+import tempfile
 import time
+import warnings
+from pathlib import Path
+
+# output sinks, resources, input cache, instrumentation, change detection and sharding are shared with the other task
+SHARED_DIR = str(Path(__file__).resolve().parents[2] / 'shared')
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+from change_detection import ChangeDetector  # noqa: E402
+from input_cache import DEFAULT_CACHE_LIMIT, InputCache  # noqa: E402
+from instrumentation import Instrumentation  # noqa: E402
+from output_sinks import COMPUTE_OUTPUTS, DEFAULT_ROW_GROUP_SIZE, OutputSink, chained_reader, collect, fetch_reader  # noqa: E402
+from resources import configure, describe_peaks, peak_rss_mb, stored_order  # noqa: E402
+from run_index import RunIndex  # noqa: E402
+from sharding import key_ranges  # noqa: E402
+from stdev_options import ENGINES, FRAMES, LAYOUTS, STATISTICS  # noqa: E402
+
+PRICE_COLUMNS = ('bid', 'mid', 'ask')
+NS_IN_HOUR = 3600 * 10**9
+# Prefix sums restart every KERNEL_BLOCK_ROWS rows (or every window, if longer), which bounds the float64 error
+# they accumulate to the rows of at most two blocks. Each partition starts on a fresh block, so its results do not
+# depend on the other partitions in the input (e.g. on how securities are sharded across workers)
+KERNEL_BLOCK_ROWS = 64
+# Windows whose sum of squared deviations falls below this share of their blocks' sum of squares lose too many
+# digits to cancellation and are recomputed with a two-pass formula. Together with the exact handling of flat
+# windows this keeps results close to the exact sample statistics. On well-conditioned data that is within 1e-9
+# relative (or 1e-12 absolute) of DuckDB STDDEV; on large values with a small spread (e.g. 1e6 +- 1e-3) DuckDB's
+# own result loses digits, so the engines can differ by more there, with this kernel the closer to exact
+CANCELLATION_RATIO = 1e-6
+# SQL of every statistic of the multi-window mode over a window `frame`. A flat window has no z-score: its STDDEV
+# is rounding noise rather than an exact zero, so it is recognised by its minimum and maximum, as the numpy kernel
+# recognises flat windows exactly
+STATISTIC_SQL = {
+    'stdev': "STDDEV({col}) OVER {frame}",
+    'variance': "VAR_SAMP({col}) OVER {frame}",
+    'mean': "AVG({col}) OVER {frame}",
+    'min': "MIN({col}) OVER {frame}",
+    'max': "MAX({col}) OVER {frame}",
+    'zscore': "CASE WHEN MIN({col}) OVER {frame} < MAX({col}) OVER {frame} "
+              "THEN ({col} - AVG({col}) OVER {frame}) / STDDEV({col}) OVER {frame} END",
+}
+
+
+def _block_prefix(x, block):
+    """ Prefix sums of each row of `x` (columns x rows) restarting every `block` entries, with the block totals """
+    n_cols, n_rows = x.shape
+    n_blocks = -(-n_rows // block)
+    padded = np.zeros((n_cols, n_blocks, block))
+    padded.reshape(n_cols, -1)[:, :n_rows] = x
+    inclusive = np.cumsum(padded, axis=2)
+    exclusive = np.zeros_like(inclusive)
+    exclusive[:, :, 1:] = inclusive[:, :, :-1]
+    totals = np.repeat(inclusive[:, :, -1], block, axis=1)
+    return inclusive.reshape(n_cols, -1), exclusive.reshape(n_cols, -1), totals, n_rows
+
+
+def _window_sums(prefix, window, block):
+    """
+    Sums over the trailing `window` entries, for entries `window - 1` onwards, from the blocked prefix sums of
+    _block_prefix, together with the totals of the blocks each window spans
+    """
+    inclusive, exclusive, totals, n_rows = prefix
+    n_windows = n_rows - window + 1
+    last = inclusive[:, window - 1:n_rows]
+    first = exclusive[:, :n_windows]
+    first_totals = totals[:, :n_windows]
+    last_totals = totals[:, window - 1:n_rows]
+    offsets = np.arange(n_windows)
+    same_block = offsets // block == (offsets + window - 1) // block
+    sums = np.where(same_block, last - first, (first_totals - first) + last)
+    return sums, np.where(same_block, first_totals, first_totals + last_totals)
+
+
+def _window_extremes(x, window, reduce):
+    """
+    Trailing `window` minimum (reduce=np.minimum) or maximum (np.maximum) of each row of `x`, for entries
+    `window - 1` onwards, in O(1) per entry: running reductions forwards and backwards within chunks of `window`
+    entries cover any window with one value from each side. NaN is skipped; all-NaN windows give +-inf.
+    """
+    fill = np.inf if reduce is np.minimum else -np.inf
+    n_cols, n_rows = x.shape
+    n_chunks = -(-n_rows // window)
+    padded = np.full((n_cols, n_chunks * window), fill)
+    padded[:, :n_rows] = np.where(np.isnan(x), fill, x)
+    chunks = padded.reshape(n_cols, n_chunks, window)
+    forward = reduce.accumulate(chunks, axis=2).reshape(n_cols, -1)
+    backward = reduce.accumulate(chunks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n_cols, -1)
+    return reduce(backward[:, :n_rows - window + 1], forward[:, window - 1:n_rows])
+
+
+def rolling_kernel(partition, times, values, windows, statistics=('stdev',), step=NS_IN_HOUR):
+    """
+    Rolling statistics over the last `window` rows of each partition, for every window and all value columns at
+    once. `statistics` are taken from STATISTICS: sample stdev and variance, mean, min, max, and the z-score of
+    the current value against its window.
+
+    `partition` holds dense integer codes and rows must be sorted by (partition, times). A row gets results
+    only when the row `window - 1` places back is in the same partition and exactly `(window - 1) * step`
+    earlier, which mirrors the LAG check of the SQL query. Window sums come from blocked prefix sums of values
+    centred on the partition mean, so each row costs O(1) regardless of window length, and windows sharing a
+    block size share the prefix sums. Flat windows are detected exactly and only windows hit by cancellation
+    fall back to a two-pass computation. NULLs (NaN) are skipped like the SQL aggregates do.
+
+    Returns {window: (is_contiguous, {statistic: array of shape (rows, columns)})} with NaN marking NULL.
+    """
+    n_rows = len(times)
+    values = np.asarray(values, dtype=np.float64).reshape(n_rows, -1)
+    if not n_rows:
+        return {w: (np.zeros(0, dtype=bool), {s: values.copy() for s in statistics}) for w in windows}
+
+    results = {}
+    blocks = {}
+    for window in sorted(set(windows)):
+        blocks.setdefault(max(KERNEL_BLOCK_ROWS, window), []).append(window)
+    for block, block_windows in blocks.items():
+        # lay every partition out from the start of a block, padding its end with NULL rows
+        starts = np.flatnonzero(np.append(True, partition[1:] != partition[:-1]))
+        lengths = np.diff(np.append(starts, n_rows))
+        aligned_lengths = -(-lengths // block) * block
+        aligned_starts = np.cumsum(aligned_lengths) - aligned_lengths
+        positions = np.arange(n_rows) + np.repeat(aligned_starts - starts, lengths)
+
+        n_aligned = int(aligned_lengths.sum())
+        aligned_partition = np.repeat(np.arange(len(starts)), aligned_lengths)
+        aligned_times = np.zeros(n_aligned, dtype=times.dtype)
+        aligned_times[positions] = times
+        aligned_values = np.full((n_aligned, values.shape[1]), np.nan)
+        aligned_values[positions] = values
+
+        aligned = _aligned_kernel(
+            aligned_partition, aligned_times, aligned_values, block_windows, statistics, step, block
+        )
+        for window, (is_contiguous, stats) in aligned.items():
+            results[window] = (is_contiguous[positions], {s: stats[s][positions] for s in statistics})
+    return results
+
+
+def rolling_stdev_kernel(partition, times, values, window, step=NS_IN_HOUR):
+    """ rolling_kernel for one window and the sample stdev only; returns (is_contiguous, stdevs) """
+    is_contiguous, stats = rolling_kernel(partition, times, values, [window], ('stdev',), step)[window]
+    return is_contiguous, stats['stdev']
+
+
+def bar_kernel(partition, times, values, windows, statistics=('stdev',), bar_lengths=NS_IN_HOUR, tolerance=0,
+               frame='rows'):
+    """
+    rolling_kernel over bars instead of rows. Every row falls in the bar `(times + tolerance) // bar_lengths` (one
+    length for all rows, or one per row), so snaps up to `tolerance` early count for the next bar. The first row
+    of each bar takes part in the windows; later rows of the same bar get no results. A window covers the last
+    `window` bars of its partition and is contiguous when every one of them has a row. `frame` 'rows' gives
+    results only for contiguous windows, 'range' over the rows that are there.
+
+    Rows must be sorted by (partition, times). Missing bars become NULL rows, at most max(windows) - 1 per gap
+    since longer gaps look the same to every window, so the sliding sums of rolling_kernel still cost O(1) per row.
+    """
+    n_rows = len(times)
+    values = np.asarray(values, dtype=np.float64).reshape(n_rows, -1)
+    results = {w: (np.zeros(n_rows, dtype=bool), {s: np.full(values.shape, np.nan) for s in statistics})
+               for w in windows}
+    if not n_rows:
+        return results
+
+    bars = (times + tolerance) // bar_lengths
+    new_partition = np.append(True, partition[1:] != partition[:-1])
+    rows = np.flatnonzero(new_partition | np.append(True, bars[1:] != bars[:-1]))
+    row_partition, row_bars = partition[rows], bars[rows]
+
+    # each partition starts with a full window of missing bars, so no window reaches into the previous one
+    longest = max(windows)
+    starts = np.append(True, row_partition[1:] != row_partition[:-1])
+    missing = np.minimum(np.diff(row_bars, prepend=row_bars[0]) - 1, longest - 1)
+    missing = np.where(starts, longest - 1, missing)
+    slots = np.arange(len(rows)) + np.cumsum(missing)
+    owner = np.repeat(np.arange(len(rows)), missing + 1)
+    before = slots[owner] - np.arange(len(owner))
+    filled_values = np.full((len(owner), values.shape[1]), np.nan)
+    filled_values[slots] = values[rows]
+    filled = rolling_kernel(row_partition[owner], row_bars[owner] - before, filled_values, windows, statistics, step=1)
+
+    present_upto = np.zeros(len(owner) + 1, dtype=np.int64)
+    present_upto[slots + 1] = 1
+    present_upto = np.cumsum(present_upto)
+    for window, (_, stats) in filled.items():
+        is_contiguous, output = results[window]
+        complete = present_upto[slots + 1] - present_upto[slots + 1 - window] == window
+        is_contiguous[rows] = complete
+        for stat, array in stats.items():
+            output[stat][rows] = np.where(complete[:, None], array[slots], np.nan) if frame == 'rows' else array[slots]
+    return results
+
+
+def interval_ns(con, value):
+    """ Length of a DuckDB interval such as '15 minutes' or '1 day' in nanoseconds; months have no fixed length """
+    try:
+        months, length = con.execute(f"""
+            SELECT 12 * datepart('year', i) + datepart('month', i), epoch_ns(TIMESTAMP 'epoch' + i)
+            FROM (SELECT INTERVAL '{str(value).replace("'", "''")}' AS i)
+        """).fetchone()
+    except duckdb.Error as e:
+        raise ValueError(f"Invalid interval '{value}': {e}") from None
+    if months:
+        raise ValueError(f"Interval '{value}' has no fixed length, use days or shorter units")
+    return length
+
+
+def read_bar_intervals(path):
+    """ {security_id: bar_interval} from a CSV file with security_id and bar_interval columns """
+    rows = duckdb.execute(f"SELECT security_id, bar_interval FROM read_csv('{path}', all_varchar = true)").fetchall()
+    return dict(rows)
+
+
+def _aligned_kernel(partition, times, values, windows, statistics, step, block):
+    """ rolling_kernel over rows where every partition starts at a multiple of `block`, block >= every window """
+    n_rows = len(times)
+    columns = np.ascontiguousarray(values.T)
+    present = ~np.isnan(columns)
+    # integer prefix counts are exact: non-null values, and changes from the previous row for flat windows
+    present_upto = np.cumsum(present, axis=1)
+    changed = np.ones(columns.shape, dtype=np.int64)
+    changed[:, 1:] = columns[:, 1:] != columns[:, :-1]
+    changed_upto = np.cumsum(changed, axis=1)
+
+    means = np.stack([
+        np.bincount(partition, np.where(p, c, 0.0)) / np.maximum(np.bincount(partition, p), 1)
+        for c, p in zip(columns, present)
+    ])
+    centred = np.where(present, columns - means[:, partition], 0.0)
+    moments = {'stdev', 'variance', 'zscore'} & set(statistics)
+    sum_prefix = _block_prefix(centred, block)
+    square_prefix = _block_prefix(centred * centred, block) if moments else None
+
+    results = {}
+    for window in windows:
+        is_contiguous = np.zeros(n_rows, dtype=bool)
+        stats = {s: np.full(columns.shape, np.nan) for s in statistics}
+        results[window] = (is_contiguous, stats)
+        if n_rows < window:
+            continue
+
+        # windows end at rows window-1 onwards; everything below is aligned to those rows
+        head, tail = slice(None, n_rows - window + 1), slice(window - 1, None)
+        is_contiguous[tail] = (partition[head] == partition[tail]) & (times[tail] - times[head] == (window - 1) * step)
+        valid = is_contiguous[tail]
+        cnt = present_upto[:, tail] - present_upto[:, head] + present[:, head]
+        s1, _ = _window_sums(sum_prefix, window, block)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = s1 / cnt
+            if 'mean' in statistics:
+                stats['mean'][:, tail] = np.where(valid & (cnt >= 1), offset + means[:, partition[tail]], np.nan)
+            for name, reduce in (('min', np.minimum), ('max', np.maximum)):
+                if name in statistics:
+                    stats[name][:, tail] = np.where(valid & (cnt >= 1), _window_extremes(columns, window, reduce), np.nan)
+        if not moments:
+            continue
+
+        flat = changed_upto[:, tail] == changed_upto[:, head]
+        s2, scale = _window_sums(square_prefix, window, block)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m2 = np.where(flat, 0.0, s2 - s1 * s1 / cnt)
+            var = np.where(valid & (cnt >= 2), np.maximum(m2, 0.0) / (cnt - 1), np.nan)
+
+        cancelled = (m2 < CANCELLATION_RATIO * scale) & ~flat & (cnt >= 2)
+        unstable = np.flatnonzero(valid & cancelled.any(axis=0))
+        if len(unstable):
+            frames = unstable[:, None] + np.arange(window)
+            # shifting by the current value keeps the two-pass sums small
+            shift = np.nan_to_num(values[unstable + window - 1])[:, None, :]
+            with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+                # nanvar warns about columns with fewer than 2 values, which are set to NULL below
+                warnings.simplefilter('ignore', RuntimeWarning)
+                exact = np.nanvar(values[frames] - shift, axis=1, ddof=1)
+            var[:, unstable] = np.where(cnt[:, unstable] >= 2, exact.T, np.nan)
+
+        std = np.sqrt(var)
+        if 'variance' in statistics:
+            stats['variance'][:, tail] = var
+        if 'stdev' in statistics:
+            stats['stdev'][:, tail] = std
+        if 'zscore' in statistics:
+            # value minus window mean, both taken relative to the partition mean; flat windows have no z-score
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats['zscore'][:, tail] = np.where(
+                    present[:, tail] & (std > 0), (centred[:, tail] - offset) / std, np.nan
+                )
+
+    return {w: (is_contiguous, {s: a.T for s, a in stats.items()}) for w, (is_contiguous, stats) in results.items()}
+
+
+def _run_shard(settings, key_range, output_file, run_id, shard):
+    """ Worker process entry point: computes the rows of one security_id range on its own connection """
+    calculation = RollingStdev(output_file=output_file, output_format='parquet', **settings)
+    calculation.key_range = key_range
+    calculation.instrumentation.run_id = run_id
+    calculation.instrumentation.fields = {'shard': shard}
+    calculation.prepare_data()
+    if calculation.engine == 'numpy':
+        calculation.run_and_save_numpy()
+    else:
+        calculation.run_and_save_query()
+    calculation.conn.close()
 
 
 class RollingStdev:
     """Calculates hourly rolling stdevs for bid, mid, and ask prices with time-contiguous checks"""
+    # 'sql' runs DuckDB window frames, 'numpy' a single-pass sliding-sum kernel (see CANCELLATION_RATIO for how
+    # closely they agree)
+    ENGINES = ENGINES
+
     def __init__(
         self,
         file_path='data/stdev_price_data.parq',
@@ -12,108 +323,841 @@ class RollingStdev:
         lookback_days=7,
         output_file='rolling_stdev_results.csv',
         rolling_window=20,
+        engine='sql',
+        state_file=None,
+        workers=1,
+        memory_limit=None,
+        threads=None,
+        temp_directory=None,
+        max_temp_directory_size=None,
+        preserve_insertion_order=True,
+        output_format=None,
+        compression='zstd',
+        row_group_size=DEFAULT_ROW_GROUP_SIZE,
+        partition_by=None,
+        metrics_file=None,
+        metrics_callback=None,
+        profile_dir=None,
+        windows=None,
+        statistics=('stdev',),
+        layout='wide',
+        bar_interval='1 hour',
+        bar_intervals=None,
+        snap_tolerance=None,
+        window_frame='rows',
+        run_index=False,
+        cache_file=None,
+        cache_limit=DEFAULT_CACHE_LIMIT,
+        encode_keys=False,
+        dictionary_keys=False,
+        fingerprint_file=None,
+        connection=None,
     ):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {self.ENGINES}")
+        if state_file is not None and engine != 'numpy':
+            raise ValueError("Incremental mode (state_file) requires the 'numpy' engine")
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        if workers > 1 and state_file is not None:
+            raise ValueError("Incremental (state_file) and parallel (workers) modes cannot be combined")
+        if run_index and state_file is not None:
+            raise ValueError("Incremental mode (state_file) needs every row in its window state, not a run index")
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown or not statistics:
+            raise ValueError(f"Unknown statistics {sorted(unknown)}, expected some of {STATISTICS}")
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout '{layout}', expected one of {LAYOUTS}")
+        if any(window < 1 for window in windows or [rolling_window]):
+            raise ValueError("Rolling windows must be at least 1 row long")
+        if window_frame not in FRAMES:
+            raise ValueError(f"Unknown window frame '{window_frame}', expected one of {FRAMES}")
+        bucketed = snap_tolerance is not None or window_frame == 'range' or bool(bar_intervals)
+        if bucketed and (state_file is not None or run_index):
+            raise ValueError("Bar mode (snap_tolerance, window_frame='range', bar_intervals) cannot use a state file "
+                             "or run index, which keep whole rows rather than bars")
+        if (encode_keys or dictionary_keys) and (engine != 'sql' or cache_file is not None):
+            raise ValueError("Key encoding (encode_keys, dictionary_keys) needs the 'sql' engine and no cache")
+        if dictionary_keys and not encode_keys:
+            raise ValueError("dictionary_keys writes the encoded keys, it needs encode_keys")
+        if fingerprint_file is not None and (state_file is not None or workers > 1 or run_index or bucketed
+                                             or partition_by or dictionary_keys):
+            raise ValueError("Change detection (fingerprint_file) merges hourly partitions into a single output file, "
+                             "it cannot be combined with state_file, workers, run_index, bar mode, partition_by or "
+                             "dictionary_keys")
         self.file_path = file_path
         self.start_output = start_output
         self.end_output = end_output
         self.lookback_days = lookback_days
         self.output_file = output_file
         self.rolling_window = rolling_window
-        self.conn = duckdb.connect()
+        # Multi-window mode: every window and statistic comes from the same sorted scan
+        self.windows = sorted(set(windows or [rolling_window]))
+        self.statistics = [s for s in STATISTICS if s in statistics]
+        self.layout = layout
+        # Bars: windows count bars of bar_interval (per security with bar_intervals). By default a window is the last
+        # rows, contiguous when they are exactly one bar apart. Bar mode buckets snap_times into bars instead,
+        # counting snaps up to snap_tolerance early for the next bar, and frames windows by bars ('rows' or 'range')
+        self.bar_interval = bar_interval
+        self.bar_intervals = dict(bar_intervals or {})
+        self.snap_tolerance = snap_tolerance
+        self.window_frame = window_frame
+        self.bucketed = bucketed
+        # Run index: only rows of runs long enough for a window are loaded, see run_index.py
+        self.use_run_index = run_index
+        self.run_index = None
+        # Persistent cache of the loaded trades, reused while the input file is unchanged
+        self.cache = InputCache(cache_file, cache_limit) if cache_file is not None else None
+        # Key encoding: security_id is loaded as the ENUM security_key of the sorted ids in the input, so windows
+        # partition and sort on integer codes. Output decodes to VARCHAR, unless dictionary_keys keeps the codes (a
+        # dictionary column in Parquet and Arrow output)
+        self.encode_keys = encode_keys
+        self.dictionary_keys = dictionary_keys
+        # Change detection: input fingerprints per (security_id, hour) of the previous run; only the windows that
+        # can see a changed hour are recomputed and merged into the existing output
+        self.fingerprint_file = fingerprint_file
+        self.engine = engine
+        # Output sink settings: format (inferred from the extension by default), Parquet options and partitioning
+        self.output_format = output_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.partition_by = partition_by
+        # Incremental mode: the last rows of the longest window per security are kept in state_file between runs
+        self.state_file = state_file
+        self.last_snaps = None
+        self.pending_state = None
+        # Parallel mode: security_id ranges are computed in worker processes, each with its own connection
+        self.workers = workers
+        # DuckDB resources (per worker): memory budget, threads and where, and how much, to spill beyond it
+        self.memory_limit = memory_limit
+        self.threads = threads
+        self.temp_directory = temp_directory
+        self.max_temp_directory_size = max_temp_directory_size
+        # every SQL result is written with an ORDER BY, so DuckDB may drop insertion order to save memory
+        self.preserve_insertion_order = preserve_insertion_order
+        # (first, last, with_nulls) security_id range this instance loads; None loads every security
+        self.key_range = None
+        # Per-stage timings and row counts as JSON lines and/or callback events, DuckDB profiles in profile_dir
+        self.metrics_file = metrics_file
+        self.profile_dir = profile_dir
+        self.instrumentation = Instrumentation('RollingStdev', metrics_file, metrics_callback, profile_dir)
+        # a given `connection` (e.g. shared by the jobs of a job file) is used instead of a new one and left open
+        self.conn = duckdb.connect() if connection is None else connection
+        self.owns_connection = connection is None
+        configure(self.conn, memory_limit, threads, temp_directory, max_temp_directory_size, preserve_insertion_order)
+        self.bar_ns = interval_ns(self.conn, bar_interval)
+        self.bar_lengths = {security: interval_ns(self.conn, interval) for security, interval in self.bar_intervals.items()}
+        self.tolerance_ns = interval_ns(self.conn, snap_tolerance) if snap_tolerance is not None else 0
+        if self.tolerance_ns < 0 or min([self.bar_ns, *self.bar_lengths.values()]) <= self.tolerance_ns:
+            raise ValueError("Bar intervals must be longer than the snap tolerance, which cannot be negative")
+        if self.bar_lengths:
+            self.conn.register('bar_lengths', pa.table({
+                'security_id': pa.array(list(self.bar_lengths), type=pa.string()),
+                'bar_ns': pa.array(list(self.bar_lengths.values()), type=pa.int64()),
+            }))
+
+    def output_sink(self):
+        return OutputSink(
+            self.output_file,
+            output_format=self.output_format,
+            compression=self.compression,
+            row_group_size=self.row_group_size,
+            partition_by=self.partition_by,
+            time_column='snap_time',
+        )
+
+    def key_filter(self):
+        """ SQL predicate restricting security_id to this instance's shard; NULL ids belong to the last shard """
+        if self.key_range is None:
+            return "TRUE"
+        first, last, with_nulls = self.key_range
+        first, last = first.replace("'", "''"), last.replace("'", "''")
+        in_range = f"(security_id >= '{first}' AND security_id <= '{last}')"
+        return f"({in_range} OR security_id IS NULL)" if with_nulls else in_range
 
     def prepare_data(self):
+        incremental = self.state_file is not None and Path(self.state_file).exists()
+        with self.instrumentation.stage('prepare_data', self.conn, incremental=incremental) as stage:
+            if incremental:
+                self.prepare_incremental()
+            elif self.use_run_index:
+                self.load_run_index()
+                self.load_trades()
+            else:
+                self.load_trades()
+            stage.record(**self.cache.stats() if self.cache is not None else {})
+            stage.count(self.conn, """
+                SELECT COUNT(*) AS input_rows, COUNT(DISTINCT security_id) AS securities FROM trades
+            """)
+
+    def load_run_index(self):
+        with self.instrumentation.stage('load_run_index', self.conn) as stage:
+            index, rebuilt = RunIndex.load(self.file_path, self.conn, step=self.bar_ns)
+            stage.record(runs=len(index), rebuilt=rebuilt)
+        if not index.regular:
+            print(f"Run index: snap_times are not on a grid of {self.bar_interval}, loading every row")
+            return
+        self.run_index = index
+        self.conn.register('runs', index.runs)
+
+    def load_trades(self):
         """ Includes lookback window to ensure we have enough data points for initial rolling windows """
-        self.conn.execute(f"""
-            CREATE TEMP TABLE trades AS
-            SELECT * FROM read_parquet('{self.file_path}')
+        self.create_key_type()
+        if self.run_index is not None:
+            return self.load_indexed_trades()
+        self.create_input_table('trades', f"""
+            SELECT {self.encoded_columns()} FROM read_parquet('{self.file_path}')
             WHERE snap_time BETWEEN TIMESTAMP '{self.start_output}' - INTERVAL '{self.lookback_days} days' 
                                 AND TIMESTAMP '{self.end_output}'
+              AND {self.key_filter()}
             ORDER BY security_id, snap_time
+        """, [self.file_path])
+
+    def load_indexed_trades(self):
+        """
+        Loads only the rows that can be in a full window: those of runs with at least min(windows) rows, from
+        max(windows) - 1 steps before start_output (or the lookback, if shorter). Output rows of shorter runs
+        can never be contiguous; they go to `idle_rows` and are emitted without computing any window.
+        """
+        start, end = f"TIMESTAMP '{self.start_output}'", f"TIMESTAMP '{self.end_output}'"
+        span = f"INTERVAL '{(max(self.windows) - 1) * self.bar_ns // 1000} microseconds'"
+        lower = f"GREATEST({start} - INTERVAL '{self.lookback_days} days', {start} - {span})"
+        in_period = f"run_end >= {start} AND run_start <= {end} AND {self.key_filter()}"
+        self.create_input_table('trades', f"""
+            SELECT {self.encoded_columns('t.')} FROM read_parquet('{self.file_path}') t
+            SEMI JOIN (
+                SELECT security_id, run_start, run_end FROM runs WHERE rows >= {min(self.windows)} AND {in_period}
+            ) r
+            ON t.security_id IS NOT DISTINCT FROM r.security_id AND t.snap_time BETWEEN r.run_start AND r.run_end
+            WHERE t.snap_time BETWEEN {lower} AND {end}
+              AND {self.key_filter()}
+            ORDER BY security_id, snap_time
+        """, [self.file_path])
+        # rows of a regular run are exactly run_start + k steps, so idle rows come from the index alone
+        start_ns, end_ns = self.conn.execute(f"SELECT epoch_ns({start}), epoch_ns({end})").fetchone()
+        self.create_input_table('idle_rows', f"""
+            SELECT security_id, CAST(make_timestamp_ns(epoch_ns(run_start) + k * {self.bar_ns}) AS {self.time_type()}) AS snap_time
+            FROM (
+                SELECT security_id, run_start, UNNEST(range(
+                    GREATEST(0, CEIL(({start_ns} - epoch_ns(run_start)) / {self.bar_ns})::BIGINT),
+                    LEAST(rows - 1, FLOOR(({end_ns} - epoch_ns(run_start)) / {self.bar_ns})::BIGINT) + 1
+                )) AS k
+                FROM runs WHERE rows < {min(self.windows)} AND {in_period}
+            )
+        """, [self.file_path])
+
+    def create_key_type(self):
+        """
+        Key encoding: the ENUM security_key of the distinct security_ids of the input (within this shard), sorted so
+        that ordering by code is ordering by security_id. It covers every period, so backfill periods share it.
+        """
+        if not self.encode_keys:
+            return
+        self.conn.execute(f"""
+            CREATE TYPE IF NOT EXISTS security_key AS ENUM (
+                SELECT DISTINCT security_id FROM read_parquet('{self.file_path}')
+                WHERE security_id IS NOT NULL AND {self.key_filter()}
+                ORDER BY security_id
+            )
         """)
 
-    def run_and_save_query(self):
-        n = self.rolling_window
-        n_minus_1 = n - 1
-        seconds_in_hour = 3600
-        total_seconds = n_minus_1 * seconds_in_hour  # Enforces hourly intervals for contiguous window
+    def encoded_key(self, column='security_id'):
+        """ security_id of a file as loaded: its security_key code when keys are encoded """
+        return f"CAST({column} AS security_key)" if self.encode_keys else column
+
+    def encoded_columns(self, prefix=''):
+        """ Every input column, with security_id encoded when keys are encoded """
+        if not self.encode_keys:
+            return f"{prefix}*"
+        return f"{prefix}* REPLACE ({self.encoded_key(f'{prefix}security_id')} AS security_id)"
+
+    def output_columns(self):
+        """ Output columns of the result relation `result`: security_id decoded unless dictionary_keys is set """
+        if self.encode_keys and not self.dictionary_keys:
+            return "* REPLACE (CAST(result.security_id AS VARCHAR) AS security_id)"
+        return "*"
+
+    def create_input_table(self, name, query, sources):
+        """ Creates a temp table from `query`, or a view on its cached copy when a cache file is configured """
+        if self.cache is not None and self.cache.attach(self.conn):
+            self.cache.table(self.conn, name, query, sources, temp=True)
+        else:
+            self.conn.execute(f"CREATE TEMP TABLE {name} AS {query}")
+
+    def time_type(self):
+        return self.conn.execute(f"""
+            SELECT column_type FROM (DESCRIBE SELECT snap_time FROM read_parquet('{self.file_path}'))
+        """).fetchone()[0]
+
+    def idle_select(self, window=None):
+        """ Output rows of idle_rows: never contiguous, so every statistic is NULL """
+        if window is not None:
+            columns = [f"{window} AS rolling_window", "FALSE AS is_contiguous"]
+            columns += [f"NULL AS {col}_{stat}" for stat in self.statistics for col in PRICE_COLUMNS]
+        else:
+            columns = []
+            for n in self.windows:
+                columns.append(f"FALSE AS is_contiguous{self.suffix(n)}")
+                columns += [f"NULL AS {col}_{stat}{self.suffix(n)}" for stat in self.statistics for col in PRICE_COLUMNS]
+        return f"SELECT {self.encoded_key()} AS security_id, snap_time, {', '.join(columns)} FROM idle_rows"
+
+    def prepare_incremental(self):
+        """
+        Seeds `trades` with the persisted windows and only the rows newer than the last processed snap_time of their
+        security, the newest one it has in the state. Securities advance independently, so a snap delivered late
+        for one security is still read after another has moved past it. New securities load their lookback.
+        The per-security bound cannot reach the parquet scan, so the scan also gets the earliest of them as a
+        literal: rows before the oldest last processed snap_time and the lookback of start_output are never read.
+        """
+        state = pq.read_table(self.state_file)
+        metadata = state.schema.metadata or {}
+        window = int(metadata.get(b'rolling_window', -1))
+        if window != max(self.windows):
+            raise ValueError(
+                f"State file '{self.state_file}' holds windows of {window} rows, expected {max(self.windows)}"
+            )
+
+        self.conn.register('window_state', state)
+        self.last_snaps = self.conn.execute("""
+            SELECT security_id, epoch_ns(max(snap_time)) AS last_snap FROM window_state GROUP BY security_id
+        """).arrow()
+        self.conn.register('last_snaps', self.last_snaps)
+        # floored to microseconds, the precision of TIMESTAMP literals
+        scan_start = self.conn.execute(f"""
+            SELECT CAST(make_timestamp(least(
+                min(last_snap), epoch_ns(TIMESTAMP '{self.start_output}' - INTERVAL '{self.lookback_days} days')
+            ) // 1000) AS VARCHAR) FROM last_snaps
+        """).fetchone()[0]
+        self.conn.execute(f"""
+            CREATE TEMP TABLE trades AS
+            SELECT security_id, snap_time, {', '.join(PRICE_COLUMNS)} FROM window_state
+            UNION ALL
+            SELECT t.security_id, t.snap_time, {', '.join(f't.{col}' for col in PRICE_COLUMNS)}
+            FROM read_parquet('{self.file_path}') t
+            LEFT JOIN last_snaps s ON t.security_id IS NOT DISTINCT FROM s.security_id
+            WHERE t.snap_time >= TIMESTAMP '{scan_start}' AND t.snap_time <= TIMESTAMP '{self.end_output}'
+              AND CASE WHEN s.last_snap IS NULL
+                       THEN t.snap_time >= TIMESTAMP '{self.start_output}' - INTERVAL '{self.lookback_days} days'
+                       ELSE t.snap_time > make_timestamp_ns(s.last_snap) END
+            ORDER BY security_id, snap_time
+        """)
+        self.conn.unregister('window_state')
+        self.conn.unregister('last_snaps')
 
-        query = f"""
-        COPY (
-            WITH ordered_with_lag AS (
-                SELECT 
+    def slide_trades(self, previous_end):
+        """
+        Backfill: replaces `trades` of a run that ended at `previous_end` with the next period's input, keeping the
+        last rows of the longest window per security (within this period's lookback) instead of reading them again
+        """
+        self.conn.execute(f"""
+            CREATE OR REPLACE TEMP TABLE window_state AS
+            SELECT security_id, snap_time, {', '.join(PRICE_COLUMNS)} FROM trades
+            WHERE snap_time >= TIMESTAMP '{self.start_output}' - INTERVAL '{self.lookback_days} days'
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY security_id ORDER BY snap_time DESC) <= {max(self.windows)}
+        """)
+        self.conn.execute(f"""
+            CREATE OR REPLACE TEMP TABLE trades AS
+            SELECT * FROM window_state
+            UNION ALL
+            SELECT {self.encoded_key()} AS security_id, snap_time, {', '.join(PRICE_COLUMNS)}
+            FROM read_parquet('{self.file_path}')
+            WHERE snap_time > TIMESTAMP '{previous_end}' AND snap_time <= TIMESTAMP '{self.end_output}'
+              AND {self.key_filter()}
+            ORDER BY security_id, snap_time
+        """)
+        self.conn.execute("DROP TABLE window_state")
+
+    def window_state(self, trades, partition, times):
+        """ Last rows of the longest window per security; the newest is its last processed snap_time """
+        keep = np.zeros(len(times), dtype=bool)
+        if len(times):
+            last_row = np.flatnonzero(np.append(partition[1:] != partition[:-1], True))
+            partition_end = np.repeat(last_row, np.diff(np.append(-1, last_row)))
+            keep = np.arange(len(times)) > partition_end - max(self.windows)
+        state = trades.select(['security_id', 'snap_time', *PRICE_COLUMNS]).filter(pa.array(keep))
+        return state.replace_schema_metadata({'rolling_window': str(max(self.windows))})
+
+    def row_last_snaps(self, security_ids):
+        """ Last processed snap_time in ns of every row's security in the state; int64 min for new securities """
+        last_snaps = self.last_snaps['last_snap'].to_numpy()
+        match = pc.index_in(security_ids.cast(pa.string()), value_set=self.last_snaps['security_id'].cast(pa.string()))
+        # unmatched rows index -1, the default appended last
+        last_snaps = np.append(last_snaps, np.iinfo(np.int64).min)
+        return last_snaps[match.fill_null(-1).to_numpy(zero_copy_only=False)]
+
+    def save_state(self, state):
+        # write next to the target and swap in, so an interrupted run never leaves a truncated state file
+        tmp_file = f"{self.state_file}.tmp"
+        pq.write_table(state, tmp_file)
+        os.replace(tmp_file, self.state_file)
+
+    def result_readers(self, batch_size):
+        """
+        Yields RecordBatchReaders over the pieces of the result in output order (one, or one per shard), in the
+        mode of this instance. A shard is only read once the reader before it has been read to the end.
+        """
+        if self.workers > 1:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                shard_queries = self.run_shards(temp_dir)
+                with stored_order(self.conn, self.preserve_insertion_order):
+                    for query in shard_queries:
+                        yield fetch_reader(self.conn, query, batch_size)
+            return
+        self.prepare_data()
+        if self.engine == 'sql':
+            yield fetch_reader(self.conn, self.stdev_query(), batch_size)
+            return
+        yield self.compute_numpy().to_reader(max_chunksize=batch_size)
+        # state only moves forward once every row computed from it has been read
+        if self.state_file is not None:
+            with self.instrumentation.stage('save_state') as stage:
+                self.save_state(self.pending_state)
+                stage.record(state_rows=self.pending_state.num_rows)
+
+    def compute(self, batch_size=DEFAULT_ROW_GROUP_SIZE, output='batches'):
+        """
+        Computes the rolling stdevs in process, in the same mode and order as run(), without writing a file.
+
+        Returns a RecordBatchReader of at most `batch_size` rows per batch, or with `output` 'pandas' or 'polars'
+        all rows as one DataFrame. The inputs and the first piece of the result are prepared up front; rows are
+        fetched from DuckDB as the reader is consumed, and the connection must not run other queries until then.
+        A connection opened by this instance is closed once the reader is read to the end or released; a given
+        `connection` is left open.
+        """
+        if output not in COMPUTE_OUTPUTS:
+            raise ValueError(f"Unknown output '{output}', expected one of {COMPUTE_OUTPUTS}")
+        return collect(chained_reader(self.closing_readers(batch_size)), output)
+
+    def closing_readers(self, batch_size):
+        """ result_readers, closing the connection this instance opened after the last of them """
+        try:
+            yield from self.result_readers(batch_size)
+        finally:
+            if self.owns_connection:
+                self.conn.close()
+
+    def to_arrow(self):
+        """ Computes the rolling stdevs in process and returns them as an Arrow table, without writing a file """
+        return self.compute().read_all()
+
+    def to_record_batches(self, batch_size=DEFAULT_ROW_GROUP_SIZE):
+        """ Like to_arrow, but returns a RecordBatchReader; see compute() """
+        return self.compute(batch_size)
+
+    def run_shards(self, temp_dir):
+        """
+        Splits the sorted security_ids into contiguous ranges of similar row counts and computes each range in a
+        worker process, writing its shard to `temp_dir`. Returns the queries reading the shards back in key order,
+        which together give the same rows as the single query.
+        """
+        if self.use_run_index:
+            # built once here, so the workers only read it
+            self.load_run_index()
+        with self.instrumentation.stage('plan_shards', self.conn) as stage:
+            key_counts = self.conn.execute(f"""
+                SELECT security_id, COUNT(*)
+                FROM read_parquet('{self.file_path}')
+                WHERE snap_time BETWEEN TIMESTAMP '{self.start_output}' - INTERVAL '{self.lookback_days} days'
+                                    AND TIMESTAMP '{self.end_output}'
+                  AND security_id IS NOT NULL
+                GROUP BY security_id
+                ORDER BY security_id
+            """).fetchall()
+            ranges = key_ranges(key_counts, self.workers) or [None]
+            stage.record(keys=len(key_counts), shards=len(ranges))
+
+        settings = {
+            'file_path': self.file_path,
+            'start_output': self.start_output,
+            'end_output': self.end_output,
+            'lookback_days': self.lookback_days,
+            'rolling_window': self.rolling_window,
+            'windows': self.windows,
+            'statistics': self.statistics,
+            'layout': self.layout,
+            'bar_interval': self.bar_interval,
+            'bar_intervals': self.bar_intervals,
+            'snap_tolerance': self.snap_tolerance,
+            'window_frame': self.window_frame,
+            'run_index': self.use_run_index,
+            'engine': self.engine,
+            'encode_keys': self.encode_keys,
+            'memory_limit': self.memory_limit,
+            'threads': self.threads or max(1, (os.cpu_count() or 1) // len(ranges)),
+            'max_temp_directory_size': self.max_temp_directory_size,
+            'preserve_insertion_order': self.preserve_insertion_order,
+            'metrics_file': self.metrics_file,
+            'profile_dir': self.profile_dir,
+        }
+        shard_files = [os.path.join(temp_dir, f'shard_{i}.parquet') for i in range(len(ranges))]
+        # each worker spills to its own directory, DuckDB's temp file names are only unique within a process
+        spill_dirs = [os.path.join(self.temp_directory or temp_dir, f'spill_{i}') for i in range(len(ranges))]
+        # imported here, like every import only some runs need, to keep the startup of other runs short
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn, not fork: the parent already holds a DuckDB connection and its threads
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+            futures = [
+                pool.submit(_run_shard, dict(settings, temp_directory=spill_dirs[i]),
+                            key_range and (*key_range, i == len(ranges) - 1), shard_file,
+                            self.instrumentation.run_id, i)
+                for i, (key_range, shard_file) in enumerate(zip(ranges, shard_files))
+            ]
+            for future in futures:
+                future.result()
+
+        # shards hold decoded keys; with dictionary_keys they are encoded again with one ENUM for all shards
+        self.create_key_type()
+        columns = self.encoded_columns() if self.dictionary_keys else "*"
+        return [f"SELECT {columns} FROM read_parquet('{shard_file}')" for shard_file in shard_files]
+
+    def run_parallel(self):
+        """ Computes the shards of run_shards in worker processes and writes them out in key order """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            shard_queries = self.run_shards(temp_dir)
+            with self.instrumentation.stage('merge_shards', self.conn) as stage:
+                sink = self.output_sink()
+                with stored_order(self.conn, self.preserve_insertion_order):
+                    for query in shard_queries:
+                        sink.write(self.conn, query)
+                sink.close()
+                stage.record(output_rows=sink.rows)
+
+    def suffix(self, window):
+        """ Output column suffix of a window: none for a single window or the long layout """
+        return '' if self.layout == 'long' or len(self.windows) == 1 else f'_{window}'
+
+    def stat_columns(self, window):
+        """ final_calc columns of a window, aliased to their output names """
+        return [f'{col}_{stat}_{window} AS {col}_{stat}{self.suffix(window)}'
+                for stat in self.statistics for col in PRICE_COLUMNS]
+
+    def row_windows(self):
+        """
+        Default windows: the last rows, computed only when they are exactly one bar apart. Returns the
+        ordered_with_lag CTE and the final_calc columns.
+        """
+        bar_seconds = self.bar_ns // 10**9 if self.bar_ns % 10**9 == 0 else self.bar_ns / 10**9
+        lags = ''.join(
+            f"""
+                    LAG(snap_time, {n - 1}) OVER (PARTITION BY security_id ORDER BY snap_time) AS lag_snap_time_{n},"""
+            for n in self.windows
+        )
+        calcs = []
+        for n in self.windows:
+            # Only calculate if window is full and time-contiguous (e.g., no missing hours)
+            contiguous = f"rn >= {n} AND EXTRACT(EPOCH FROM (snap_time - lag_snap_time_{n})) = {(n - 1) * bar_seconds}"
+            frame = f"(PARTITION BY security_id ORDER BY snap_time ROWS BETWEEN {n - 1} PRECEDING AND CURRENT ROW)"
+            calcs.append(f"""
+                    CASE WHEN {contiguous} THEN TRUE ELSE FALSE END AS is_contiguous_{n}""")
+            for stat in self.statistics:
+                for col in PRICE_COLUMNS:
+                    calcs.append(f"""
+                    CASE
+                        WHEN {contiguous}
+                        THEN {STATISTIC_SQL[stat].format(col=col, frame=frame)}
+                        ELSE NULL
+                    END AS {col}_{stat}_{n}""")
+        ordered = f"""ordered_with_lag AS (
+                SELECT
                     security_id,
                     snap_time,
                     bid,
                     mid,
-                    ask,
-                    ROW_NUMBER() OVER (PARTITION BY security_id ORDER BY snap_time) AS rn,
-                    LAG(snap_time, {n_minus_1}) OVER (PARTITION BY security_id ORDER BY snap_time) AS lag_snap_time
+                    ask,{lags}
+                    ROW_NUMBER() OVER (PARTITION BY security_id ORDER BY snap_time) AS rn
                 FROM trades
+            )"""
+        return ordered, calcs
+
+    def bar_windows(self):
+        """
+        Bar mode windows, see bar_kernel: each snap_time is bucketed into its bar number with one integer division.
+        Later snaps of a bar get no bar number, which sorts them after the others and keeps them out of every
+        frame. All windows order by the bar number, so they share one sort: ROWS frames for 'rows', which are the
+        last n bars when the LAG check finds them n - 1 bars apart, RANGE frames over the last n bar numbers for
+        'range'. Returns the ordered_with_lag CTE and the final_calc columns.
+        """
+        bar_ns = str(self.bar_ns)
+        joined = ""
+        if self.bar_lengths:
+            bar_ns = f"COALESCE(lengths.bar_ns, {self.bar_ns})"
+            joined = " LEFT JOIN bar_lengths lengths ON trades.security_id = lengths.security_id"
+        calcs = []
+        for n in self.windows:
+            frame = f"(PARTITION BY security_id ORDER BY bar {self.window_frame.upper()} BETWEEN {n - 1} PRECEDING AND CURRENT ROW)"
+            contiguous = f"bar - LAG(bar, {n - 1}) OVER (PARTITION BY security_id ORDER BY bar) = {n - 1}"
+            computed = contiguous if self.window_frame == 'rows' else "bar IS NOT NULL"
+            calcs.append(f"""
+                    CASE WHEN {contiguous} THEN TRUE ELSE FALSE END AS is_contiguous_{n}""")
+            for stat in self.statistics:
+                for col in PRICE_COLUMNS:
+                    calcs.append(f"""
+                    CASE
+                        WHEN {computed}
+                        THEN {STATISTIC_SQL[stat].format(col=col, frame=frame)}
+                        ELSE NULL
+                    END AS {col}_{stat}_{n}""")
+        ordered = f"""bars AS (
+                SELECT
+                    trades.security_id,
+                    trades.snap_time,
+                    bid,
+                    mid,
+                    ask,
+                    epoch_ns(trades.snap_time) + {self.tolerance_ns} AS shifted,
+                    {bar_ns} AS bar_ns
+                FROM trades{joined}
             ),
-            final_calc AS (
-                SELECT 
+            ordered_with_lag AS (
+                SELECT
                     security_id,
                     snap_time,
-                    -- Only calculate if window is full and time-contiguous (e.g., no missing hours)
-                    CASE 
-                        WHEN rn >= {n} 
-                        AND EXTRACT(EPOCH FROM (snap_time - lag_snap_time)) = {total_seconds}
-                        THEN TRUE ELSE FALSE
-                    END AS is_contiguous,
-                    CASE 
-                        WHEN rn >= {n} 
-                        AND EXTRACT(EPOCH FROM (snap_time - lag_snap_time)) = {total_seconds}
-                        THEN STDDEV(bid) OVER (
-                            PARTITION BY security_id ORDER BY snap_time ROWS BETWEEN {n_minus_1} PRECEDING AND CURRENT ROW
-                        )
-                        ELSE NULL 
-                    END AS bid_stdev,
-                    CASE 
-                        WHEN rn >= {n} 
-                        AND EXTRACT(EPOCH FROM (snap_time - lag_snap_time)) = {total_seconds}
-                        THEN STDDEV(mid) OVER (
-                            PARTITION BY security_id ORDER BY snap_time ROWS BETWEEN {n_minus_1} PRECEDING AND CURRENT ROW
-                        )
-                        ELSE NULL 
-                    END AS mid_stdev,
-                    CASE 
-                        WHEN rn >= {n} 
-                        AND EXTRACT(EPOCH FROM (snap_time - lag_snap_time)) = {total_seconds}
-                        THEN STDDEV(ask) OVER (
-                            PARTITION BY security_id ORDER BY snap_time ROWS BETWEEN {n_minus_1} PRECEDING AND CURRENT ROW
-                        )
-                        ELSE NULL 
-                    END AS ask_stdev
-                FROM ordered_with_lag
+                    bid,
+                    mid,
+                    ask,
+                    CASE WHEN bar IS DISTINCT FROM LAG(bar) OVER (PARTITION BY security_id ORDER BY snap_time) THEN bar END AS bar
+                FROM (
+                    -- floor division, also for snap_times before the epoch
+                    SELECT *, (shifted - ((shifted % bar_ns) + bar_ns) % bar_ns) // bar_ns AS bar FROM bars
+                )
+            )"""
+        return ordered, calcs
+
+    def stdev_query(self):
+        if self.bucketed:
+            ordered, calcs = self.bar_windows()
+        else:
+            ordered, calcs = self.row_windows()
+
+        # Window functions see the lookback rows, the output period is filtered afterwards
+        period = f"snap_time BETWEEN TIMESTAMP '{self.start_output}' AND TIMESTAMP '{self.end_output}'"
+        if self.layout == 'long':
+            output = ' UNION ALL '.join(
+                f"""
+            SELECT security_id, snap_time, {n} AS rolling_window, is_contiguous_{n} AS is_contiguous, {', '.join(self.stat_columns(n))}
+            FROM final_calc
+            WHERE {period}"""
+                for n in self.windows
             )
-            SELECT 
-                security_id,
-                snap_time,
-                is_contiguous,
-                bid_stdev,
-                mid_stdev,
-                ask_stdev
+            if self.run_index is not None:
+                output += ''.join(f" UNION ALL {self.idle_select(n)}" for n in self.windows)
+            order = "security_id, snap_time, rolling_window"
+        else:
+            output = f"""
+            SELECT security_id, snap_time, {', '.join(
+                f'is_contiguous_{n} AS is_contiguous{self.suffix(n)}, ' + ', '.join(self.stat_columns(n)) for n in self.windows
+            )}
             FROM final_calc
-            WHERE snap_time BETWEEN TIMESTAMP '{self.start_output}' AND TIMESTAMP '{self.end_output}'
-            ORDER BY security_id, snap_time
-        ) TO '{self.output_file}' (HEADER, DELIMITER ';');
+            WHERE {period}"""
+            if self.run_index is not None:
+                output += f" UNION ALL {self.idle_select()}"
+            order = "security_id, snap_time"
+
+        return f"""
+            WITH {ordered},
+            final_calc AS (
+                SELECT
+                    security_id,
+                    snap_time,{','.join(calcs)}
+                FROM ordered_with_lag
+            )
+            SELECT {self.output_columns()} FROM ({output}
+            ) result
+            ORDER BY {', '.join(f'result.{column}' for column in order.split(', '))}
+        """
+
+    def run_and_save_query(self, sink=None, **fields):
+        """ Writes the rows of the loaded trades to `sink`, or to a new sink on output_file that is closed after """
+        # the window query streams straight into the sink, so computation and output are one stage
+        with self.instrumentation.stage('calculate_stdev', self.conn, **fields) as stage:
+            output = sink or self.output_sink()
+            stage.record(output_rows=output.write(self.conn, self.stdev_query()))
+            if sink is None:
+                output.close()
+
+    def fetch_trades(self, columns=PRICE_COLUMNS):
+        """ Reads `trades` as Arrow, sorting only if its insertion order is not already (security_id, snap_time) """
+        select = f"SELECT security_id, snap_time, {', '.join(columns)} FROM trades"
+        trades = self.conn.execute(select).arrow()
+        encoded = pc.dictionary_encode(trades['security_id']).combine_chunks()
+        partition = encoded.indices.to_numpy()
+        times = trades['snap_time'].combine_chunks().cast(pa.timestamp('ns')).cast(pa.int64()).to_numpy()
+
+        same = partition[1:] == partition[:-1]
+        in_order = (
+            np.all(partition[1:] >= partition[:-1])
+            and np.all(times[1:][same] >= times[:-1][same])
+            and pc.all(pc.less(encoded.dictionary[:-1], encoded.dictionary[1:])).as_py() in (True, None)
+        )
+        if not in_order:
+            trades = self.conn.execute(f"{select} ORDER BY security_id, snap_time").arrow()
+            partition = pc.dictionary_encode(trades['security_id']).combine_chunks().indices.to_numpy()
+            times = trades['snap_time'].combine_chunks().cast(pa.timestamp('ns')).cast(pa.int64()).to_numpy()
+        values = np.column_stack([trades[col].combine_chunks().to_numpy(zero_copy_only=False) for col in columns])
+        return trades, partition, times, values
+
+    def row_bar_lengths(self, security_ids):
+        """ Bar length in ns of every row: its security's entry in bar_intervals, otherwise bar_interval """
+        if not self.bar_lengths:
+            return self.bar_ns
+        match = pc.index_in(security_ids.cast(pa.string()), value_set=pa.array(list(self.bar_lengths), type=pa.string()))
+        # unmatched rows index -1, the default appended last
+        lengths = np.array([*self.bar_lengths.values(), self.bar_ns], dtype=np.int64)
+        return lengths[match.fill_null(-1).to_numpy(zero_copy_only=False)]
+
+    def compute_numpy(self):
+        """ Runs the sliding-sum kernel over `trades` and returns the output rows as an Arrow table """
+        with self.instrumentation.stage('fetch_trades', self.conn) as stage:
+            trades, partition, times, values = self.fetch_trades()
+            stage.record(input_rows=len(times))
+        with self.instrumentation.stage('calculate_stdev') as stage:
+            if self.bucketed:
+                results = bar_kernel(partition, times, values, self.windows, self.statistics,
+                                     self.row_bar_lengths(trades['security_id']), self.tolerance_ns, self.window_frame)
+            else:
+                results = rolling_kernel(partition, times, values, self.windows, self.statistics, step=self.bar_ns)
+            stage.record(window_rows=len(times) * len(self.windows),
+                         contiguous_rows=sum(int(is_contiguous.sum()) for is_contiguous, _ in results.values()))
+        if self.state_file is not None:
+            self.pending_state = self.window_state(trades, partition, times)
+
+        # lookback and persisted rows only feed the windows; trades is already bounded by end_output
+        start_ns = self.conn.execute(f"SELECT epoch_ns(TIMESTAMP '{self.start_output}')").fetchone()[0]
+        emit = times >= start_ns
+        if self.last_snaps is not None:
+            emit &= times > self.row_last_snaps(trades['security_id'])
+        rows = np.flatnonzero(emit)
+
+        def stat_arrays(window):
+            is_contiguous, stats = results[window]
+            arrays = {f'is_contiguous{self.suffix(window)}': is_contiguous[rows]}
+            for stat in self.statistics:
+                for k, col in enumerate(PRICE_COLUMNS):
+                    arrays[f'{col}_{stat}{self.suffix(window)}'] = stats[stat][rows, k]
+            return arrays
+
+        if self.layout == 'long':
+            # one row per (security_id, snap_time, window), windows interleaved in ascending order
+            per_window = [stat_arrays(window) for window in self.windows]
+            rows = np.repeat(rows, len(self.windows))
+            columns = {'rolling_window': np.tile(np.array(self.windows, dtype=np.int32), len(per_window[0]['is_contiguous']))}
+            for name in per_window[0]:
+                columns[name] = np.stack([arrays[name] for arrays in per_window], axis=1).ravel()
+        else:
+            columns = {name: array for window in self.windows for name, array in stat_arrays(window).items()}
+
+        result = pa.table({
+            'security_id': trades['security_id'].take(rows),
+            'snap_time': trades['snap_time'].take(rows),
+            **{name: pa.array(array, from_pandas=True) for name, array in columns.items()},
+        })
+        if self.run_index is None:
+            return result
+        self.conn.register('kernel_result', result)
+        idle = ' UNION ALL '.join(
+            [self.idle_select(n) for n in self.windows] if self.layout == 'long' else [self.idle_select()]
+        )
+        order = "security_id, snap_time, rolling_window" if self.layout == 'long' else "security_id, snap_time"
+        return self.conn.execute(f"SELECT * FROM kernel_result UNION ALL {idle} ORDER BY {order}").arrow()
+
+    def run_and_save_numpy(self, sink=None, **fields):
+        result = self.compute_numpy()
+        with self.instrumentation.stage('write_output', self.conn, **fields) as stage:
+            self.conn.register('stdev_result', result)
+            output = sink or self.output_sink()
+            with stored_order(self.conn, self.preserve_insertion_order):
+                stage.record(output_rows=output.write(self.conn, "SELECT * FROM stdev_result"))
+            if sink is None:
+                output.close()
+        # state only moves forward once the rows computed from it are saved
+        if self.state_file is not None:
+            with self.instrumentation.stage('save_state') as stage:
+                self.save_state(self.pending_state)
+                stage.record(state_rows=self.pending_state.num_rows)
+
+    def change_detector(self):
+        return ChangeDetector(self.fingerprint_file, {
+            'start_output': self.start_output,
+            'end_output': self.end_output,
+            'lookback_days': self.lookback_days,
+            'windows': self.windows,
+            'statistics': self.statistics,
+            'layout': self.layout,
+            'bar_interval': self.bar_interval,
+            'output_file': os.path.abspath(self.output_file),
+            'output_format': self.output_sink().output_format,
+        })
+
+    def downstream_hours(self):
+        """ Hours after a changed hour whose windows can reach back into it: the longest window less one bar """
+        return -(-(max(self.windows) - 1) * self.bar_ns // NS_IN_HOUR)
+
+    def run_changes(self):
+        """
+        Change detection: compares the loaded trades with the fingerprints of the previous run and recomputes only
+        the (security_id, hour) partitions whose windows can include a changed hour, from the rows those windows
+        read, merging them into the existing output. Without a previous run everything is computed.
         """
-        self.conn.execute(query)
+        detector = self.change_detector()
+        self.prepare_data()
+        hours = self.downstream_hours()
+        with self.instrumentation.stage('detect_changes', self.conn) as stage:
+            detector.add('trades', 'trades', 'security_id', 'snap_time', ['snap_time', *PRICE_COLUMNS])
+            merge = detector.detect(self.conn, {'trades': hours}, os.path.exists(self.output_file))
+            stage.record(**detector.stats)
+        if not merge:
+            if self.engine == 'numpy':
+                self.run_and_save_numpy()
+            else:
+                self.run_and_save_query()
+        elif detector.stats['changed_partitions']:
+            with self.instrumentation.stage('merge_output', self.conn) as stage:
+                detector.restrict(self.conn, 'trades', 'security_id', 'snap_time', hours, 'security_id, snap_time')
+                query = self.stdev_query()
+                if self.engine == 'numpy':
+                    self.conn.register('stdev_result', self.compute_numpy())
+                    query = "SELECT * FROM stdev_result"
+                # write next to the target and swap in, the previous output is read while merging
+                tmp_file = f"{self.output_file}.tmp"
+                sink = OutputSink(tmp_file, self.output_sink().output_format, self.compression, self.row_group_size)
+                order = "security_id, snap_time, rolling_window" if self.layout == 'long' else "security_id, snap_time"
+                detector.merge(self.conn, sink, self.output_file, query, 'security_id', 'snap_time', order,
+                               self.preserve_insertion_order)
+                sink.close()
+                os.replace(tmp_file, self.output_file)
+                stage.record(**detector.stats)
+        detector.save(self.conn)
+        print(detector.describe())
 
     def run(self):
         start_time = time.time()
-        print("Starting calculation with direct file loading...")
+        print(f"Starting calculation with direct file loading ({self.engine} engine)...")
 
         try:
-            self.prepare_data()
-            self.run_and_save_query()
+            mode = 'parallel' if self.workers > 1 else 'changes' if self.fingerprint_file is not None else 'batch'
+            with self.instrumentation.stage('run', mode=mode, engine=self.engine) as stage:
+                if mode == 'parallel':
+                    self.run_parallel()
+                elif mode == 'changes':
+                    self.run_changes()
+                else:
+                    self.prepare_data()
+                    if self.engine == 'numpy':
+                        self.run_and_save_numpy()
+                    else:
+                        self.run_and_save_query()
+                stage.record(peak_rss_mb=peak_rss_mb(), **self.instrumentation.peaks)
             elapsed = time.time() - start_time
             print(f"Saved to: '{self.output_file}'")
             print(f"Execution time: {elapsed:.3f} seconds")
+            print(describe_peaks(peak_rss_mb(), self.instrumentation.peaks))
 
         except Exception as e:
             elapsed = time.time() - start_time
             print(f"Error occurred after {elapsed:.3f} seconds: {e}")
             raise
         finally:
-            self.conn.close()
\ No newline at end of file
+            if self.owns_connection:
+                self.conn.close()
\ No newline at end of file
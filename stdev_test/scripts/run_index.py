@@ -0,0 +1,180 @@
+"""
+Contiguity run index: every security_id's snap_time series split into maximal runs of rows exactly one step
+apart, persisted next to the input file and rebuilt only when the input changes.
+
+Usage (gap report):
+    python run_index.py --input-file ../data/stdev_price_data.parq --gaps-file gaps.csv
+"""
+import argparse
+import duckdb
+import numpy as np
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pathlib import Path
+
+STEP_NS = 3600 * 10**9
+INDEX_SUFFIX = '.runs.parquet'
+
+
+def index_path(file_path):
+    """ The index is kept next to its input, e.g. stdev_price_data.parq.runs.parquet """
+    return Path(f'{file_path}{INDEX_SUFFIX}')
+
+
+def fingerprint(file_path):
+    """ Size and modification time of the input; an index built from another version is rebuilt """
+    stat = os.stat(file_path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def build_runs(con, file_path, step=STEP_NS):
+    """
+    One sorted pass over the input: a run starts at every row that is not exactly `step` after the previous row of
+    its security. Returns (runs, regular), where runs holds security_id, run_start, run_end, row_offset (position
+    of the run's first row in the security's series) and rows. `regular` is True when all consecutive snap_times
+    of a security are positive multiples of `step` apart; only then does "row k of a run" imply that the row
+    `window - 1` places back is exactly `(window - 1) * step` earlier, and pruning by runs is exact.
+    Rows without a snap_time are never in a window and are left out.
+    """
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE run_steps AS
+        SELECT
+            security_id,
+            snap_time,
+            ROW_NUMBER() OVER w - 1 AS row_offset,
+            epoch_ns(snap_time) - LAG(epoch_ns(snap_time)) OVER w AS diff
+        FROM read_parquet('{file_path}')
+        WHERE snap_time IS NOT NULL
+        WINDOW w AS (PARTITION BY security_id ORDER BY snap_time)
+    """)
+    regular = con.execute(f"""
+        SELECT COALESCE(bool_and(diff IS NULL OR (diff > 0 AND diff % {step} = 0)), TRUE) FROM run_steps
+    """).fetchone()[0]
+    runs = con.execute(f"""
+        SELECT
+            security_id,
+            MIN(snap_time) AS run_start,
+            MAX(snap_time) AS run_end,
+            MIN(row_offset) AS row_offset,
+            COUNT(*) AS rows
+        FROM (
+            SELECT *, SUM(CASE WHEN diff = {step} THEN 0 ELSE 1 END) OVER (
+                PARTITION BY security_id ORDER BY row_offset ROWS UNBOUNDED PRECEDING
+            ) AS run
+            FROM run_steps
+        )
+        GROUP BY security_id, run
+        ORDER BY security_id, run_start
+    """).arrow()
+    con.execute("DROP TABLE run_steps")
+    return runs, regular
+
+
+class RunIndex:
+    """ Runs of one input file, with contiguity lookups and a gap report """
+    def __init__(self, runs, regular=True, step=STEP_NS):
+        self.runs = runs
+        self.regular = regular
+        self.step = step
+
+    @classmethod
+    def load(cls, file_path, con=None, index_file=None, step=STEP_NS):
+        """
+        Reads the persisted index, or builds it and saves it next to the input when it is missing, was built for
+        another step or from an older version of the file. Returns (index, rebuilt).
+        """
+        index_file = Path(index_file or index_path(file_path))
+        source = fingerprint(file_path)
+        if index_file.exists():
+            runs = pq.read_table(index_file)
+            metadata = runs.schema.metadata or {}
+            if metadata.get(b'fingerprint') == source.encode() and int(metadata.get(b'step_ns', -1)) == step:
+                return cls(runs.replace_schema_metadata(None), metadata[b'regular'] == b'true', step), False
+
+        own_con = con is None
+        con = con or duckdb.connect()
+        runs, regular = build_runs(con, file_path, step)
+        if own_con:
+            con.close()
+        index = cls(runs, regular, step)
+        try:
+            # write next to the target and swap in, so concurrent readers never see a partial index
+            tmp_file = f'{index_file}.tmp'
+            pq.write_table(runs.replace_schema_metadata({
+                'fingerprint': source,
+                'step_ns': str(step),
+                'regular': str(regular).lower(),
+            }), tmp_file)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            # read-only input directory: the index still serves this run from memory
+            pass
+        return index, True
+
+    def __len__(self):
+        return self.runs.num_rows
+
+    def arrays(self):
+        """ (security codes, -1 for NULL ids; distinct security ids; run starts and ends in ns) """
+        encoded = self.runs['security_id'].combine_chunks().dictionary_encode()
+        starts = self.runs['run_start'].combine_chunks().cast(pa.timestamp('ns')).cast(pa.int64()).to_numpy()
+        ends = self.runs['run_end'].combine_chunks().cast(pa.timestamp('ns')).cast(pa.int64()).to_numpy()
+        return encoded.indices.fill_null(-1).to_numpy(), encoded.dictionary, starts, ends
+
+    def is_contiguous(self, security_ids, snap_times, window):
+        """
+        Whether each (security_id, snap_time) has a full window of `window` rows over the file's whole history;
+        False for times that are not in the file
+        """
+        codes, dictionary, starts, ends = self.arrays()
+        query_codes = pc.index_in(pa.array(security_ids, type=pa.string()), value_set=dictionary)
+        query_codes = query_codes.fill_null(-1).to_numpy(zero_copy_only=False)
+        times = pa.array(snap_times).cast(pa.timestamp('ns')).cast(pa.int64()).to_numpy(zero_copy_only=False)
+
+        result = np.zeros(len(times), dtype=bool)
+        for code in set(query_codes.tolist()) - {-1}:
+            # runs of one security are sorted by run_start
+            runs = np.flatnonzero(codes == code)
+            rows = np.flatnonzero(query_codes == code)
+            run = runs[0] + np.searchsorted(starts[runs], times[rows], side='right') - 1
+            found = run >= runs[0]
+            run, rows = run[found], rows[found]
+            offset = times[rows] - starts[run]
+            result[rows] = (times[rows] <= ends[run]) & (offset % self.step == 0) & (offset >= (window - 1) * self.step)
+        return result
+
+    def gaps(self):
+        """ Missing stretches between consecutive runs of a security: first and last missing step and their count """
+        codes, _, starts, ends = self.arrays()
+        inner = np.flatnonzero(codes[1:] == codes[:-1])
+        gap_start, gap_end = ends[inner] + self.step, starts[inner + 1] - self.step
+        return pa.table({
+            'security_id': self.runs['security_id'].take(inner + 1),
+            'gap_start': pa.array(gap_start, type=pa.timestamp('ns')),
+            'gap_end': pa.array(gap_end, type=pa.timestamp('ns')),
+            'missing_steps': (gap_end - gap_start) // self.step + 1,
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the contiguity run index of a price file and report gaps")
+
+    script_dir = Path(__file__).parent
+    data_dir = script_dir.parent / "data"
+
+    parser.add_argument('--input-file', default=data_dir / 'stdev_price_data.parq', type=Path)
+    parser.add_argument('--gaps-file', default=None, type=Path, help='Write the gap report to this CSV file')
+
+    args = parser.parse_args()
+
+    index, rebuilt = RunIndex.load(args.input_file)
+    gaps = index.gaps()
+    print(f"{'Built' if rebuilt else 'Loaded'} '{index_path(args.input_file)}': {len(index)} runs, "
+          f"{gaps.num_rows} gaps{'' if index.regular else ' (irregular snap_times, pruning disabled)'}")
+    if args.gaps_file is not None:
+        con = duckdb.connect()
+        con.register('gaps', gaps)
+        con.execute(f"COPY gaps TO '{args.gaps_file}' (HEADER, DELIMITER ';')")
+        print(f"Saved to: '{args.gaps_file}'")
@@ -0,0 +1,11 @@
+"""
+Choices of the rolling statistics options. This module imports nothing, so main.py builds its parser without
+importing DuckDB, Arrow or NumPy.
+"""
+ENGINES = ('sql', 'numpy')
+# Statistics of the multi-window mode, in output column order
+STATISTICS = ('stdev', 'variance', 'mean', 'min', 'max', 'zscore')
+LAYOUTS = ('wide', 'long')
+# Window frames of the bar mode: 'rows' computes a window only when all of its bars have a snap, 'range' over the
+# snaps of its bars that are there, with is_contiguous telling whether all of them are
+FRAMES = ('rows', 'range')
@@ -1,10 +1,22 @@
+import duckdb
+import json
 import pytest
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 import tempfile
 import shutil
+import statistics
 from datetime import datetime, timedelta
-from rolling_stdev_calculation import RollingStdev
+from pathlib import Path
+from rolling_stdev_calculation import LAYOUTS, STATISTICS, RollingStdev, read_bar_intervals, rolling_kernel, rolling_stdev_kernel
+from resources import reset
+from run_index import RunIndex
+from backfill import Backfill, date_ranges, parse_ranges
+
+DATA_DIR = Path(__file__).parent.parent / "data"
 
 class TestRollingStdev:
     """ Unit tests including std logic with contiguous/non-contiguous data"""
@@ -83,6 +95,720 @@ class TestRollingStdev:
         # Because the data is broken in the middle, it restricts a full 20-point window, so we expect 0 computed stdevs
         assert actual_non_null_rows == 0, f"Expected 0 non-null rows due to break, got {actual_non_null_rows}"
 
+    @pytest.mark.parametrize("engine", RollingStdev.ENGINES)
+    def test_engines_on_contiguous_data(self, engine):
+        self.create_contiguous_data()
+        calculator = RollingStdev(
+            file_path=self.test_data_file,
+            start_output='2021-11-1 00:00:00',
+            end_output='2021-11-2 23:00:00',
+            output_file=self.output_file,
+            rolling_window=20,
+            engine=engine
+        )
+        calculator.run()
+
+        df = pd.read_csv(self.output_file, delimiter=';')
+        assert df['is_contiguous'].sum() == 11
+        # bid rises by 1 each hour, so every full window has the stdev of 0..19
+        assert np.allclose(df['bid_stdev'].dropna(), np.std(np.arange(20), ddof=1))
+
+    def test_unknown_engine(self):
+        with pytest.raises(ValueError):
+            RollingStdev(engine="polars")
+
+    def test_numpy_engine_matches_sql_on_bundled_data(self):
+        outputs = {}
+        for engine in RollingStdev.ENGINES:
+            output_file = os.path.join(self.temp_dir, f'output_{engine}.csv')
+            RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', output_file=output_file, engine=engine).run()
+            outputs[engine] = pd.read_csv(output_file, delimiter=';')
+
+        sql, fast = outputs['sql'], outputs['numpy']
+        pd.testing.assert_frame_equal(
+            sql[['security_id', 'snap_time', 'is_contiguous']], fast[['security_id', 'snap_time', 'is_contiguous']]
+        )
+        for col in ['bid_stdev', 'mid_stdev', 'ask_stdev']:
+            assert (sql[col].isna() == fast[col].isna()).all()
+            assert np.allclose(fast[col], sql[col], rtol=1e-9, atol=1e-12, equal_nan=True)
+
+    def test_kernel_matches_exact_statistics_on_ill_conditioned_data(self):
+        # large values with a small spread cancel in the sums of squares; DuckDB's STDDEV loses digits here, so the
+        # kernel is checked against the exact statistics module instead of the sql engine
+        rng = np.random.default_rng(0)
+        values = 1e6 + rng.normal(0, 1e-3, size=(200, 3))
+        times = np.arange(200) * 3600 * 10**9
+        results = rolling_kernel(np.zeros(200, dtype=np.int64), times, values, [5, 20, 100], ('stdev', 'variance'))
+        for window, (is_contiguous, stats) in results.items():
+            rows = np.flatnonzero(is_contiguous)
+            assert len(rows) == 200 - window + 1
+            for col in range(3):
+                frames = [values[row - window + 1:row + 1, col] for row in rows]
+                np.testing.assert_allclose(stats['stdev'][rows, col], [statistics.stdev(f) for f in frames], rtol=1e-12)
+                np.testing.assert_allclose(stats['variance'][rows, col], [statistics.variance(f) for f in frames],
+                                           rtol=1e-12)
+
+    def test_kernel_skips_nulls_and_handles_flat_windows(self):
+        partition = np.array([0, 0, 0, 0, 1, 1, 1])
+        times = np.array([0, 1, 2, 3, 0, 1, 3]) * 3600 * 10**9
+        values = np.array([
+            [1.0, 5.0], [np.nan, 5.0], [4.0, 5.0], [np.nan, 5.0],
+            [1.0, 2.0], [2.0, 3.0], [3.0, 4.0],
+        ])
+        is_contiguous, stdevs = rolling_stdev_kernel(partition, times, values, window=3)
+
+        assert is_contiguous.tolist() == [False, False, True, True, False, False, False]
+        assert stdevs[2, 0] == pytest.approx(np.std([1.0, 4.0], ddof=1))
+        assert np.isnan(stdevs[3, 0])  # only one non-null value in the window
+        assert stdevs[2, 1] == 0.0 and stdevs[3, 1] == 0.0
+        assert np.isnan(stdevs[4:]).all()
+
+    def create_two_security_data(self, count=60, missing_hour_index=35):
+        base_time = datetime(2021, 11, 1, 0, 0)
+        rng = np.random.default_rng(0)
+        data = []
+        for security_id in ['id_a', 'id_b']:
+            for i in range(count):
+                if security_id == 'id_b' and i == missing_hour_index:
+                    continue
+                mid = 100 + rng.normal()
+                data.append({
+                    'snap_time': base_time + timedelta(hours=i),
+                    'security_id': security_id,
+                    'bid': mid - 0.5,
+                    'mid': mid,
+                    'ask': mid + 0.5
+                })
+        pd.DataFrame(data).to_parquet(self.test_data_file)
+
+    def run_numpy(self, end_output, output_file, state_file=None):
+        RollingStdev(
+            file_path=self.test_data_file,
+            start_output='2021-11-1 00:00:00',
+            end_output=end_output,
+            output_file=output_file,
+            rolling_window=20,
+            engine='numpy',
+            state_file=state_file
+        ).run()
+        return pd.read_csv(output_file, delimiter=';')
+
+    def test_incremental_runs_match_full_run(self):
+        self.create_two_security_data()
+        state_file = os.path.join(self.temp_dir, 'state.parq')
+        full = self.run_numpy('2021-11-3 11:00:00', self.output_file)
+
+        first = self.run_numpy('2021-11-2 06:00:00', os.path.join(self.temp_dir, 'first.csv'), state_file)
+        second = self.run_numpy('2021-11-3 11:00:00', os.path.join(self.temp_dir, 'second.csv'), state_file)
+        assert first['snap_time'].max() == '2021-11-02 06:00:00'
+        assert second['snap_time'].min() == '2021-11-02 07:00:00'
+
+        combined = pd.concat([first, second]).sort_values(['security_id', 'snap_time']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(combined, full, rtol=1e-12)
+
+        # the gap in id_b at hour 35 blocks its windows from hour 36 until hour 55
+        id_b = second[second['security_id'] == 'id_b']
+        assert id_b['is_contiguous'].sum() == (34 - 31 + 1) + (59 - 55 + 1)
+
+        state = pd.read_parquet(state_file)
+        assert state.groupby('security_id').size().tolist() == [20, 20]
+
+        third = self.run_numpy('2021-11-3 11:00:00', os.path.join(self.temp_dir, 'third.csv'), state_file)
+        assert third.empty
+
+    def test_incremental_with_securities_advancing_unevenly(self):
+        self.create_two_security_data()
+        complete = pd.read_parquet(self.test_data_file)
+        state_file = os.path.join(self.temp_dir, 'state.parq')
+        full = self.run_numpy('2021-11-3 11:00:00', self.output_file)
+
+        # id_a is delivered up to hour 29 and id_b up to hour 28; id_b's hour 29 and the rest arrive later
+        hour = (complete['snap_time'] - datetime(2021, 11, 1)) // timedelta(hours=1)
+        complete[hour <= np.where(complete['security_id'] == 'id_a', 29, 28)].to_parquet(self.test_data_file)
+        first = self.run_numpy('2021-11-3 11:00:00', os.path.join(self.temp_dir, 'first.csv'), state_file)
+        complete.to_parquet(self.test_data_file)
+        second = self.run_numpy('2021-11-3 11:00:00', os.path.join(self.temp_dir, 'second.csv'), state_file)
+
+        assert second.groupby('security_id')['snap_time'].min().tolist() == ['2021-11-02 06:00:00', '2021-11-02 05:00:00']
+        combined = pd.concat([first, second]).sort_values(['security_id', 'snap_time']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(combined, full, rtol=1e-12)
+
+    def test_incremental_scan_skips_processed_rows(self):
+        self.create_two_security_data()
+        complete = pd.read_parquet(self.test_data_file)
+        state_file = os.path.join(self.temp_dir, 'state.parq')
+        profile_dir = os.path.join(self.temp_dir, 'profiles')
+        options = dict(file_path=self.test_data_file, start_output='2021-11-2 06:00:00', end_output='2021-11-3 11:00:00',
+                       output_file=self.output_file, rolling_window=20, lookback_days=1, engine='numpy',
+                       state_file=state_file)
+        complete[complete['snap_time'] <= datetime(2021, 11, 2, 5)].to_parquet(self.test_data_file)
+        RollingStdev(**options).run()
+        complete.to_parquet(self.test_data_file)
+        RollingStdev(**options, profile_dir=profile_dir).run()
+
+        def operators(node):
+            yield node
+            for child in node.get('children', []):
+                yield from operators(child)
+
+        [profile_file] = [name for name in os.listdir(profile_dir) if name.endswith('prepare_data.json')]
+        with open(os.path.join(profile_dir, profile_file)) as profile:
+            [scan] = [op for op in operators(json.load(profile)) if op.get('operator_name', '').strip() == 'READ_PARQUET']
+        # both securities were processed up to hour 29, so only the lookback of start_output is read again
+        assert 'snap_time>=' in scan['extra_info']['Filters']
+        assert scan['operator_cardinality'] == (complete['snap_time'] >= datetime(2021, 11, 1, 6)).sum()
+
+    def test_incremental_requires_numpy_engine(self):
+        with pytest.raises(ValueError):
+            RollingStdev(state_file='state.parq')
+
+    def test_parallel_matches_single_run(self):
+        outputs = {}
+        for engine in RollingStdev.ENGINES:
+            for workers in (1, 3):
+                output_file = os.path.join(self.temp_dir, f'output_{engine}_{workers}.csv')
+                RollingStdev(
+                    file_path=DATA_DIR / 'stdev_price_data.parq',
+                    output_file=output_file,
+                    engine=engine,
+                    workers=workers
+                ).run()
+                outputs[engine, workers] = output_file
+
+        # the numpy kernel treats each security independently, so sharding does not change a single bit
+        with open(outputs['numpy', 1], 'rb') as single, open(outputs['numpy', 3], 'rb') as parallel:
+            assert parallel.read() == single.read()
+
+        # DuckDB window aggregates may round differently once the securities are split
+        single = pd.read_csv(outputs['sql', 1], delimiter=';')
+        parallel = pd.read_csv(outputs['sql', 3], delimiter=';')
+        pd.testing.assert_frame_equal(parallel, single, rtol=1e-12)
+
+    @pytest.mark.parametrize('engine,workers', [('sql', 1), ('numpy', 1), ('sql', 2)])
+    def test_resource_settings_keep_output(self, engine, workers):
+        default_file = os.path.join(self.temp_dir, 'default.csv')
+        budgeted_file = os.path.join(self.temp_dir, 'budgeted.csv')
+        spill_dir = os.path.join(self.temp_dir, 'spill')
+        RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', output_file=default_file, engine=engine).run()
+        events = []
+        calculation = RollingStdev(
+            file_path=DATA_DIR / 'stdev_price_data.parq',
+            output_file=budgeted_file,
+            engine=engine,
+            workers=workers,
+            memory_limit='256MB',
+            threads=2,
+            temp_directory=spill_dir,
+            max_temp_directory_size='1GB',
+            preserve_insertion_order=False,
+            metrics_callback=events.append
+        )
+        assert calculation.conn.execute(
+            "SELECT current_setting('temp_directory'), current_setting('threads'), "
+            "current_setting('preserve_insertion_order')"
+        ).fetchone() == (spill_dir, 2, False)
+        calculation.run()
+
+        default = pd.read_csv(default_file, delimiter=';')
+        budgeted = pd.read_csv(budgeted_file, delimiter=';')
+        # spilled or sharded DuckDB windows may round differently in the last bits
+        pd.testing.assert_frame_equal(budgeted, default, rtol=1e-12)
+        run = next(event for event in events if event['stage'] == 'run')
+        assert run['rows']['peak_rss_mb'] > 0
+
+    @pytest.mark.parametrize('engine', RollingStdev.ENGINES)
+    def test_parquet_output_matches_csv(self, engine):
+        outputs = {}
+        for extension in ('csv', 'parquet'):
+            outputs[extension] = os.path.join(self.temp_dir, f'output.{extension}')
+            RollingStdev(
+                file_path=DATA_DIR / 'stdev_price_data.parq',
+                output_file=outputs[extension],
+                engine=engine
+            ).run()
+
+        expected = pd.read_csv(outputs['csv'], delimiter=';', parse_dates=['snap_time'])
+        actual = pd.read_parquet(outputs['parquet'])
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False, rtol=1e-15)
+
+        in_process = RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', engine=engine).to_arrow()
+        pd.testing.assert_frame_equal(in_process.to_pandas(), actual)
+
+    @pytest.mark.parametrize('options', [
+        {},
+        {'engine': 'numpy'},
+        {'workers': 2},
+        {'windows': [5, 20], 'layout': 'long', 'run_index': True},
+    ])
+    def test_compute_matches_run(self, options):
+        output_file = os.path.join(self.temp_dir, 'output.parquet')
+        RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', output_file=output_file, **options).run()
+
+        reader = RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', **options).compute(batch_size=500)
+        batches = list(reader)
+        assert batches and all(batch.num_rows <= 500 for batch in batches)
+        actual = pa.Table.from_batches(batches, reader.schema).to_pandas()
+        # separate DuckDB runs may round their window aggregates differently in the last bits
+        pd.testing.assert_frame_equal(actual, pd.read_parquet(output_file), rtol=1e-12)
+
+    def test_compute_saves_state_once_read(self):
+        self.create_two_security_data()
+        state_file = os.path.join(self.temp_dir, 'state.parq')
+        full = self.run_numpy('2021-11-3 11:00:00', self.output_file)
+
+        reader = RollingStdev(
+            file_path=self.test_data_file,
+            start_output='2021-11-1 00:00:00',
+            end_output='2021-11-2 06:00:00',
+            output_file=None,
+            engine='numpy',
+            state_file=state_file
+        ).compute(batch_size=10)
+        first = reader.read_next_batch()
+        assert not os.path.exists(state_file)
+        rest = reader.read_all()
+        assert os.path.exists(state_file)
+        assert first.num_rows + rest.num_rows == (full['snap_time'] <= '2021-11-02 06:00:00').sum()
+
+        second = self.run_numpy('2021-11-3 11:00:00', os.path.join(self.temp_dir, 'second.csv'), state_file)
+        assert second['snap_time'].min() == '2021-11-02 07:00:00'
+
+    def test_compute_closes_its_own_connection(self):
+        calculation = RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq')
+        reader = calculation.compute(batch_size=500)
+        reader.read_next_batch()
+        assert calculation.conn.execute('SELECT 1').fetchone() == (1,)
+        reader.read_all()
+        with pytest.raises(duckdb.ConnectionException):
+            calculation.conn.execute('SELECT 1')
+
+        connection = duckdb.connect()
+        RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', connection=connection).to_arrow()
+        assert connection.execute('SELECT 1').fetchone() == (1,)
+        connection.close()
+
+    def test_compute_frames(self):
+        expected = RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', engine='numpy').to_arrow()
+        frame = RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', engine='numpy').compute(output='pandas')
+        pd.testing.assert_frame_equal(frame, expected.to_pandas())
+        with pytest.raises(ValueError, match='Unknown output'):
+            RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq').compute(output='csv')
+        polars = pytest.importorskip('polars')
+        frame = RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', engine='numpy').compute(output='polars')
+        assert frame.equals(polars.from_arrow(expected))
+
+    def test_instrumentation_metrics_file(self):
+        metrics_file = os.path.join(self.temp_dir, 'metrics.jsonl')
+        output_file = os.path.join(self.temp_dir, 'output.csv')
+        RollingStdev(
+            file_path=DATA_DIR / 'stdev_price_data.parq',
+            output_file=output_file,
+            engine='numpy',
+            metrics_file=metrics_file
+        ).run()
+
+        with open(metrics_file) as metrics:
+            events = {event['stage']: event for event in map(json.loads, metrics)}
+        assert list(events) == ['prepare_data', 'fetch_trades', 'calculate_stdev', 'write_output', 'run']
+        assert events['prepare_data']['rows']['input_rows'] == events['fetch_trades']['rows']['input_rows']
+        assert events['write_output']['rows']['output_rows'] == len(pd.read_csv(output_file, delimiter=';'))
+        assert all(event['elapsed_seconds'] >= 0 for event in events.values())
+
+    def test_multi_window_engines_match(self):
+        windows, statistics = [5, 20, 50], list(STATISTICS)
+        outputs = {}
+        for engine in RollingStdev.ENGINES:
+            outputs[engine] = RollingStdev(
+                file_path=DATA_DIR / 'stdev_price_data.parq',
+                engine=engine,
+                windows=windows,
+                statistics=statistics
+            ).to_arrow().to_pandas()
+
+        sql, fast = outputs['sql'], outputs['numpy']
+        assert list(sql.columns) == list(fast.columns)
+        assert 'bid_zscore_168' not in sql.columns and 'ask_max_50' in sql.columns
+        for col in sql.columns[2:]:
+            if col.startswith('is_contiguous'):
+                assert (sql[col] == fast[col]).all()
+                continue
+            assert (sql[col].isna() == fast[col].isna()).all(), col
+            assert np.allclose(fast[col], sql[col], rtol=1e-9, atol=1e-12, equal_nan=True), col
+
+    @pytest.mark.parametrize("engine,run_index", [("sql", False), ("numpy", False), ("sql", True), ("numpy", True)])
+    def test_flat_windows_have_no_zscore(self, engine, run_index):
+        # the bundled data has flat windows, where DuckDB's STDDEV is rounding noise rather than an exact zero
+        shutil.copy(DATA_DIR / 'stdev_price_data.parq', self.test_data_file)
+        result = RollingStdev(
+            file_path=self.test_data_file,
+            engine=engine,
+            run_index=run_index,
+            statistics=['min', 'max', 'zscore']
+        ).to_arrow().to_pandas()
+        for col in ['bid', 'mid', 'ask']:
+            flat = result[f'{col}_min'] == result[f'{col}_max']
+            assert flat.sum() > 0
+            assert result.loc[flat, f'{col}_zscore'].isna().all(), col
+
+    def test_multi_window_matches_single_window(self):
+        def run(**params):
+            return RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', engine='numpy', **params).to_arrow()
+
+        single = run(rolling_window=20)
+        multi = run(windows=[168, 20, 50], statistics=['mean', 'stdev'])
+        assert multi['is_contiguous_20'].equals(single['is_contiguous'])
+        for col in ['bid', 'mid', 'ask']:
+            assert multi[f'{col}_stdev_20'].equals(single[f'{col}_stdev'])
+
+        long = run(windows=[20, 50], statistics=['stdev'], layout='long').to_pandas()
+        assert list(long.columns[:4]) == ['security_id', 'snap_time', 'rolling_window', 'is_contiguous']
+        assert long['rolling_window'].tolist() == [20, 50] * single.num_rows
+        wide = run(windows=[20, 50], statistics=['stdev']).to_pandas()
+        assert long[long['rolling_window'] == 50]['bid_stdev'].reset_index(drop=True).equals(wide['bid_stdev_50'])
+
+        sql_long = RollingStdev(
+            file_path=DATA_DIR / 'stdev_price_data.parq', windows=[20, 50], statistics=['stdev'], layout='long'
+        ).to_arrow().to_pandas()
+        assert list(sql_long.columns) == list(long.columns)
+        assert np.allclose(sql_long['bid_stdev'], long['bid_stdev'], rtol=1e-9, atol=1e-12, equal_nan=True)
+
+    def test_invalid_statistics_and_layout(self):
+        with pytest.raises(ValueError):
+            RollingStdev(statistics=['median'])
+        with pytest.raises(ValueError):
+            RollingStdev(layout='tall')
+
+    def create_gappy_data(self, securities=4, hours=300, seed=7):
+        """ Runs of random lengths between random gaps, many of them shorter than a window """
+        rng = np.random.default_rng(seed)
+        base_time = datetime(2021, 11, 1, 0, 0)
+        data = []
+        for s in range(securities):
+            keep = np.repeat(rng.random(hours // 10) > 0.3, 10) & (rng.random(hours) > 0.05)
+            for h in np.flatnonzero(keep):
+                data.append({
+                    'snap_time': base_time + timedelta(hours=int(h)),
+                    'security_id': f'id_{s}',
+                    'bid': rng.normal(100, 1),
+                    'mid': rng.normal(200, 1),
+                    'ask': rng.normal(300, 1)
+                })
+        pd.DataFrame(data).to_parquet(self.test_data_file)
+
+    @pytest.mark.parametrize("engine", RollingStdev.ENGINES)
+    @pytest.mark.parametrize("layout", LAYOUTS)
+    def test_run_index_matches_full_scan(self, engine, layout):
+        self.create_gappy_data()
+        outputs = {}
+        for run_index in (False, True):
+            outputs[run_index] = RollingStdev(
+                file_path=self.test_data_file,
+                start_output='2021-11-05 00:00:00',
+                end_output='2021-11-12 23:00:00',
+                lookback_days=3,
+                engine=engine,
+                windows=[5, 20],
+                statistics=['stdev', 'max'],
+                layout=layout,
+                run_index=run_index
+            ).to_arrow().to_pandas()
+
+        full, indexed = outputs[False], outputs[True]
+        assert list(full.columns) == list(indexed.columns)
+        assert full.drop(columns=[c for c in full.columns if '_stdev' in c]).equals(
+            indexed.drop(columns=[c for c in full.columns if '_stdev' in c])
+        )
+        for col in [c for c in full.columns if '_stdev' in c]:
+            assert np.allclose(full[col], indexed[col], rtol=1e-9, atol=1e-12, equal_nan=True)
+        assert os.path.exists(f'{self.test_data_file}.runs.parquet')
+
+    def test_run_index_persistence_gaps_and_lookup(self):
+        self.create_gappy_data(securities=2)
+        index, rebuilt = RunIndex.load(self.test_data_file)
+        assert rebuilt and index.regular
+        assert RunIndex.load(self.test_data_file)[1] is False
+
+        trades = pd.read_parquet(self.test_data_file)
+        runs = index.runs.to_pandas()
+        assert runs['rows'].sum() == len(trades)
+        gaps = index.gaps().to_pandas()
+        assert len(gaps) == len(runs) - runs['security_id'].nunique()
+        assert (gaps['missing_steps'] >= 1).all()
+        assert runs.groupby('security_id')['rows'].sum().to_dict() == trades.groupby('security_id').size().to_dict()
+
+        output = RollingStdev(
+            file_path=self.test_data_file,
+            start_output='2021-11-01 00:00:00',
+            end_output='2021-11-13 23:00:00',
+            rolling_window=20
+        ).to_arrow().to_pandas()
+        lookup = index.is_contiguous(output['security_id'], output['snap_time'], 20)
+        assert (lookup == output['is_contiguous'].to_numpy()).all()
+        assert not index.is_contiguous(['id_9', 'id_0'], [datetime(2021, 11, 5), datetime(2022, 1, 1)], 1).any()
+
+        # a new version of the input invalidates the stored index
+        self.create_gappy_data(securities=3)
+        os.utime(self.test_data_file, ns=(0, 0))
+        index, rebuilt = RunIndex.load(self.test_data_file)
+        assert rebuilt and index.runs['security_id'].unique().to_pylist() == ['id_0', 'id_1', 'id_2']
+
+    @pytest.mark.parametrize("engine", RollingStdev.ENGINES)
+    def test_input_cache_reuses_trades(self, engine):
+        cache_file = os.path.join(self.temp_dir, 'cache.duckdb')
+        outputs, loads = [], []
+        for i in range(2):
+            events = []
+            output_file = os.path.join(self.temp_dir, f'output_{i}.csv')
+            RollingStdev(
+                file_path=DATA_DIR / 'stdev_price_data.parq',
+                output_file=output_file,
+                engine=engine,
+                cache_file=cache_file,
+                metrics_callback=events.append
+            ).run()
+            loads.append(next(event['rows'] for event in events if event['stage'] == 'prepare_data'))
+            outputs.append(Path(output_file).read_bytes())
+
+        assert (loads[0]['cache_misses'], loads[1]['cache_hits']) == (1, 1)
+        assert loads[0]['input_rows'] == loads[1]['input_rows']
+        assert outputs[0] == outputs[1]
+
+    def assert_frames_close(self, expected, actual):
+        assert list(expected.columns) == list(actual.columns)
+        values = [c for c in expected.columns if '_stdev' in c]
+        assert expected.drop(columns=values).equals(actual.drop(columns=values))
+        for col in values:
+            assert np.allclose(expected[col], actual[col], rtol=1e-9, atol=1e-12, equal_nan=True)
+
+    @pytest.mark.parametrize("engine", RollingStdev.ENGINES)
+    def test_backfill_matches_separate_runs(self, engine):
+        self.create_gappy_data()
+        ranges = date_ranges('2021-11-05 00:00:00', '2021-11-09 12:00:00', '1 day')
+        assert len(ranges) == 5 and ranges[-1][1] == datetime(2021, 11, 9, 12)
+        settings = dict(file_path=self.test_data_file, lookback_days=2, engine=engine, windows=[5, 20])
+        events = []
+        template = os.path.join(self.temp_dir, 'backfill', 'stdev_{start:%Y%m%d}.parquet')
+        Backfill(ranges, template, metrics_callback=events.append, **settings).run()
+
+        for start, end in ranges:
+            expected = RollingStdev(start_output=str(start), end_output=str(end), **settings).to_arrow().to_pandas()
+            actual = pd.read_parquet(template.format(start=start))
+            self.assert_frames_close(expected, actual)
+        slides = [event['slide'] for event in events if event['stage'] == 'load_range']
+        assert slides == [False, True, True, True, True]
+
+    def test_backfill_single_output_and_ranges(self):
+        self.create_gappy_data()
+        # the second period is too far from the first to reuse its rows
+        ranges = parse_ranges('2021-11-10 00:00:00/2021-11-10 23:00:00,2021-11-05 00:00:00/2021-11-06 23:00:00')
+        Backfill(ranges, self.output_file, file_path=self.test_data_file, lookback_days=1).run()
+
+        expected = pd.concat([
+            RollingStdev(file_path=self.test_data_file, start_output=str(start), end_output=str(end),
+                         lookback_days=1).to_arrow().to_pandas()
+            for start, end in ranges
+        ], ignore_index=True)
+        actual = pd.read_csv(self.output_file, delimiter=';', parse_dates=['snap_time'])
+        self.assert_frames_close(expected, actual)
+
+        with pytest.raises(ValueError):
+            parse_ranges('2021-11-05/2021-11-06,2021-11-06/2021-11-07')
+        with pytest.raises(ValueError):
+            Backfill(ranges, self.output_file, file_path=self.test_data_file, state_file='state.parquet')
+
+
+    @pytest.mark.parametrize('options', [
+        {}, {'workers': 2}, {'run_index': True, 'windows': [5, 20], 'layout': 'long'},
+    ])
+    def test_encoded_keys_match_string_keys(self, options):
+        self.create_gappy_data()
+        settings = dict(file_path=self.test_data_file, start_output='2021-11-05 00:00:00',
+                        end_output='2021-11-09 12:00:00', lookback_days=2, **options)
+        strings = os.path.join(self.temp_dir, 'strings.csv')
+        encoded = os.path.join(self.temp_dir, 'encoded.csv')
+        RollingStdev(output_file=strings, **settings).run()
+        RollingStdev(output_file=encoded, encode_keys=True, **settings).run()
+        self.assert_frames_close(pd.read_csv(strings, delimiter=';'), pd.read_csv(encoded, delimiter=';'))
+
+    def test_encoded_keys_backfill_and_dictionary_output(self):
+        self.create_gappy_data()
+        ranges = date_ranges('2021-11-05 00:00:00', '2021-11-09 12:00:00', '1 day')
+        settings = dict(file_path=self.test_data_file, lookback_days=2)
+        strings = os.path.join(self.temp_dir, 'strings.parquet')
+        encoded = os.path.join(self.temp_dir, 'encoded.parquet')
+        Backfill(ranges, strings, **settings).run()
+        Backfill(ranges, encoded, encode_keys=True, dictionary_keys=True, **settings).run()
+
+        table = pq.read_table(encoded)
+        assert pa.types.is_dictionary(table.schema.field('security_id').type)
+        ids = sorted(pd.read_parquet(self.test_data_file)['security_id'].dropna().unique())
+        assert table.column('security_id').chunk(0).dictionary.to_pylist() == ids
+        self.assert_frames_close(pd.read_parquet(strings), table.to_pandas().astype({'security_id': object}))
+
+        with pytest.raises(ValueError, match='encode_keys'):
+            RollingStdev(file_path=self.test_data_file, engine='numpy', encode_keys=True)
+        with pytest.raises(ValueError, match='encode_keys'):
+            RollingStdev(file_path=self.test_data_file, dictionary_keys=True)
+
+    def create_jittered_data(self):
+        """ Hourly snaps 20s late, 10s early, twice in one bar and missing one bar """
+        base_time = datetime(2021, 11, 1, 0, 0)
+        offsets = [timedelta(0), timedelta(hours=1, seconds=20), timedelta(hours=1, minutes=59, seconds=50),
+                   timedelta(hours=3), timedelta(hours=3, minutes=10), timedelta(hours=5)]
+        bids = [1.0, 2.0, 4.0, 8.0, 100.0, 16.0]
+        pd.DataFrame({
+            'snap_time': [base_time + offset for offset in offsets],
+            'security_id': 'id_test',
+            'bid': bids,
+            'mid': [2 * bid for bid in bids],
+            'ask': [3 * bid for bid in bids],
+        }).to_parquet(self.test_data_file)
+
+    @pytest.mark.parametrize("engine", RollingStdev.ENGINES)
+    def test_snap_tolerance_and_window_frames(self, engine):
+        self.create_jittered_data()
+        settings = dict(file_path=self.test_data_file, start_output='2021-11-01 00:00:00',
+                        end_output='2021-11-01 23:00:00', lookback_days=0, rolling_window=3, engine=engine,
+                        snap_tolerance='30 seconds')
+        rows = RollingStdev(**settings).to_arrow().to_pandas()
+        ranged = RollingStdev(window_frame='range', **settings).to_arrow().to_pandas()
+
+        # bars 0, 1, 2, 3, 3 (second snap, left out) and 5
+        assert rows['is_contiguous'].tolist() == [False, False, True, True, False, False]
+        assert ranged['is_contiguous'].tolist() == rows['is_contiguous'].tolist()
+        expected = [np.nan, np.nan, np.std([1, 2, 4], ddof=1), np.std([2, 4, 8], ddof=1), np.nan, np.nan]
+        assert np.allclose(rows['bid_stdev'], expected, equal_nan=True)
+        expected[1], expected[5] = np.std([1, 2], ddof=1), np.std([8, 16], ddof=1)
+        assert np.allclose(ranged['bid_stdev'], expected, equal_nan=True)
+
+    @pytest.mark.parametrize('options', [
+        {'snap_tolerance': '1 minute'},
+        {'window_frame': 'range', 'windows': [5, 20], 'statistics': ['stdev', 'mean'], 'layout': 'long'},
+    ])
+    def test_bar_mode_engines_match(self, options):
+        self.create_gappy_data()
+        data = pd.read_parquet(self.test_data_file)
+        # id_1 snaps every 15 minutes and a few seconds early, id_2 daily
+        base_time = datetime(2021, 11, 1, 0, 0)
+        quarter, daily = data['security_id'] == 'id_1', data['security_id'] == 'id_2'
+        data.loc[quarter, 'snap_time'] = base_time + (data.loc[quarter, 'snap_time'] - base_time) / 4 - timedelta(seconds=5)
+        data.loc[daily, 'snap_time'] = base_time + (data.loc[daily, 'snap_time'] - base_time) * 24
+        data.to_parquet(self.test_data_file)
+        bar_file = os.path.join(self.temp_dir, 'bars.csv')
+        pd.DataFrame({'security_id': ['id_1', 'id_2'], 'bar_interval': ['15 minutes', '1 day']}).to_csv(bar_file, index=False)
+        assert read_bar_intervals(bar_file) == {'id_1': '15 minutes', 'id_2': '1 day'}
+        settings = dict(file_path=self.test_data_file, start_output='2021-11-01 00:00:00',
+                        end_output='2022-01-01 00:00:00', lookback_days=0,
+                        bar_intervals=read_bar_intervals(bar_file), **options)
+
+        expected = RollingStdev(**settings).to_arrow().to_pandas()
+        assert expected['is_contiguous'].any()
+        for other in ({'engine': 'numpy'}, {'workers': 2}):
+            actual = RollingStdev(**settings, **other).to_arrow().to_pandas()
+            pd.testing.assert_frame_equal(actual, expected, rtol=1e-9)
+
+    @pytest.mark.parametrize("engine", RollingStdev.ENGINES)
+    def test_snap_tolerance_matches_exact_on_hourly_data(self, engine):
+        settings = dict(file_path=DATA_DIR / 'stdev_price_data.parq', engine=engine, windows=[5, 20])
+        exact = RollingStdev(**settings).to_arrow().to_pandas()
+        bars = RollingStdev(snap_tolerance='1 minute', **settings).to_arrow().to_pandas()
+        pd.testing.assert_frame_equal(bars, exact, rtol=1e-9)
+
+    def test_invalid_bar_settings(self):
+        self.create_jittered_data()
+        with pytest.raises(ValueError, match='window frame'):
+            RollingStdev(file_path=self.test_data_file, window_frame='groups')
+        with pytest.raises(ValueError, match='fixed length'):
+            RollingStdev(file_path=self.test_data_file, bar_interval='1 month')
+        with pytest.raises(ValueError, match='Invalid interval'):
+            RollingStdev(file_path=self.test_data_file, bar_intervals={'id_test': 'hourly'})
+        with pytest.raises(ValueError, match='snap tolerance'):
+            RollingStdev(file_path=self.test_data_file, snap_tolerance='1 hour')
+        with pytest.raises(ValueError, match='Bar mode'):
+            RollingStdev(file_path=self.test_data_file, engine='numpy', window_frame='range',
+                         state_file=os.path.join(self.temp_dir, 'state.parq'))
+        with pytest.raises(ValueError, match='Bar mode'):
+            RollingStdev(file_path=self.test_data_file, snap_tolerance='1 minute', run_index=True)
+
+    def test_shared_connection_matches_separate_runs(self):
+        # the second input has other security_ids, which a stale security_key ENUM could not encode
+        self.create_gappy_data(securities=3)
+        gappy = dict(file_path=self.test_data_file, start_output='2021-11-05 00:00:00', end_output='2021-11-12 23:00:00')
+        runs = [dict(file_path=DATA_DIR / 'stdev_price_data.parq', encode_keys=True),
+                dict(gappy, encode_keys=True, windows=[3, 5], layout='long'),
+                dict(gappy, engine='numpy', preserve_insertion_order=False),
+                dict(file_path=DATA_DIR / 'stdev_price_data.parq', cache_file=os.path.join(self.temp_dir, 'c.duckdb'))]
+        con = duckdb.connect()
+        for i, params in enumerate(runs):
+            shared_file = os.path.join(self.temp_dir, f'shared_{i}.csv')
+            own_file = os.path.join(self.temp_dir, f'own_{i}.csv')
+            RollingStdev(output_file=shared_file, connection=con, **params).run()
+            reset(con)
+            RollingStdev(output_file=own_file, **params).run()
+            assert Path(shared_file).read_bytes() == Path(own_file).read_bytes()
+            assert len(pd.read_csv(shared_file, sep=';')) > 0
+        # the run leaves a given connection open
+        assert con.execute("SELECT COUNT(*) FROM duckdb_types() WHERE NOT internal").fetchone()[0] == 0
+        con.close()
+
+    @pytest.mark.parametrize("options", [
+        dict(engine='sql', extension='csv'),
+        dict(engine='numpy', extension='parquet'),
+        dict(engine='sql', extension='arrow', windows=[5, 20], statistics=['stdev', 'mean'], layout='long'),
+    ])
+    def test_change_detection_matches_full_run(self, options):
+        options = dict(options)
+        extension = options.pop('extension')
+        input_file = os.path.join(self.temp_dir, 'input.parq')
+        shutil.copy(DATA_DIR / 'stdev_price_data.parq', input_file)
+        fingerprint_file = os.path.join(self.temp_dir, 'fingerprints.parquet')
+
+        def run(name, **params):
+            events = []
+            output_file = os.path.join(self.temp_dir, f'{name}.{extension}')
+            RollingStdev(file_path=input_file, output_file=output_file, metrics_callback=events.append,
+                         **options, **params).run()
+            if extension == 'csv':
+                frame = pd.read_csv(output_file, sep=';')
+            elif extension == 'parquet':
+                frame = pd.read_parquet(output_file)
+            else:
+                frame = pd.read_feather(output_file)
+            return frame, {event['stage']: event['rows'] for event in events}
+
+        first, stages = run('changes', fingerprint_file=fingerprint_file)
+        assert 'merge_output' not in stages
+        _, stages = run('changes', fingerprint_file=fingerprint_file)
+        assert stages['detect_changes']['changed_partitions'] == 0 and 'merge_output' not in stages
+
+        # restate the bids of one security over two hours and drop a snap of another
+        trades = pd.read_parquet(DATA_DIR / 'stdev_price_data.parq')
+        first_id, last_id = trades['security_id'].min(), trades['security_id'].max()
+        restated = (trades['security_id'] == first_id) & trades['snap_time'].between('2021-11-21 03:00',
+                                                                                     '2021-11-21 04:30')
+        trades.loc[restated, 'bid'] *= 1.01
+        trades = trades[~((trades['security_id'] == last_id) & (trades['snap_time'] == '2021-11-22 10:00'))]
+        trades.to_parquet(input_file)
+        merged, stages = run('changes', fingerprint_file=fingerprint_file)
+        expected, _ = run('restated')
+        pd.testing.assert_frame_equal(merged, expected, rtol=1e-9)
+        assert not merged.equals(first)
+        assert stages['detect_changes']['changed_partitions'] == 3
+        rows = stages['merge_output']
+        assert 0 < rows['recomputed_rows'] < rows['output_rows'] == len(expected)
+
+    def test_change_detection_options(self):
+        fingerprint_file = os.path.join(self.temp_dir, 'fingerprints.parquet')
+        for params in (dict(engine='numpy', state_file=os.path.join(self.temp_dir, 'state.parq')),
+                       dict(workers=2), dict(run_index=True), dict(snap_tolerance='1 minute'),
+                       dict(partition_by=['security_id'])):
+            with pytest.raises(ValueError, match='fingerprint_file'):
+                RollingStdev(file_path=DATA_DIR / 'stdev_price_data.parq', fingerprint_file=fingerprint_file,
+                             **params)
+        with pytest.raises(ValueError, match='change detection'):
+            Backfill([('2021-11-20 00:00:00', '2021-11-21 00:00:00')], self.output_file,
+                     file_path=DATA_DIR / 'stdev_price_data.parq', fingerprint_file=fingerprint_file)
+
 
 if __name__ == "__main__":
     import pytest